@@ -88,6 +88,9 @@ DATABASES = {
     }
 }
 
+# Lets a blue/green sync build the wrike mirror in a staging db.
+DATABASE_ROUTERS = ['wrike.routers.StagingRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
@@ -133,6 +136,94 @@ STATIC_ROOT = BASE_DIR + STATIC_URL
 
 CRISPY_TEMPLATE_PACK = 'bootstrap3'
 
+# The chart data is cached in files that all of the worker processes share, see wrike/report_cache.py.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'wrike_reports': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'wrike_report_cache'),
+        # Results cached before the data last changed are never read again; let them expire.
+        'TIMEOUT': 86400,
+    },
+}
+
+# Wrike sync
+# Incremental task syncs ask for tasks updated since the last watermark minus this many seconds.
+WRIKE_SYNC_WATERMARK_OVERLAP = 600
+# Number of sync stages that may run at the same time.
+WRIKE_SYNC_POOL_SIZE = 4
+# Number of pooled, reused connections to the Wrike api.
+WRIKE_HTTP_POOL_SIZE = 8
+# Seconds to wait for a connection to / a response from the Wrike api.
+WRIKE_HTTP_CONNECT_TIMEOUT = 10
+WRIKE_HTTP_READ_TIMEOUT = 120
+# 429s, 5xx responses and connection errors are retried with exponential backoff and jitter.
+WRIKE_HTTP_MAX_RETRIES = 5
+WRIKE_HTTP_BACKOFF = 1.0
+WRIKE_HTTP_BACKOFF_MAX = 60
+# Wrike allows at most this many requests per period (in seconds) per user.
+WRIKE_API_RATE_LIMIT = 400
+WRIKE_API_RATE_PERIOD = 60
+# Number of fetched pages that may wait in memory to be written to the db.
+WRIKE_PAGE_QUEUE_DEPTH = 2
+# Full task fetches are split into this many createdDate ranges, whose page chains
+# are followed by up to WRIKE_TASK_FETCH_WORKERS threads at a time.
+WRIKE_TASK_PARTITIONS = 8
+WRIKE_TASK_FETCH_WORKERS = 4
+# The ranges are spread from this date until now; older tasks fall into the first range.
+WRIKE_TASK_PARTITION_START = "2015-01-01"
+# Folders and projects are stored this many at a time; their listings are streamed
+# into temporary files WRIKE_STREAM_CHUNK_SIZE bytes at a time rather than held in memory.
+WRIKE_FOLDER_BATCH_SIZE = 1000
+WRIKE_STREAM_CHUNK_SIZE = 65536
+# Seconds between checks for tasks that have been deleted in Wrike; full syncs always check.
+WRIKE_TASK_RECONCILE_INTERVAL = 86400
+# The raw pages of every sync are archived here, gzipped, in a directory per sync run;
+# None turns archiving off. Only the archives of the last WRIKE_ARCHIVE_KEEP_RUNS runs are kept, and
+# those of the last WRIKE_ARCHIVE_KEEP_FULL_RUNS full runs, however many daemon runs came after them.
+WRIKE_ARCHIVE_DIR = os.path.join(BASE_DIR, 'wrike_archive')
+WRIKE_ARCHIVE_KEEP_RUNS = 30
+WRIKE_ARCHIVE_KEEP_FULL_RUNS = 3
+# SyncRuns and their SyncStageRuns are deleted after this many days, except those of the full runs
+# whose archives are kept.
+WRIKE_SYNC_RUN_KEEP_DAYS = 30
+# Seconds between runs of each sync stage in daemon mode (get_palm_wrike_data --daemon), keyed by the
+# stage's SyncCheckpoint entity; "task_ids" is the check for tasks that have been deleted in Wrike.
+WRIKE_SYNC_INTERVALS = {
+    "custom_fields": 86400,
+    "contacts": 3600,
+    "folders": 900,
+    "tasks": 120,
+    "task_ids": WRIKE_TASK_RECONCILE_INTERVAL,
+}
+# The longest the daemon sleeps before checking again for due stages and queued webhook updates.
+WRIKE_SYNC_DAEMON_TICK = 5
+# The secret the Wrike webhook was created with (see wrike/webhooks.py); None turns the webhook endpoint off.
+WRIKE_WEBHOOK_SECRET = None
+# The tasks and folders queued by the webhook are fetched this many per request; Wrike accepts up to 100.
+WRIKE_WEBHOOK_BATCH_SIZE = 50
+# A queued webhook update whose fetch fails waits this many seconds before it is fetched again, doubled after
+# each failed attempt; after WRIKE_WEBHOOK_MAX_ATTEMPTS it is dropped and left to the scheduled syncs.
+WRIKE_WEBHOOK_RETRY_DELAY = 60
+WRIKE_WEBHOOK_MAX_ATTEMPTS = 5
+# Held while a sync runs so that syncs, e.g. a cron run and the daemon, never overlap.
+WRIKE_SYNC_LOCK_FILE = os.path.join(BASE_DIR, 'wrike_sync.lock')
+# Where a blue/green sync builds the mirror; defaults to the live db's path + ".staging"
+WRIKE_STAGING_DB_PATH = None
+# The cache alias of the chart data, keyed by the data version that syncs bump; None turns caching off.
+WRIKE_REPORT_CACHE = 'wrike_reports'
+# Workers that miss the same cached chart data wait on lock files here for the first one to compute it.
+WRIKE_REPORT_LOCK_DIR = os.path.join(BASE_DIR, 'wrike_report_locks')
+# Wrike access tokens expire after an hour; refresh them this many seconds early.
+WRIKE_ACCESS_TOKEN_LIFETIME = 3600
+WRIKE_ACCESS_TOKEN_REFRESH_MARGIN = 120
+# Seconds to wait after a failed refresh before trying again; the old token is used until it expires.
+WRIKE_ACCESS_TOKEN_RETRY_DELAY = 30
+# Milliseconds a SQLite connection waits for a lock before giving up.
+WRIKE_SQLITE_BUSY_TIMEOUT = 20000
+
 # Email setup
 EMAIL_HOST = 'localhost'
 EMAIL_PORT = 25
@@ -173,6 +264,7 @@ LOGGING = {
             'level': 'WARNING',
             'propagate': True,
         },
+        # The sync's per-stage counters and timings are kept as SyncRuns; INFO also logs them per stage and page.
         'wrike': {
             'handlers': ['file'],
             'level': 'WARNING',
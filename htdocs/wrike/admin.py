@@ -7,4 +7,25 @@ admin.site.register(Contact)
 admin.site.register(Folder)
 admin.site.register(Task)
 admin.site.register(CustomFieldTask)
-admin.site.register(WrikeOauth2Credentials)
\ No newline at end of file
+admin.site.register(WrikeOauth2Credentials)
+admin.site.register(SyncCheckpoint)
+admin.site.register(WebhookUpdate)
+
+
+class SyncStageRunInline(admin.TabularInline):
+    model = SyncStageRun
+    extra = 0
+    can_delete = False
+    readonly_fields = ('name', 'started', 'finished', 'duration', 'success', 'requests', 'retries',
+                       'pages', 'bytes', 'rows_inserted', 'rows_updated', 'rows_unchanged', 'rows_failed',
+                       'http_seconds', 'db_seconds')
+    exclude = ('created', 'updated')
+
+
+class SyncRunAdmin(admin.ModelAdmin):
+    list_display = ('started', 'finished', 'duration', 'full', 'success')
+    list_filter = ('success', 'full')
+    date_hierarchy = 'started'
+    inlines = [SyncStageRunInline]
+
+admin.site.register(SyncRun, SyncRunAdmin)
\ No newline at end of file
@@ -1,7 +1,32 @@
 from __future__ import unicode_literals
 
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+def configure_sqlite_connection(sender, connection, **kwargs):
+    """
+    Puts the live SQLite db in WAL mode so that the charts can keep reading while
+    a sync is writing, and makes writers wait for a lock instead of failing.
+    """
+    from .routers import STAGING_DB_ALIAS
+
+    if connection.vendor != 'sqlite':
+        return
+    cursor = connection.cursor()
+    if connection.alias == STAGING_DB_ALIAS:
+        # The staging db is throwaway until it's published, so don't pay for durability.
+        cursor.execute("PRAGMA journal_mode=MEMORY")
+        cursor.execute("PRAGMA synchronous=OFF")
+    else:
+        cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=%d" % settings.WRIKE_SQLITE_BUSY_TIMEOUT)
+    cursor.close()
 
 
 class WrikeConfig(AppConfig):
     name = 'wrike'
+
+    def ready(self):
+        connection_created.connect(configure_sqlite_connection)
@@ -0,0 +1,132 @@
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+
+from django.conf import settings
+
+from .streaming import JsonItems, iter_file_chunks
+
+logger = logging.getLogger(__name__)
+
+
+# The archive of the sync that is running, if any.
+_active_archive = None
+
+
+class PayloadArchive(object):
+    """
+    The raw pages that one sync run fetched from Wrike, kept as one gzipped
+    JSON-lines file per entity type (e.g. tasks.jsonl.gz) in a directory named
+    after the run's SyncRun id under WRIKE_ARCHIVE_DIR. The files are only ever
+    appended to; a page is one line.
+    """
+    def __init__(self, run_id, root=None):
+        self.path = os.path.join(root or settings.WRIKE_ARCHIVE_DIR, str(run_id))
+        self.lock = threading.Lock()
+        self.files = {}
+
+    def get_file_path(self, entity):
+        return os.path.join(self.path, "%s.jsonl.gz" % entity)
+
+    def append(self, entity, content):
+        self.append_chunks(entity, [content])
+
+    def append_chunks(self, entity, chunks):
+        """
+        Appends a page that is given as a sequence of chunks.
+        """
+        with self.lock:
+            archive_file = self.files.get(entity, None)
+            if archive_file is None:
+                if not os.path.isdir(self.path):
+                    os.makedirs(self.path)
+                archive_file = gzip.open(self.get_file_path(entity), "ab", compresslevel=6)
+                self.files[entity] = archive_file
+            # Wrike pretty prints its json. Line breaks can only be whitespace in
+            # json, as they are escaped inside strings, so a page fits on one line.
+            for chunk in chunks:
+                archive_file.write(chunk.replace(b"\r", b" ").replace(b"\n", b" "))
+            archive_file.write(b"\n")
+
+    def close(self):
+        with self.lock:
+            for archive_file in self.files.values():
+                archive_file.close()
+            self.files = {}
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def has_pages(self, entity):
+        return os.path.exists(self.get_file_path(entity))
+
+    def get_items(self, entity):
+        """
+        Returns the rows of the first page archived for the entity, decoded one
+        at a time whenever they are iterated over, e.g. those of a folder listing.
+        """
+        return JsonItems(self.get_file_path(entity), open_file=gzip.open)
+
+    def iter_pages(self, entity):
+        """
+        Yields the decoded pages archived for the entity, in the order they were fetched.
+        """
+        if not self.has_pages(entity):
+            return
+        with gzip.open(self.get_file_path(entity), "rb") as archive_file:
+            for line in archive_file:
+                yield json.loads(line)
+
+
+def activate(run_id):
+    """
+    Starts archiving the pages fetched from now on under the given run id,
+    unless archiving is turned off by setting WRIKE_ARCHIVE_DIR to None.
+    """
+    global _active_archive
+    if settings.WRIKE_ARCHIVE_DIR:
+        _active_archive = PayloadArchive(run_id)
+
+
+def deactivate():
+    global _active_archive
+    if _active_archive is not None:
+        _active_archive.close()
+    _active_archive = None
+
+
+def record(entity, content):
+    """
+    Appends a raw page to the archive of the running sync, if any.
+    """
+    if _active_archive is not None:
+        _active_archive.append(entity, content)
+
+
+def record_file(entity, path):
+    """
+    Appends a page that was downloaded into a file to the archive of the running sync, if any.
+    """
+    if _active_archive is not None:
+        with open(path, "rb") as page_file:
+            _active_archive.append_chunks(entity, iter_file_chunks(page_file))
+
+
+def prune(keep=None, also_keep=()):
+    """
+    Deletes the archives of all but the most recent `keep` (WRIKE_ARCHIVE_KEEP_RUNS)
+    runs and the runs in `also_keep`, e.g. the last full runs, which a replay starts from.
+    """
+    root = settings.WRIKE_ARCHIVE_DIR
+    if not root or not os.path.isdir(root):
+        return
+    keep = settings.WRIKE_ARCHIVE_KEEP_RUNS if keep is None else keep
+    run_ids = sorted(int(name) for name in os.listdir(root) if name.isdigit())
+    for run_id in run_ids[:max(0, len(run_ids) - keep)]:
+        if run_id in also_keep:
+            continue
+        logger.info("Deleting the archive of Wrike sync run %s" % run_id)
+        shutil.rmtree(os.path.join(root, str(run_id)), ignore_errors=True)
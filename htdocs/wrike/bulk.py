@@ -0,0 +1,275 @@
+import bisect
+import datetime
+import hashlib
+import itertools
+import json
+import threading
+
+from contextlib import contextmanager
+
+from django.db import router, transaction
+from django.utils.timezone import utc
+
+
+# Keeps `pk__in` lookups well under SQLite's limit of 999 bound variables.
+LOOKUP_CHUNK_SIZE = 500
+
+# Number of Wrike ids per range when the local mirror is reconciled with Wrike's listing.
+RECONCILE_RANGE_SIZE = 1000
+
+_write_lock = threading.RLock()
+
+
+def chunked(items, size=LOOKUP_CHUNK_SIZE):
+    """
+    Yields successive lists of at most `size` items. The items can come from
+    a generator, which is only consumed a list at a time.
+    """
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@contextmanager
+def write_transaction(model):
+    """
+    A transaction on the db that the model is written to, for a sync stage.
+
+    SQLite has a single writer, and a transaction that has read before another
+    stage committed fails with "database is locked" as soon as it tries to write,
+    instead of waiting. The concurrent stages therefore take turns to write.
+    """
+    with _write_lock:
+        with transaction.atomic(using=router.db_for_write(model)):
+            yield
+
+
+def get_content_hash(payload):
+    """
+    Returns a stable hash of a (json serializable) wrike payload, e.g. a row or a
+    whole endpoint response. Keys are sorted so that the hash doesn't depend on
+    the order in which Wrike lists them.
+    """
+    normalized = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def get_existing_ids(model, ids):
+    """
+    Returns the subset of the given primary keys that already exist in the db.
+    """
+    existing = set()
+    for chunk in chunked(ids):
+        existing.update(model.objects.filter(pk__in=chunk).values_list('pk', flat=True))
+    return existing
+
+
+def get_existing_hashes(model, ids):
+    """
+    Returns a dictionary of {pk: content_hash} for the given primary keys that
+    already exist in the db.
+    """
+    existing = {}
+    for chunk in chunked(ids):
+        existing.update(model.objects.filter(pk__in=chunk).values_list('pk', 'content_hash'))
+    return existing
+
+
+def get_changed_ids(model, since):
+    """
+    Returns the primary keys of the rows that have been inserted, updated,
+    tombstoned or revived by the sync since the given time.
+    """
+    return set(model.objects.filter(updated__gte=since).values_list('pk', flat=True).iterator())
+
+
+def clear_content_hashes(model, ids):
+    """
+    Forgets the content hashes of the given rows so that the next sync that
+    lists them rewrites them rather than skipping them as unchanged, e.g. rows
+    that were stored without the links to folders or contacts we don't have yet.
+    """
+    for chunk in chunked(ids):
+        model.objects.filter(pk__in=chunk).update(content_hash=None)
+
+
+def bulk_upsert(model, rows):
+    """
+    Writes a whole page of rows for a model whose primary key comes from Wrike.
+
+    `rows` is a dictionary of {pk: {field: value}} where the values include the
+    content_hash of the payload row. Rows whose pk does not yet exist are inserted
+    with a single bulk_create, rows whose stored content_hash differs are updated
+    in place and rows with the same content_hash are skipped entirely. Call it
+    inside a transaction so that the page is written in one go.
+
+    Returns a tuple of (inserted, updated, unchanged) sets of primary keys.
+    """
+    existing = get_existing_hashes(model, rows.keys())
+
+    inserted = set(pk for pk in rows if pk not in existing)
+    unchanged = set(pk for pk, content_hash in existing.iteritems()
+                    if content_hash is not None and content_hash == rows[pk].get('content_hash'))
+    updated = set(existing) - unchanged
+
+    # bulk_create() and queryset.update() bypass BaseModel.save(), so stamp the updated
+    # column here; inserted rows are stamped as well, see get_changed_ids().
+    now_utc = datetime.datetime.utcnow().replace(tzinfo=utc)
+    if inserted:
+        # Leave the batch_size to django so that it honours the backend's limits.
+        model.objects.bulk_create([model(pk=pk, **dict(rows[pk], updated=now_utc)) for pk in inserted])
+
+    for pk in updated:
+        values = dict(rows[pk], updated=now_utc)
+        model.objects.filter(pk=pk).update(**values)
+
+    return (inserted, updated, unchanged)
+
+
+def bulk_upsert_values(model, owner_field, owner_ids, rows):
+    """
+    Writes custom field values (CustomFieldTask or CustomFieldFolder) for a page.
+
+    `rows` is a dictionary of {(owner_id, customfield_id): value} that holds all
+    of the values of the owners in `owner_ids`. Existing values are loaded with
+    one query per chunk of owners; new pairs are bulk inserted, only the pairs
+    whose value has changed are updated, and the pairs that are no longer given,
+    e.g. values that were cleared in Wrike, are deleted.
+
+    Returns a tuple of (inserted, updated, deleted) counts.
+    """
+    owner_column = '%s_id' % owner_field
+
+    existing = {}
+    for chunk in chunked(owner_ids):
+        lookup = {'%s__in' % owner_field: chunk}
+        for pk, owner_id, customfield_id, value in model.objects.filter(**lookup)\
+                .values_list('pk', owner_column, 'customfield_id', 'value'):
+            existing[(owner_id, customfield_id)] = (pk, value)
+
+    inserts = []
+    now_utc = datetime.datetime.utcnow().replace(tzinfo=utc)
+    updated = 0
+    for key, value in rows.iteritems():
+        current = existing.get(key, None)
+        if current is None:
+            inserts.append(model(**{owner_column: key[0], 'customfield_id': key[1], 'value': value}))
+        elif current[1] != value:
+            model.objects.filter(pk=current[0]).update(value=value, updated=now_utc)
+            updated += 1
+
+    stale = [pk for key, (pk, value) in existing.iteritems() if key not in rows]
+    for chunk in chunked(stale):
+        model.objects.filter(pk__in=chunk).delete()
+
+    if inserts:
+        model.objects.bulk_create(inserts)
+
+    return (len(inserts), updated, len(stale))
+
+
+def reconcile_m2m(model, field_name, source_ids, pairs):
+    """
+    Makes the m2m `field_name` of the given `model` rows match the desired pairs.
+
+    `pairs` is the set of (source_id, target_id) pairs that should exist for the
+    rows in `source_ids`. The existing pairs of those rows are loaded with one query
+    per chunk and diffed against the desired ones; only the missing pairs are bulk
+    inserted and only the stale ones are deleted. Rows that are not in `source_ids`
+    are left alone.
+
+    Returns a tuple of (inserted, deleted) counts.
+    """
+    field = model._meta.get_field(field_name)
+    through = field.remote_field.through
+    source_column = '%s_id' % field.m2m_field_name()
+    target_column = '%s_id' % field.m2m_reverse_field_name()
+
+    existing = {}
+    for chunk in chunked(source_ids):
+        lookup = {'%s__in' % source_column: chunk}
+        for pk, source_id, target_id in through.objects.filter(**lookup)\
+                .values_list('pk', source_column, target_column):
+            existing[(source_id, target_id)] = pk
+
+    stale = [pk for pair, pk in existing.iteritems() if pair not in pairs]
+    for chunk in chunked(stale):
+        through.objects.filter(pk__in=chunk).delete()
+
+    missing = [through(**{source_column: source_id, target_column: target_id})
+               for source_id, target_id in pairs if (source_id, target_id) not in existing]
+    if missing:
+        through.objects.bulk_create(missing)
+
+    return (len(missing), len(stale))
+
+
+class RangeDigests(object):
+    """
+    Digests of the ids that fall into each of a list of id ranges.
+
+    A range starts at its lower bound and ends before the next range's; the
+    first range also takes the ids below its lower bound. A digest is the count
+    and the xor of the ids' hashes, so it doesn't depend on the order in which
+    the ids are added.
+    """
+    def __init__(self, lower_bounds):
+        self.lower_bounds = lower_bounds
+        self.digests = [(0, 0)] * len(lower_bounds)
+
+    def get_range(self, pk):
+        return max(0, bisect.bisect_right(self.lower_bounds, pk) - 1)
+
+    def add(self, pk):
+        i = self.get_range(pk)
+        count, digest = self.digests[i]
+        self.digests[i] = (count + 1, digest ^ int(hashlib.md5(pk.encode('utf-8')).hexdigest(), 16))
+
+
+def reconcile_tombstones(model, remote_ids, range_size=RECONCILE_RANGE_SIZE):
+    """
+    Tombstones the rows of the model that are no longer listed by Wrike and
+    revives the tombstoned rows that are listed again.
+
+    `remote_ids` are all of the ids that Wrike lists. They are split into ranges
+    of `range_size` ids and the digest of each range is compared with the digest
+    of the local rows that aren't tombstoned in the same range; the local ids are
+    streamed from the db rather than loaded all at once. Only the ranges whose
+    digests differ are compared id by id. Remote ids that don't exist locally
+    yet are left to the sync.
+
+    Returns a tuple of (tombstoned, revived, ranges that differed, all ranges).
+    """
+    if not remote_ids:
+        # An empty listing is far more likely to be an api problem than an empty account.
+        return (0, 0, 0, 0)
+    remote_ids = sorted(set(remote_ids))
+    lower_bounds = remote_ids[::range_size]
+    remote = RangeDigests(lower_bounds)
+    for pk in remote_ids:
+        remote.add(pk)
+
+    live_ids = model.objects.filter(tombstoned=False).values_list('pk', flat=True)
+    local = RangeDigests(lower_bounds)
+    for pk in live_ids.iterator():
+        local.add(pk)
+
+    differing = set(i for i in range(len(lower_bounds)) if remote.digests[i] != local.digests[i])
+    if not differing:
+        return (0, 0, 0, len(lower_bounds))
+
+    # A second pass over the local ids collects those of the ranges that differ.
+    local_ids = set(pk for pk in live_ids.iterator() if local.get_range(pk) in differing)
+    listed_ids = set(pk for pk in remote_ids if remote.get_range(pk) in differing)
+
+    now_utc = datetime.datetime.utcnow().replace(tzinfo=utc)
+    tombstoned = 0
+    for chunk in chunked(local_ids - listed_ids):
+        tombstoned += model.objects.filter(pk__in=chunk).update(tombstoned=True, updated=now_utc)
+    revived = 0
+    for chunk in chunked(listed_ids - local_ids):
+        revived += model.objects.filter(pk__in=chunk, tombstoned=True).update(tombstoned=False, updated=now_utc)
+    return (tombstoned, revived, len(differing), len(lower_bounds))
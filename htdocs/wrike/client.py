@@ -0,0 +1,297 @@
+import collections
+import logging
+import random
+import threading
+import time
+import requests
+import Queue
+
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from .tokens import token_provider
+from . import archive, telemetry
+
+logger = logging.getLogger(__name__)
+
+
+class RequestBudget(object):
+    """
+    Keeps the sync within Wrike's rate limit of WRIKE_API_RATE_LIMIT requests
+    per WRIKE_API_RATE_PERIOD seconds, no matter how many threads are making
+    requests. The times of the last WRIKE_API_RATE_LIMIT requests are kept and
+    a request waits until the oldest of them is a period old, so that no rolling
+    period, including the first one, ever holds more requests than the limit.
+    """
+    def __init__(self, requests_allowed, period):
+        self.period = float(period)
+        self.sent = collections.deque(maxlen=max(1, int(requests_allowed)))
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                if len(self.sent) < self.sent.maxlen or now - self.sent[0] >= self.period:
+                    # A full deque drops the oldest time.
+                    self.sent.append(now)
+                    return
+                wait = self.sent[0] + self.period - now
+            time.sleep(wait)
+
+
+class WrikeClient(object):
+    """
+    The http client used for all of the wrike api calls.
+
+    It shares one pooled session between all threads, adds the access token to
+    every request, applies connect and read timeouts, stays within Wrike's rate
+    limit and retries 429s, 5xx responses and connection errors with exponential
+    backoff and jitter. It counts the requests, retries and bytes received.
+    """
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=settings.WRIKE_HTTP_POOL_SIZE,
+            pool_maxsize=settings.WRIKE_HTTP_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.budget = RequestBudget(settings.WRIKE_API_RATE_LIMIT, settings.WRIKE_API_RATE_PERIOD)
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "retries": 0, "bytes": 0, "seconds": 0.0}
+
+    def count(self, **increments):
+        with self.lock:
+            for name, value in increments.iteritems():
+                self.counters[name] += value
+
+    def get_counters(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def get(self, url, **kwargs):
+        """
+        GETs a wrike api url with the current access token. If Wrike rejects the
+        token, e.g. because it expired in the middle of a pagination, the request
+        is retried once with a freshly refreshed token.
+        """
+        access_token = token_provider.get_token()
+        response = self.request("GET", url, access_token, **kwargs)
+        if response.status_code == 401:
+            token_provider.invalidate(access_token)
+            response = self.request("GET", url, token_provider.get_token(), **kwargs)
+        if response.status_code == 200:
+            telemetry.record(pages=1)
+        return response
+
+    def request(self, method, url, access_token, **kwargs):
+        kwargs.setdefault("timeout", (settings.WRIKE_HTTP_CONNECT_TIMEOUT, settings.WRIKE_HTTP_READ_TIMEOUT))
+        headers = {"Authorization": "bearer %s" % access_token}
+        attempt = 0
+        while True:
+            self.budget.acquire()
+            start_time = time.time()
+            try:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+                error = None
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                response = None
+                error = e
+            received = len(response.content) if response is not None and not kwargs.get("stream") else 0
+            elapsed = time.time() - start_time
+            self.count(requests=1, seconds=elapsed, bytes=received)
+            telemetry.record(requests=1, http_seconds=elapsed, bytes=received)
+
+            if error is None and response.status_code not in self.RETRY_STATUS_CODES:
+                return response
+            if attempt >= settings.WRIKE_HTTP_MAX_RETRIES:
+                if error is not None:
+                    raise error
+                return response
+
+            delay = self.get_retry_delay(attempt, response)
+            logger.warn("Wrike %s %s failed (%s); retrying in %.1fs" % (
+                method, url, error or response.status_code, delay))
+            self.count(retries=1)
+            telemetry.record(retries=1)
+            attempt += 1
+            time.sleep(delay)
+
+    def get_retry_delay(self, attempt, response):
+        """
+        Honours Wrike's Retry-After header; otherwise backs off exponentially
+        with full jitter so that concurrent workers don't retry in lockstep.
+        """
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        ceiling = min(settings.WRIKE_HTTP_BACKOFF_MAX, settings.WRIKE_HTTP_BACKOFF * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the WrikeClient shared by the whole process.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = WrikeClient()
+    return _client
+
+
+def get(url, **kwargs):
+    return get_client().get(url, **kwargs)
+
+
+def map_concurrently(func, items):
+    """
+    Calls the function on each of the items on a thread pool, within the
+    caller's telemetry stage, and returns the results in the same order.
+    """
+    stage = telemetry.get_current_stage()
+
+    def call_for_stage(item):
+        telemetry.bind(stage)
+        return func(item)
+
+    pool = ThreadPool(min(len(items), settings.WRIKE_HTTP_POOL_SIZE))
+    try:
+        return pool.map(call_for_stage, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_many(urls):
+    """
+    Issues the GET requests concurrently and returns the responses in the same
+    order as the urls.
+    """
+    return map_concurrently(get, urls)
+
+
+def download(url, path, archive_as=None):
+    """
+    Streams the body of a GET into a file, WRIKE_STREAM_CHUNK_SIZE bytes at a
+    time, so that a large listing never has to be held in memory. Returns the
+    number of bytes received.
+    """
+    received = 0
+    response = get(url, stream=True)
+    try:
+        response.raise_for_status()
+        with open(path, "wb") as download_file:
+            for chunk in response.iter_content(chunk_size=settings.WRIKE_STREAM_CHUNK_SIZE):
+                download_file.write(chunk)
+                received += len(chunk)
+    finally:
+        response.close()
+        # Streamed bodies aren't counted by request().
+        get_client().count(bytes=received)
+        telemetry.record(bytes=received)
+    if archive_as:
+        archive.record_file(archive_as, path)
+    return received
+
+
+def download_many(downloads):
+    """
+    Downloads the (url, path, archive_as) downloads concurrently.
+    """
+    return map_concurrently(lambda item: download(*item), downloads)
+
+
+def iter_pages(url, queue_depth=None, archive_as=None):
+    """
+    Yields the decoded pages of a paginated wrike api call.
+
+    A producer thread follows the nextPageToken chain and pushes each decoded
+    page into a bounded queue, so that the next page is being downloaded while
+    the caller is still storing the current one. At most `queue_depth` pages are
+    held in memory at a time.
+    """
+    return iter_partitioned_pages([url], workers=1, queue_depth=queue_depth, archive_as=archive_as)
+
+
+def iter_partitioned_pages(urls, workers=None, queue_depth=None, archive_as=None):
+    """
+    Yields the decoded pages of several paginated wrike api calls, e.g. the
+    partitions of a task listing, in the order in which they arrive.
+
+    Up to `workers` nextPageToken chains are followed at the same time, each by
+    its own producer thread, and their pages are pushed into one bounded queue.
+    At most `queue_depth` pages are held in memory at a time. If any call fails
+    the error is raised and the remaining producers stop.
+    """
+    pages = Queue.Queue(maxsize=queue_depth or settings.WRIKE_PAGE_QUEUE_DEPTH)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up if the consumer has stopped reading, instead of blocking forever.
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    stage = telemetry.get_current_stage()
+    pending = Queue.Queue()
+    for url in urls:
+        pending.put(url)
+
+    def produce():
+        telemetry.bind(stage)
+        try:
+            while not stop.is_set():
+                try:
+                    url = pending.get_nowait()
+                except Queue.Empty:
+                    break
+                next_url = url
+                while next_url is not None:
+                    response = get(next_url)
+                    # A 429 or 5xx that outlasted the retries must not pass for the last page.
+                    response.raise_for_status()
+                    if archive_as:
+                        archive.record(archive_as, response.content)
+                    page = response.json()
+                    if not put(page):
+                        return
+                    nextPageToken = page.get('nextPageToken', None)
+                    next_url = None if nextPageToken is None else "%s&%s=%s" % (url, "nextPageToken", nextPageToken)
+        except Exception as e:
+            put(e)
+            return
+        put(done)
+
+    producers = []
+    for i in range(min(workers or settings.WRIKE_TASK_FETCH_WORKERS, len(urls))):
+        producer = threading.Thread(target=produce, name="wrike-pages-%d" % i)
+        producer.daemon = True
+        producer.start()
+        producers.append(producer)
+    try:
+        running = len(producers)
+        while running:
+            page = pages.get()
+            if page is done:
+                running -= 1
+                continue
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        stop.set()
+        for producer in producers:
+            producer.join()
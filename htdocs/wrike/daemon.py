@@ -0,0 +1,130 @@
+import datetime
+import errno
+import fcntl
+import logging
+import signal
+import threading
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .models import SyncCheckpoint
+from . import utils, webhooks
+
+logger = logging.getLogger(__name__)
+
+
+class SyncAlreadyRunning(Exception):
+    pass
+
+
+@contextmanager
+def sync_lock(path=None):
+    """
+    Holds an exclusive lock on WRIKE_SYNC_LOCK_FILE so that syncs never overlap.
+    Raises SyncAlreadyRunning if another process holds the lock. The lock is
+    released by the OS if the process dies.
+    """
+    path = path or settings.WRIKE_SYNC_LOCK_FILE
+    lock_file = open(path, "a")
+    try:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise SyncAlreadyRunning("Another Wrike sync holds %s" % path)
+            raise
+        yield
+    finally:
+        lock_file.close()
+
+
+def get_due_stages(now=None):
+    """
+    Returns the names of the sync stages whose WRIKE_SYNC_INTERVALS interval has
+    passed since they last started, and the seconds until the next stage that
+    isn't due yet will be. The Webhook Updates stage is due whenever there are
+    queued updates that aren't backing off after a failed fetch, and the Support
+    Facts stage follows every run, see utils.process_wrike_data.
+    """
+    now = now or timezone.now()
+    checkpoints = dict((checkpoint.entity, checkpoint) for checkpoint in
+                       SyncCheckpoint.objects.filter(entity__in=utils.STAGE_ENTITIES.values()))
+    due = []
+    wait = None
+    for name, func, dependencies in utils.get_sync_stages():
+        if name == "Webhook Updates":
+            # Runs whenever the webhook has queued something, rather than on a schedule.
+            if webhooks.get_ready_updates(now).exists():
+                due.append(name)
+            continue
+        if name == "Support Facts":
+            continue
+        entity = utils.STAGE_ENTITIES[name]
+        checkpoint = checkpoints.get(entity, None)
+        if checkpoint is None or checkpoint.last_started is None:
+            due.append(name)
+            continue
+        next_run = checkpoint.last_started + datetime.timedelta(seconds=settings.WRIKE_SYNC_INTERVALS[entity])
+        if next_run <= now:
+            due.append(name)
+        else:
+            remaining = (next_run - now).total_seconds()
+            wait = remaining if wait is None else min(wait, remaining)
+    return due, wait
+
+
+class SyncDaemon(object):
+    """
+    Keeps the mirror fresh by running each sync stage on its own schedule
+    (WRIKE_SYNC_INTERVALS) instead of reloading everything on every run.
+
+    The stages that are due are run together as one SyncRun; the tasks and
+    folders queued by the webhook are fetched within a tick. SIGTERM and SIGINT
+    stop the daemon once the run in progress, if any, has finished.
+    """
+    def __init__(self, tick=None):
+        self.tick = tick or settings.WRIKE_SYNC_DAEMON_TICK
+        self.stopping = threading.Event()
+
+    def stop(self, signum=None, frame=None):
+        logger.info("Wrike sync daemon is stopping")
+        self.stopping.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        # Only one daemon at a time; the sync lock itself is only held while a run is in progress.
+        with sync_lock(settings.WRIKE_SYNC_LOCK_FILE + ".daemon"):
+            logger.info("Wrike sync daemon started")
+            while not self.stopping.is_set():
+                wait = self.run_due_stages()
+                # Don't keep idle connections open between runs.
+                for conn in connections.all():
+                    conn.close()
+                if wait:
+                    self.stopping.wait(min(wait, self.tick))
+        logger.info("Wrike sync daemon stopped")
+
+    def run_due_stages(self):
+        """
+        Runs the stages that are due and returns the seconds to wait before checking again.
+        """
+        due, wait = get_due_stages()
+        if not due:
+            return wait
+        try:
+            with sync_lock():
+                logger.info("Wrike sync daemon is running: %s" % ", ".join(due))
+                success = utils.process_wrike_data(stage_names=due)
+        except SyncAlreadyRunning as e:
+            logger.info("%s; trying again later" % e)
+            return self.tick
+        if not success:
+            # E.g. the api is down; don't run the failed stages again straight away.
+            return self.tick
+        # Check again straight away, in case a stage became due while the others were running.
+        return 0
@@ -0,0 +1,297 @@
+"""
+The support facts and their daily rollup that the charts are drawn from, see
+SupportFact and SupportRollup.
+"""
+import datetime
+import logging
+import time
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.timezone import utc
+
+from .bulk import chunked, get_changed_ids, write_transaction
+from .hierarchy import update_folder_closure
+from .models import Folder, FolderClosure, Task, SupportFact, SupportRollup, SyncCheckpoint
+from . import telemetry
+
+logger = logging.getLogger(__name__)
+
+# The SyncCheckpoint whose watermark is when the facts were last brought up to date.
+FACTS_ENTITY = "support_facts"
+
+# The category of the tasks in the general tech support folder.
+GEN_TECH = "gen_tech"
+
+# The project categories of the charts, each with the settings that hold the ids
+# of its folder and of its archive folder.
+SUPPORT_CATEGORIES = (
+    ("recruitment", ("WRIKE_PALM_RECRUITING_FOLDER_ID", "WRIKE_PALM_RECRUITMENT_ARCHIVE_FOLDER_ID")),
+    ("material_aid", ("WRIKE_PALM_MATERIAL_AID_FOLDER_ID", "WRIKE_PALM_MATERIAL_AID_ARCHIVE_FOLDER_ID")),
+    ("tdy", ("WRIKE_PALM_SHORT_TERM_TDY_FOLDER_ID", "WRIKE_PALM_SHORT_TERM_TDY_ARCHIVE_FOLDER_ID")),
+    ("agency_response", ("WRIKE_PALM_AGENCY_RESPONSE_FOLDER_ID", "WRIKE_PALM_AGENCY_RESPONSE_ARCHIVE_FOLDER_ID")),
+    ("field_trips", ("WRIKE_PALM_FILED_TRIPS_FOLDER_ID", "WRIKE_PALM_FIELD_TRIPS_ARCHIVE_FOLDER_ID")),
+    ("snl", ("WRIKE_PALM_SHIPPING_LOGISTICS_FOLDER_ID", "WRIKE_PALM_SHIPPING_LOGISTICS_ARCHIVE_FOLDER_ID")),
+    ("tenders", ("WRIKE_PALM_TENDERS_FOLDER_ID", "WRIKE_PALM_TENDERS_ARCHIVE_FOLDER_ID")),
+)
+
+# Facts are written this many at a time.
+FACT_BATCH_SIZE = 1000
+
+# The SupportRollup columns that the buckets are sliced by, in the order of
+# the columns of a fact as returned by get_support_facts.
+ROLLUP_FIELDS = ("assignee", "country", "region")
+
+
+def get_support_category_folder_ids():
+    """
+    Returns a list of (category, ids of the category's folders) for the SUPPORT_CATEGORIES.
+    """
+    return [(category, [getattr(settings, name) for name in setting_names])
+            for category, setting_names in SUPPORT_CATEGORIES]
+
+
+def get_child_folder_ids(parent_id):
+    return set(Folder.objects.filter(parents=parent_id, tombstoned=False).values_list('id', flat=True))
+
+
+def group_pairs(pairs, groups=None):
+    """
+    Returns {key: [values]} for the (key, value) pairs.
+    """
+    groups = {} if groups is None else groups
+    for key, value in pairs:
+        groups.setdefault(key, []).append(value)
+    return groups
+
+
+def get_support_facts(task_ids=None, project_ids=None):
+    """
+    Returns {(category, task or project id): set of (assignee id, country id,
+    region id, completedDate)} for the general tech support tasks and the
+    projects filed under the category folders, except the ones that were
+    deleted in Wrike, from the mirror. Tasks and projects count wherever they
+    are filed under those folders and under the countries and regions, however
+    deep; folders deeper than the categories' direct subfolders only count if
+    they're projects, rather than the folders that group them.
+
+    If `task_ids` and `project_ids` are given, only the facts of those tasks and
+    folders are returned, for the ones that are support instances.
+    """
+    countries = get_child_folder_ids(settings.WRIKE_PALM_COUNTRIES_FOLDER_ID)
+    regions = get_child_folder_ids(settings.WRIKE_PALM_RPD_PORTFOLIOS_FOLDER_ID)
+    place_ids = list(countries | regions)
+
+    # {(category, task or project id): completedDate}
+    instances = {}
+    # The countries and regions, and the assignees, of the tasks and projects.
+    places = {}
+    assignees = {}
+
+    gen_tech_folders = FolderClosure.objects\
+        .filter(ancestor=settings.WRIKE_PALM_GENERAL_TECH_SUPPORT_FOLDER_ID).values('descendant')
+    for chunk in [None] if task_ids is None else chunked(task_ids):
+        tasks = Task.objects.filter(folders__in=gen_tech_folders, tombstoned=False)
+        if chunk is not None:
+            tasks = tasks.filter(pk__in=chunk)
+        tasks = tasks.distinct()
+        for task_id, completed in tasks.values_list('id', 'completedDate'):
+            instances[(GEN_TECH, task_id)] = completed
+        group_pairs(Task.folders.through.objects
+                    .filter(task__in=tasks.values('pk'), folder__ancestor_links__ancestor__in=place_ids)
+                    .values_list('task_id', 'folder__ancestor_links__ancestor_id'), places)
+        group_pairs(Task.assignees.through.objects
+                    .filter(task__in=tasks.values('pk'))
+                    .values_list('task_id', 'contact_id'), assignees)
+
+    category_of_folder = dict((folder_id, category) for category, folder_ids in get_support_category_folder_ids()
+                              for folder_id in folder_ids)
+    for chunk in [None] if project_ids is None else chunked(project_ids):
+        project_links = FolderClosure.objects\
+            .filter(ancestor__in=list(category_of_folder), descendant__tombstoned=False)\
+            .filter(Q(depth=1) | Q(depth__gt=1, descendant__status__isnull=False))
+        if chunk is not None:
+            project_links = project_links.filter(descendant__in=chunk)
+        for project_id, folder_id, completed in project_links.values_list(
+                'descendant_id', 'ancestor_id', 'descendant__completedDate'):
+            instances[(category_of_folder[folder_id], project_id)] = completed
+        projects = project_links.values('descendant')
+        group_pairs(FolderClosure.objects
+                    .filter(descendant__in=projects, ancestor__in=place_ids)
+                    .values_list('descendant_id', 'ancestor_id'), places)
+        group_pairs(Folder.assignees.through.objects
+                    .filter(folder__in=projects)
+                    .values_list('folder_id', 'contact_id'), assignees)
+
+    facts = {}
+    for (category, wrike_id), completed in instances.iteritems():
+        folder_ids = places.get(wrike_id, [])
+        facts[(category, wrike_id)] = set(
+            (assignee_id, country_id, region_id, completed)
+            for assignee_id in assignees.get(wrike_id, None) or [None]
+            for country_id in [pk for pk in folder_ids if pk in countries] or [None]
+            for region_id in [pk for pk in folder_ids if pk in regions] or [None])
+    return facts
+
+
+def get_stored_support_facts(wrike_ids=None):
+    """
+    Returns the SupportFacts in the form of get_support_facts(), and
+    {(category, task or project id): [pks of its SupportFacts]}; only those of
+    the given tasks and projects if `wrike_ids` is given.
+    """
+    facts = {}
+    pks = {}
+    categories = [GEN_TECH] + [category for category, setting_names in SUPPORT_CATEGORIES]
+    for chunk in [None] if wrike_ids is None else chunked(wrike_ids):
+        stored = SupportFact.objects.all()
+        if chunk is not None:
+            # The categories let the lookup use the (category, wrike_id) index.
+            stored = stored.filter(category__in=categories, wrike_id__in=chunk)
+        for pk, category, wrike_id, assignee_id, country_id, region_id, completed in stored.values_list(
+                'pk', 'category', 'wrike_id', 'assignee_id', 'country_id', 'region_id', 'completedDate').iterator():
+            facts.setdefault((category, wrike_id), set()).add((assignee_id, country_id, region_id, completed))
+            pks.setdefault((category, wrike_id), []).append(pk)
+    return facts, pks
+
+
+def get_affected_ids(since):
+    """
+    Returns the ids of the tasks and of the folders whose facts may have changed
+    since the given time: those that the sync has inserted, updated or tombstoned
+    since then, the folders anywhere under the changed folders, and the tasks in
+    any of those folders.
+    """
+    task_ids = get_changed_ids(Task, since)
+    changed_folder_ids = get_changed_ids(Folder, since)
+    # A deleted folder has no FolderClosure rows any more, but its subfolders can
+    # still be found through their parents.
+    folder_ids = set(changed_folder_ids)
+    for chunk in chunked(changed_folder_ids):
+        folder_ids.update(Folder.parents.through.objects.filter(to_folder__in=chunk)
+                          .values_list('from_folder_id', flat=True))
+    for chunk in chunked(list(folder_ids)):
+        folder_ids.update(FolderClosure.objects.filter(ancestor__in=chunk)
+                          .values_list('descendant_id', flat=True))
+    for chunk in chunked(folder_ids):
+        task_ids.update(Task.folders.through.objects.filter(folder__in=chunk).values_list('task_id', flat=True))
+    return task_ids, folder_ids
+
+
+def add_rollup_deltas(deltas, category, facts, increment):
+    """
+    Adds the increment to the deltas of the SupportRollup buckets of one task
+    or project, i.e. to its day's bucket of each of its assignees, countries
+    and regions.
+    """
+    completed = next(iter(facts))[3]
+    day = completed.date() if completed is not None else None
+    for index, field in enumerate(ROLLUP_FIELDS):
+        for pk in set(fact[index] for fact in facts):
+            if pk is not None:
+                key = (day, category, field, pk)
+                deltas[key] = deltas.get(key, 0) + increment
+
+
+def apply_rollup_deltas(deltas):
+    """
+    Applies {(day, category, field, pk): delta} to the SupportRollup buckets,
+    creating the buckets that don't exist yet and deleting the ones that drop
+    to zero. Returns a tuple of (inserted, updated, deleted) counts.
+    """
+    deltas = dict((key, delta) for key, delta in deltas.iteritems() if delta)
+    existing = {}
+    days = set(day for day, category, field, pk in deltas)
+    for chunk in chunked([day for day in days if day is not None]):
+        for bucket in SupportRollup.objects.filter(day__in=chunk):
+            existing[bucket.get_key()] = bucket
+    if None in days:
+        for bucket in SupportRollup.objects.filter(day__isnull=True):
+            existing[bucket.get_key()] = bucket
+
+    inserts = []
+    updated = 0
+    deleted = []
+    for key, delta in deltas.iteritems():
+        bucket = existing.get(key, None)
+        if bucket is None:
+            day, category, field, pk = key
+            inserts.append(SupportRollup(day=day, category=category, total=delta, **{'%s_id' % field: pk}))
+        elif bucket.total + delta == 0:
+            deleted.append(bucket.pk)
+        else:
+            SupportRollup.objects.filter(pk=bucket.pk).update(total=bucket.total + delta)
+            updated += 1
+    for chunk in chunked(deleted):
+        SupportRollup.objects.filter(pk__in=chunk).delete()
+    for batch in chunked(inserts, FACT_BATCH_SIZE):
+        SupportRollup.objects.bulk_create(batch)
+    return (len(inserts), updated, len(deleted))
+
+
+def update_support_facts():
+    """
+    Brings the SupportFact table in line with the mirror, and the SupportRollup
+    buckets with the facts. Only the tasks and projects that the sync may have
+    changed since the last update are looked at, see get_affected_ids(); only
+    the facts of those that have changed are rewritten, and only their buckets
+    are adjusted. If there are no buckets yet, e.g. after they were added, every
+    fact is rewritten so that the rollup is built from scratch.
+    """
+    start_time = time.time()
+    started = datetime.datetime.utcnow().replace(tzinfo=utc)
+    if not FolderClosure.objects.exists():
+        # E.g. right after the table was added, before the Folders stage has filled it.
+        update_folder_closure()
+    checkpoint = SyncCheckpoint.objects.get_or_none(pk=FACTS_ENTITY)
+    since = checkpoint.watermark if checkpoint else None
+    rebuild = not SupportRollup.objects.exists()
+    if rebuild or since is None:
+        facts = get_support_facts()
+        wrike_ids = None
+    else:
+        task_ids, folder_ids = get_affected_ids(since)
+        facts = get_support_facts(task_ids, folder_ids)
+        wrike_ids = task_ids | folder_ids
+    if rebuild:
+        stored_facts, stored_pks = {}, {}
+    else:
+        stored_facts, stored_pks = get_stored_support_facts(wrike_ids)
+    changed = [instance for instance in set(facts) | set(stored_facts)
+               if facts.get(instance, None) != stored_facts.get(instance, None)]
+
+    deltas = {}
+    for instance in changed:
+        if instance in stored_facts:
+            add_rollup_deltas(deltas, instance[0], stored_facts[instance], -1)
+        if instance in facts:
+            add_rollup_deltas(deltas, instance[0], facts[instance], 1)
+
+    def iter_changed_facts():
+        for category, wrike_id in changed:
+            for assignee_id, country_id, region_id, completed in facts.get((category, wrike_id), ()):
+                yield SupportFact(category=category, wrike_id=wrike_id, assignee_id=assignee_id,
+                                  country_id=country_id, region_id=region_id, completedDate=completed)
+
+    inserted = 0
+    try:
+        with write_transaction(SupportFact):
+            if rebuild:
+                SupportFact.objects.all().delete()
+            for chunk in chunked([pk for instance in changed for pk in stored_pks.get(instance, [])]):
+                SupportFact.objects.filter(pk__in=chunk).delete()
+            for batch in chunked(iter_changed_facts(), FACT_BATCH_SIZE):
+                SupportFact.objects.bulk_create(batch)
+                inserted += len(batch)
+            buckets = apply_rollup_deltas(deltas)
+            SyncCheckpoint.objects.update_or_create(entity=FACTS_ENTITY, defaults={'watermark': started})
+    except Exception as e:
+        logger.error(e)
+        return False
+    looked_at = len(set(facts) | set(stored_facts))
+    telemetry.record(inserted=inserted, updated=len(changed), unchanged=looked_at - len(changed),
+                     db_seconds=time.time() - start_time)
+    logger.info("Support facts: %s of %s tasks and projects looked at changed; %s facts written; "
+                "%s buckets inserted, %s updated, %s deleted in %.2fs" % (
+                    (len(changed), looked_at, inserted) + buckets + (time.time() - start_time,)))
+    return True
@@ -0,0 +1,471 @@
+"""
+A local stand-in for the parts of the Wrike api that the sync uses, serving a
+deterministic synthetic account. It lets get_palm_wrike_data be load tested
+without touching the real Wrike account; see the run_fake_wrike_server and
+benchmark_wrike_sync management commands.
+"""
+import datetime
+import json
+import logging
+import random
+import time
+import urlparse
+import zlib
+import BaseHTTPServer
+import SocketServer
+# strptime imports this lazily, which isn't thread safe on python 2.
+import _strptime
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Synthetic account sizes, in number of tasks.
+ACCOUNT_SIZES = {
+    'small': 1000,
+    'medium': 100000,
+    'large': 1000000,
+}
+
+# The folders that the charts in views_helpers look for. They get the ids from
+# the settings, if set, so that the charts have data after a synthetic sync.
+CATEGORY_FOLDER_SETTINGS = (
+    'WRIKE_PALM_RECRUITING_FOLDER_ID',
+    'WRIKE_PALM_RECRUITMENT_ARCHIVE_FOLDER_ID',
+    'WRIKE_PALM_MATERIAL_AID_FOLDER_ID',
+    'WRIKE_PALM_MATERIAL_AID_ARCHIVE_FOLDER_ID',
+    'WRIKE_PALM_SHORT_TERM_TDY_FOLDER_ID',
+    'WRIKE_PALM_SHORT_TERM_TDY_ARCHIVE_FOLDER_ID',
+    'WRIKE_PALM_AGENCY_RESPONSE_FOLDER_ID',
+    'WRIKE_PALM_AGENCY_RESPONSE_ARCHIVE_FOLDER_ID',
+    'WRIKE_PALM_FILED_TRIPS_FOLDER_ID',
+    'WRIKE_PALM_FIELD_TRIPS_ARCHIVE_FOLDER_ID',
+    'WRIKE_PALM_SHIPPING_LOGISTICS_FOLDER_ID',
+    'WRIKE_PALM_SHIPPING_LOGISTICS_ARCHIVE_FOLDER_ID',
+    'WRIKE_PALM_TENDERS_FOLDER_ID',
+    'WRIKE_PALM_TENDERS_ARCHIVE_FOLDER_ID',
+)
+STRUCTURE_FOLDER_SETTINGS = (
+    'WRIKE_PALM_GENERAL_TECH_SUPPORT_FOLDER_ID',
+    'WRIKE_PALM_COUNTRIES_FOLDER_ID',
+    'WRIKE_PALM_RPD_PORTFOLIOS_FOLDER_ID',
+) + CATEGORY_FOLDER_SETTINGS
+
+ACCOUNT_ID = 'IEFAKEACCOUNT'
+ROOT_FOLDER_ID = 'IEFAKEROOT'
+TASK_STATUSES = ('Active', 'Completed', 'Completed', 'Deferred', 'Cancelled')
+PROJECT_STATUSES = ('Green', 'Yellow', 'Red', 'Completed', 'OnHold', 'Cancelled')
+IMPORTANCES = ('High', 'Normal', 'Normal', 'Low')
+# Task fields that Wrike only returns when they are asked for with the `fields` parameter.
+OPTIONAL_TASK_FIELDS = ('briefDescription', 'parentIds', 'responsibleIds', 'customFields')
+# Created dates of the synthetic tasks and projects are spread over this many days up to today.
+PERIOD_DAYS = 3 * 365
+
+
+def format_date(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_date_range(value):
+    """
+    Parses a Wrike date range parameter such as {"start":"2016-01-01T00:00:00Z"}
+    into a (start, end) tuple of the date strings; missing bounds are None.
+    """
+    if not value:
+        return (None, None)
+    date_range = json.loads(value)
+    return (date_range.get('start', None), date_range.get('end', None))
+
+
+class SyntheticAccount(object):
+    """
+    A deterministic, synthetic Wrike account.
+
+    Every row is derived from its index and the seed, so the same account is
+    generated every time (its dates are relative to the current day) and tasks
+    are only materialized one page at a time, which keeps the server's memory
+    flat even for a million tasks.
+
+    The folder tree has the PALM structure folders under a root folder, country
+    and region folders, projects filed under a category folder and a country,
+    and `folders` generic folders nested `depth` levels deep. Half of the tasks
+    are general tech support requests filed under a country, the rest are filed
+    under the generic folders.
+    """
+    def __init__(self, tasks=1000, folders=None, projects=None, depth=4, contacts=50,
+                 customfields=10, countries=40, regions=6, seed=0):
+        self.tasks = tasks
+        self.folders = folders if folders is not None else max(10, tasks // 100)
+        self.projects = projects if projects is not None else max(10, tasks // 20)
+        self.depth = max(1, depth)
+        self.contacts = contacts
+        self.customfields = customfields
+        self.countries = countries
+        self.regions = regions
+        self.seed = seed
+        today = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.start_date = today - datetime.timedelta(days=PERIOD_DAYS)
+        self.structure_folder_ids = dict(
+            (name, getattr(settings, name, None) or 'IEFAKE%s' % name[len('WRIKE_PALM_'):-len('_FOLDER_ID')])
+            for name in STRUCTURE_FOLDER_SETTINGS)
+
+    def get_random(self, kind, index):
+        return random.Random(zlib.crc32("%s:%s:%s" % (self.seed, kind, index)))
+
+    def get_created_date(self, index, count):
+        return self.start_date + datetime.timedelta(seconds=PERIOD_DAYS * 86400.0 * index / max(1, count))
+
+    def get_first_task_index(self, created_since):
+        """
+        Returns an index at or before the first task created since the given date;
+        the tasks' created dates grow with their index.
+        """
+        if created_since is None:
+            return 0
+        since = datetime.datetime.strptime(created_since[:19], "%Y-%m-%dT%H:%M:%S")
+        offset = (since - self.start_date).total_seconds() / (PERIOD_DAYS * 86400.0)
+        return min(self.tasks, max(0, int(offset * self.tasks) - 1))
+
+    def contact_id(self, index):
+        return 'IEFAKEC%07d' % index
+
+    def customfield_id(self, index):
+        return 'IEFAKECF%05d' % index
+
+    def country_id(self, index):
+        return 'IEFAKECOUNTRY%04d' % index
+
+    def region_id(self, index):
+        return 'IEFAKEREGION%03d' % index
+
+    def folder_id(self, index):
+        return 'IEFAKEF%08d' % index
+
+    def project_id(self, index):
+        return 'IEFAKEP%08d' % index
+
+    def task_id(self, index):
+        return 'IEFAKET%08d' % index
+
+    def get_customfields(self):
+        return [{
+            "id": self.customfield_id(i),
+            "accountId": ACCOUNT_ID,
+            "title": "Custom Field %d" % i,
+            "type": "Text",
+        } for i in range(self.customfields)]
+
+    def get_contacts(self):
+        return [{
+            "id": self.contact_id(i),
+            "firstName": "First%d" % i,
+            "lastName": "Last%d" % i,
+            "type": "Person",
+            "deleted": False,
+        } for i in range(self.contacts)]
+
+    def get_customfield_values(self, rnd):
+        values = []
+        for i in rnd.sample(range(self.customfields), min(self.customfields, rnd.randint(0, 3))):
+            values.append({"id": self.customfield_id(i), "value": "Value %d" % rnd.randint(0, 20)})
+        return values
+
+    def get_folders(self):
+        """
+        Returns all of the folders, but not the projects.
+        """
+        folders = [{"id": ROOT_FOLDER_ID, "title": "PALM Support", "scope": "WsFolder"}]
+        for name, folder_id in sorted(self.structure_folder_ids.items()):
+            title = name[len('WRIKE_PALM_'):-len('_FOLDER_ID')].replace('_', ' ').title()
+            folders.append({"id": folder_id, "title": title, "scope": "WsFolder",
+                            "parentIds": [ROOT_FOLDER_ID]})
+
+        countries_id = self.structure_folder_ids['WRIKE_PALM_COUNTRIES_FOLDER_ID']
+        for i in range(self.countries):
+            folders.append({"id": self.country_id(i), "title": "Country %03d" % i, "scope": "WsFolder",
+                            "parentIds": [countries_id]})
+        regions_id = self.structure_folder_ids['WRIKE_PALM_RPD_PORTFOLIOS_FOLDER_ID']
+        for i in range(self.regions):
+            folders.append({"id": self.region_id(i), "title": "Region %02d" % i, "scope": "WsFolder",
+                            "parentIds": [regions_id]})
+
+        # The generic folders form chains of `depth` nested folders.
+        for i in range(self.folders):
+            parent_id = ROOT_FOLDER_ID if i % self.depth == 0 else self.folder_id(i - 1)
+            folders.append({"id": self.folder_id(i), "title": "Folder %d" % i, "scope": "WsFolder",
+                            "parentIds": [parent_id],
+                            "customFields": self.get_customfield_values(self.get_random('folder', i))})
+
+        for folder in folders:
+            folder["permalink"] = "https://www.wrike.com/open.htm?id=%s" % folder["id"]
+        return folders
+
+    def get_project(self, index):
+        rnd = self.get_random('project', index)
+        created = self.get_created_date(index, self.projects)
+        status = rnd.choice(PROJECT_STATUSES)
+        category_id = self.structure_folder_ids[CATEGORY_FOLDER_SETTINGS[index % len(CATEGORY_FOLDER_SETTINGS)]]
+        parent_ids = [category_id]
+        if self.countries:
+            parent_ids.append(self.country_id(rnd.randrange(self.countries)))
+        if self.regions:
+            parent_ids.append(self.region_id(rnd.randrange(self.regions)))
+        project = {
+            "status": status,
+            "createdDate": format_date(created),
+            "startDate": created.strftime("%Y-%m-%d"),
+            "endDate": (created + datetime.timedelta(days=rnd.randint(7, 90))).strftime("%Y-%m-%d"),
+            "ownerIds": [self.contact_id(i) for i in rnd.sample(range(self.contacts), min(self.contacts, rnd.randint(1, 2)))],
+        }
+        if status == 'Completed':
+            project["completedDate"] = format_date(created + datetime.timedelta(days=rnd.randint(1, 120)))
+        return {
+            "id": self.project_id(index),
+            "title": "Project %d" % index,
+            "scope": "WsFolder",
+            "permalink": "https://www.wrike.com/open.htm?id=%s" % self.project_id(index),
+            "parentIds": parent_ids,
+            "customFields": self.get_customfield_values(rnd),
+            "project": project,
+        }
+
+    def get_projects(self):
+        return [self.get_project(i) for i in range(self.projects)]
+
+    def get_task(self, index):
+        rnd = self.get_random('task', index)
+        created = self.get_created_date(index, self.tasks)
+        updated = created + datetime.timedelta(days=rnd.randint(0, 60), seconds=rnd.randint(0, 86399))
+        # Nothing is updated after today.
+        updated = min(updated, self.start_date + datetime.timedelta(days=PERIOD_DAYS))
+        status = rnd.choice(TASK_STATUSES)
+        if index % 2 == 0 or not self.folders:
+            parent_ids = [self.structure_folder_ids['WRIKE_PALM_GENERAL_TECH_SUPPORT_FOLDER_ID']]
+            if self.countries:
+                parent_ids.append(self.country_id(rnd.randrange(self.countries)))
+        else:
+            parent_ids = [self.folder_id(rnd.randrange(self.folders))]
+        task = {
+            "id": self.task_id(index),
+            "accountId": ACCOUNT_ID,
+            "title": "Task %d" % index,
+            "briefDescription": "Synthetic task number %d" % index,
+            "parentIds": parent_ids,
+            "responsibleIds": [self.contact_id(i) for i in rnd.sample(range(self.contacts), min(self.contacts, rnd.randint(0, 2)))],
+            "status": status,
+            "importance": rnd.choice(IMPORTANCES),
+            "createdDate": format_date(created),
+            "updatedDate": format_date(updated),
+            "scope": "WsTask",
+            "permalink": "https://www.wrike.com/open.htm?id=%s" % self.task_id(index),
+            "customFields": self.get_customfield_values(rnd),
+        }
+        if status == 'Completed':
+            task["completedDate"] = task["updatedDate"]
+        return task
+
+    def get_task_by_id(self, task_id):
+        """
+        Returns the task with the given id, or None if there is no such task.
+        """
+        prefix = self.task_id(0)[:-8]
+        if not task_id.startswith(prefix) or not task_id[len(prefix):].isdigit():
+            return None
+        index = int(task_id[len(prefix):])
+        return self.get_task(index) if index < self.tasks else None
+
+    def get_folder_by_id(self, folder_id):
+        """
+        Returns the folder or project with the given id, or None if there is no such folder.
+        """
+        for folder in self.get_folders() + self.get_projects():
+            if folder["id"] == folder_id:
+                return folder
+        return None
+
+    def get_tasks_page(self, start=0, page_size=1000, created_range=(None, None), updated_range=(None, None)):
+        """
+        Returns the (tasks, next start index) of a page of tasks matching the date
+        ranges; the next start index is None after the last page.
+        """
+        tasks = []
+        index = max(start, self.get_first_task_index(created_range[0]))
+        while index < self.tasks and len(tasks) < page_size:
+            task = self.get_task(index)
+            index += 1
+            if created_range[1] is not None and task["createdDate"] > created_range[1]:
+                # None of the remaining tasks are in the range.
+                return (tasks, None)
+            if in_range(task["createdDate"], created_range) and in_range(task["updatedDate"], updated_range):
+                tasks.append(task)
+        return (tasks, index if index < self.tasks else None)
+
+
+def add_account_arguments(parser):
+    """
+    Adds the options that describe a SyntheticAccount to a management command.
+    """
+    parser.add_argument("--size", choices=sorted(ACCOUNT_SIZES), default='small',
+                        help="Number of tasks: %s" % ", ".join(
+                            "%s=%s" % item for item in sorted(ACCOUNT_SIZES.items(), key=lambda item: item[1])))
+    parser.add_argument("--tasks", type=int, help="Number of tasks; overrides --size")
+    parser.add_argument("--folders", type=int, help="Number of generic folders (default: tasks / 100)")
+    parser.add_argument("--projects", type=int, help="Number of projects (default: tasks / 20)")
+    parser.add_argument("--depth", type=int, default=4, help="Nesting depth of the generic folders")
+    parser.add_argument("--contacts", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Seconds the fake server waits before answering each api call")
+
+
+def get_account(options):
+    return SyntheticAccount(
+        tasks=options['tasks'] if options['tasks'] is not None else ACCOUNT_SIZES[options['size']],
+        folders=options['folders'], projects=options['projects'], depth=options['depth'],
+        contacts=options['contacts'], seed=options['seed'])
+
+
+def in_range(value, date_range):
+    # Wrike's dates are zero padded ISO strings, so they compare as strings.
+    start, end = date_range
+    return (start is None or value >= start) and (end is None or value <= end)
+
+
+class FakeWrikeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the api endpoints that the settings' WRIKE_*_URLs point at.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict((key, values[0]) for key, values in urlparse.parse_qs(url.query).iteritems())
+        account = self.server.account
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        parts = url.path.split('/')
+        if len(parts) > 1 and parts[-2] in ('tasks', 'folders'):
+            return self.get_by_ids(account, parts[-2], parts[-1].split(','), params)
+        if url.path.endswith('/customfields') or url.path.endswith('/accounts'):
+            data = [{"id": ACCOUNT_ID, "customFields": account.get_customfields()}]
+        elif url.path.endswith('/contacts'):
+            data = account.get_contacts()
+        elif url.path.endswith('/folders'):
+            data = self.get_folders(account, params)
+        elif url.path.endswith('/tasks'):
+            return self.get_tasks(account, params)
+        else:
+            return self.send_json({"error": "resource_not_found"}, status=404)
+        self.send_json({"kind": url.path.rsplit('/', 1)[-1], "data": data})
+
+    def do_POST(self):
+        # Any refresh token is exchanged for a new access token.
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_json({
+            "access_token": "fake-access-token-%d" % int(time.time()),
+            "refresh_token": "fake-refresh-token",
+            "token_type": "bearer",
+            "expires_in": 3600,
+        })
+
+    def get_folders(self, account, params):
+        project = params.get('project', None)
+        if project == 'true':
+            return account.get_projects()
+        if project == 'false':
+            return account.get_folders()
+        # Like Wrike, the account-wide listing has neither parentIds nor customFields.
+        rows = []
+        for row in account.get_folders() + account.get_projects():
+            rows.append(dict((key, value) for key, value in row.iteritems()
+                             if key not in ('parentIds', 'customFields')))
+        return rows
+
+    def get_tasks(self, account, params):
+        try:
+            start = int(params.get('nextPageToken', 0))
+            page_size = min(int(params.get('pageSize', 1000)), 1000)
+            created_range = parse_date_range(params.get('createdDate', None))
+            updated_range = parse_date_range(params.get('updatedDate', None))
+            fields = json.loads(params.get('fields', '[]'))
+        except ValueError:
+            return self.send_json({"error": "invalid_parameter"}, status=400)
+
+        status = self.server.failing_task_pages.get(start, None)
+        if status is not None:
+            return self.send_json({"error": "server_error", "errorDescription": "Injected failure"}, status=status)
+
+        tasks, next_start = account.get_tasks_page(start, page_size, created_range, updated_range)
+        omitted = [field for field in OPTIONAL_TASK_FIELDS if field not in fields]
+        for task in tasks:
+            for field in omitted:
+                task.pop(field, None)
+        body = {"kind": "tasks", "data": tasks}
+        if next_start is not None:
+            body["nextPageToken"] = str(next_start)
+        self.send_json(body)
+
+    def get_by_ids(self, account, kind, ids, params):
+        get_row = account.get_task_by_id if kind == 'tasks' else account.get_folder_by_id
+        rows = [get_row(row_id) for row_id in ids]
+        if None in rows:
+            # Like Wrike, one unknown id fails the whole request.
+            return self.send_json({"error": "resource_not_found", "errorDescription": "Resource not found"},
+                                  status=404)
+        if kind == 'tasks':
+            try:
+                fields = json.loads(params.get('fields', '[]'))
+            except ValueError:
+                return self.send_json({"error": "invalid_parameter"}, status=400)
+            omitted = [field for field in OPTIONAL_TASK_FIELDS if field not in fields]
+            for row in rows:
+                for field in omitted:
+                    row.pop(field, None)
+        self.send_json({"kind": kind, "data": rows})
+
+    def send_json(self, body, status=200):
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s" % (self.address_string(), format % args))
+
+
+class FakeWrikeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A threaded http server for a SyntheticAccount. Pass port 0 to listen on a
+    free port; `get_settings()` returns the WRIKE_* settings that point at it.
+    `latency` adds that many seconds to every api call. The task pages that
+    start at the indexes in `failing_task_pages` are answered with the mapped
+    http status instead, e.g. {1000: 503}.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, account, host='127.0.0.1', port=0, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeWrikeRequestHandler)
+        self.account = account
+        self.latency = latency
+        self.failing_task_pages = {}
+
+    @property
+    def base_url(self):
+        return "http://%s:%s" % self.server_address[:2]
+
+    def get_settings(self):
+        api_url = "%s/api/v3" % self.base_url
+        return {
+            "WRIKE_ACCESS_TOKEN_URL": "%s/oauth2/token" % self.base_url,
+            "WRIKE_CUSTOMFIELDS_API_URL": '%s/accounts?fields=["customFields"]' % api_url,
+            "WRIKE_CONTACT_API_URL": "%s/contacts" % api_url,
+            "WRIKE_FOLDER_AND_PROJECTS_API_URL": "%s/folders" % api_url,
+            "WRIKE_PROJECT_API_URL": '%s/folders?project=true&fields=["customFields"]' % api_url,
+            "WRIKE_FOLDER_API_URL": '%s/folders?project=false&fields=["customFields"]' % api_url,
+            "WRIKE_TASK_API_URL": '%s/tasks?fields=["customFields","parentIds","responsibleIds"]&pageSize=1000' % api_url,
+        }
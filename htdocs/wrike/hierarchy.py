@@ -0,0 +1,134 @@
+"""
+Maintains the FolderClosure table, the ancestors of every folder at any depth.
+"""
+import collections
+import datetime
+import logging
+import time
+
+from django.conf import settings
+from django.utils.timezone import utc
+
+from .bulk import chunked, get_changed_ids, write_transaction
+from .models import Folder, FolderClosure, SyncCheckpoint
+from . import telemetry
+
+logger = logging.getLogger(__name__)
+
+# The SyncCheckpoint whose watermark is when the closure was last brought up to date.
+CLOSURE_ENTITY = "folder_closure"
+
+
+def get_subtree_ids(folder_ids):
+    """
+    Returns the given folders and the folders anywhere under them, both those
+    under them in the FolderClosure table and those under them by their current
+    parents, e.g. the ones that have just been moved there.
+    """
+    subtree_ids = set(folder_ids)
+    for chunk in chunked(folder_ids):
+        subtree_ids.update(FolderClosure.objects.filter(ancestor__in=chunk)
+                           .values_list('descendant_id', flat=True))
+    pending = set(folder_ids)
+    while pending:
+        children = set()
+        for chunk in chunked(pending):
+            children.update(Folder.parents.through.objects.filter(to_folder__in=chunk)
+                            .values_list('from_folder_id', flat=True))
+        pending = children - subtree_ids
+        subtree_ids.update(pending)
+    return subtree_ids
+
+
+def get_folder_closure(folder_ids):
+    """
+    Returns {(ancestor id, descendant id): depth} for the given folders, from
+    their parents in the mirror, leaving out the folders that have been deleted
+    in Wrike. The depth is that of the shortest path, as a folder can have
+    several parents. Only the given folders and their ancestors are loaded.
+    """
+    parents = {}
+    pending = set(folder_ids)
+    while pending:
+        for folder_id in pending:
+            parents[folder_id] = []
+        for chunk in chunked(pending):
+            for child_id, parent_id in Folder.parents.through.objects.filter(from_folder__in=chunk)\
+                    .values_list('from_folder_id', 'to_folder_id'):
+                parents[child_id].append(parent_id)
+        pending = set(parent_id for folder_id in pending for parent_id in parents[folder_id]) - set(parents)
+
+    live_ids = set()
+    for chunk in chunked(parents):
+        live_ids.update(Folder.objects.filter(pk__in=chunk, tombstoned=False).values_list('id', flat=True))
+
+    closure = {}
+    for folder_id in folder_ids:
+        if folder_id not in live_ids:
+            continue
+        # Breadth first, so that each ancestor is first reached by a shortest path.
+        depths = {folder_id: 0}
+        queue = collections.deque([folder_id])
+        while queue:
+            current = queue.popleft()
+            for parent_id in parents[current]:
+                if parent_id in live_ids and parent_id not in depths:
+                    depths[parent_id] = depths[current] + 1
+                    queue.append(parent_id)
+        for ancestor_id, depth in depths.iteritems():
+            closure[(ancestor_id, folder_id)] = depth
+    return closure
+
+
+def update_folder_closure():
+    """
+    Brings the FolderClosure table in line with the folders' parents. Only the
+    ancestors of the folders that the sync has inserted, updated or tombstoned
+    since the last update, and of the folders under them, are recomputed, and
+    only WRIKE_FOLDER_BATCH_SIZE folders at a time; only the pairs that have
+    been added, removed or moved are written. If there is no closure yet, that
+    of every folder is computed.
+    """
+    start_time = time.time()
+    started = datetime.datetime.utcnow().replace(tzinfo=utc)
+    checkpoint = SyncCheckpoint.objects.get_or_none(pk=CLOSURE_ENTITY)
+    since = checkpoint.watermark if checkpoint else None
+    if since is None or not FolderClosure.objects.exists():
+        folder_ids = set(Folder.objects.values_list('id', flat=True).iterator())
+    else:
+        folder_ids = get_subtree_ids(get_changed_ids(Folder, since))
+
+    inserted = 0
+    moved = 0
+    deleted = 0
+    try:
+        with write_transaction(FolderClosure):
+            for batch in chunked(sorted(folder_ids), settings.WRIKE_FOLDER_BATCH_SIZE):
+                closure = get_folder_closure(batch)
+                stored = {}
+                for chunk in chunked(batch):
+                    for pk, ancestor_id, descendant_id, depth in FolderClosure.objects.filter(descendant__in=chunk)\
+                            .values_list('pk', 'ancestor_id', 'descendant_id', 'depth'):
+                        stored[(ancestor_id, descendant_id)] = (pk, depth)
+
+                stale = [pk for pair, (pk, depth) in stored.iteritems() if pair not in closure]
+                for chunk in chunked(stale):
+                    FolderClosure.objects.filter(pk__in=chunk).delete()
+                for pair, (pk, depth) in stored.iteritems():
+                    if pair in closure and closure[pair] != depth:
+                        FolderClosure.objects.filter(pk=pk).update(depth=closure[pair])
+                        moved += 1
+                FolderClosure.objects.bulk_create(
+                    FolderClosure(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=depth)
+                    for (ancestor_id, descendant_id), depth in closure.iteritems()
+                    if (ancestor_id, descendant_id) not in stored)
+                inserted += len(closure) - len(stored) + len(stale)
+                deleted += len(stale)
+            SyncCheckpoint.objects.update_or_create(entity=CLOSURE_ENTITY, defaults={'watermark': started})
+    except Exception as e:
+        logger.error(e)
+        return False
+    telemetry.record(db_seconds=time.time() - start_time)
+    logger.info("Wrike folder closure: %s folders looked at; %s pairs inserted, %s moved, %s deleted in %.2fs" % (
+        len(folder_ids), inserted, moved, deleted, time.time() - start_time))
+    return True
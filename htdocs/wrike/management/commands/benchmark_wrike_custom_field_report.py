@@ -0,0 +1,100 @@
+import datetime
+import random
+import time
+
+import pytz
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from wrike.bulk import chunked
+from wrike.facts import GEN_TECH, SUPPORT_CATEGORIES
+from wrike.models import CustomField, CustomFieldFolder, CustomFieldTask, Folder, SupportFact, Task
+from wrike.views_helpers import get_support_data_by_custom_field
+
+# Rows are inserted this many at a time.
+BATCH_SIZE = 5000
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    """
+    Usage: python manage.py benchmark_wrike_custom_field_report [--tasks 100000] [--projects 20000] [--fields 10]
+
+    The synthetic rows are written in a transaction that is rolled back at the
+    end, so nothing is left behind; on SQLite the db is locked for writing
+    meanwhile, so don't run it against a db that is being synced.
+    """
+    help = 'Measures the support by custom field report over a synthetic dataset of custom field values'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tasks", type=int, default=100000, help="Number of general tech support tasks")
+        parser.add_argument("--projects", type=int, default=20000, help="Number of projects")
+        parser.add_argument("--fields", type=int, default=10, help="Number of custom fields, each set on every row")
+        parser.add_argument("--values", type=int, default=50, help="Number of distinct values of each field")
+        parser.add_argument("--repeat", type=int, default=3, help="The best of this many runs is reported")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                start_time = time.time()
+                customfield_ids = self.create_dataset(options)
+                self.stdout.write("Created %d custom field values in %.1fs" % (
+                    (options['tasks'] + options['projects']) * options['fields'], time.time() - start_time))
+
+                self.measure_reports(customfield_ids[0], "with the value indexes", options['repeat'])
+                if connection.features.can_rollback_ddl:
+                    with connection.cursor() as cursor:
+                        for model, owner in ((CustomFieldTask, 'task_id'), (CustomFieldFolder, 'folder_id')):
+                            for name in self.get_index_names(cursor, model, ['customfield_id', 'value', owner]):
+                                cursor.execute('DROP INDEX "%s"' % name)
+                    self.measure_reports(customfield_ids[0], "without them", options['repeat'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def create_dataset(self, options):
+        rnd = random.Random(0)
+        start = datetime.datetime(2015, 1, 1, tzinfo=pytz.UTC)
+        categories = [category for category, setting_names in SUPPORT_CATEGORIES]
+        customfield_ids = ['IEBENCHCF%04d' % i for i in range(options['fields'])]
+        CustomField.objects.bulk_create(CustomField(id=pk, title=pk, type="Text") for pk in customfield_ids)
+
+        def completed():
+            return start + datetime.timedelta(minutes=rnd.randrange(3 * 365 * 24 * 60))
+
+        for model, prefix, count in ((Task, 'IEBENCHT', options['tasks']), (Folder, 'IEBENCHP', options['projects'])):
+            ids = ['%s%08d' % (prefix, i) for i in range(count)]
+            for batch in chunked(ids, BATCH_SIZE):
+                model.objects.bulk_create(model(id=pk, title=pk) for pk in batch)
+                SupportFact.objects.bulk_create(
+                    SupportFact(category=GEN_TECH if model is Task else rnd.choice(categories), wrike_id=pk,
+                                completedDate=completed()) for pk in batch)
+
+            value_model, owner = (CustomFieldTask, 'task_id') if model is Task else (CustomFieldFolder, 'folder_id')
+            rows = (value_model(customfield_id=customfield_id, value="Value %d" % rnd.randrange(options['values']),
+                                **{owner: pk})
+                    for pk in ids for customfield_id in customfield_ids)
+            for batch in chunked(rows, BATCH_SIZE):
+                value_model.objects.bulk_create(batch)
+        return customfield_ids
+
+    def get_index_names(self, cursor, model, columns):
+        constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+        return [name for name, constraint in constraints.items()
+                if constraint['index'] and not constraint['unique'] and constraint['columns'] == columns]
+
+    def measure_reports(self, customfield_id, label, repeat):
+        for name, criteria in (("All dates", {}),
+                               ("One year", {'start': datetime.datetime(2016, 1, 1, tzinfo=pytz.UTC),
+                                             'end': datetime.datetime(2017, 1, 1, tzinfo=pytz.UTC)})):
+            best = None
+            for i in range(max(1, repeat)):
+                start_time = time.time()
+                labels, series = get_support_data_by_custom_field(customfield_id, criteria)
+                elapsed = time.time() - start_time
+                best = elapsed if best is None else min(best, elapsed)
+            self.stdout.write("%-9s %-24s %4d values  %8.3fs" % (name, label, len(labels), best))
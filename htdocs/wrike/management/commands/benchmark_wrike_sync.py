@@ -0,0 +1,108 @@
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.test.utils import override_settings
+
+from wrike import utils
+from wrike.fake_api import FakeWrikeServer, add_account_arguments, get_account
+from wrike.models import WrikeOauth2Credentials, Folder, Task, SyncRun
+
+
+class Command(BaseCommand):
+    """
+    Usage: python manage.py benchmark_wrike_sync [--size small|medium|large] [--runs 2]
+    """
+    help = 'Runs the Wrike sync against a local synthetic account and reports its throughput and peak memory'
+
+    def add_arguments(self, parser):
+        add_account_arguments(parser)
+        parser.add_argument("--runs", type=int, default=2,
+                            help="Number of syncs; the first one starts from an empty db")
+        parser.add_argument("--port", type=int, default=0, help="Port of the fake server (default: any free port)")
+        parser.add_argument("--rate-limit", type=int, default=100000,
+                            help="Requests allowed per WRIKE_API_RATE_PERIOD; use 400 to include Wrike's rate limit")
+        parser.add_argument("--partitions", type=int, help="Overrides WRIKE_TASK_PARTITIONS")
+        parser.add_argument("--workers", type=int, help="Overrides WRIKE_TASK_FETCH_WORKERS")
+        parser.add_argument("--keep-db", action="store_true", default=False,
+                            help="Keep the benchmark's db instead of deleting it afterwards")
+
+    def handle(self, *args, **options):
+        connection = connections[DEFAULT_DB_ALIAS]
+        if connection.vendor != 'sqlite':
+            raise CommandError("The benchmark only supports a SQLite default db")
+
+        account = get_account(options)
+        server = FakeWrikeServer(account, port=options['port'], latency=options['latency'])
+        # Serve from another process so that the server doesn't count towards the sync's memory and cpu.
+        for conn in connections.all():
+            conn.close()
+        server_process = multiprocessing.Process(target=server.serve_forever, name="fake-wrike")
+        server_process.daemon = True
+        server_process.start()
+        server.socket.close()
+
+        # The sync runs against a throwaway db, never against the real one.
+        db_dir = tempfile.mkdtemp(prefix="wrike-benchmark-")
+        connection.settings_dict['NAME'] = os.path.join(db_dir, "db.sqlite3")
+        try:
+            call_command('migrate', interactive=False, verbosity=0)
+            user, created = User.objects.get_or_create(username=settings.WRIKE_API_USER_ACCOUNT)
+            WrikeOauth2Credentials.objects.create(
+                user=user, access_token="fake-access-token", token_type="bearer", refresh_token="fake-refresh-token")
+
+            self.stdout.write("Syncing %s tasks, %s folders and %s projects from %s" % (
+                account.tasks, account.folders, account.projects, server.base_url))
+            overrides = server.get_settings()
+            overrides.update(
+                WRIKE_API_RATE_LIMIT=options['rate_limit'],
+                WRIKE_ARCHIVE_DIR=os.path.join(db_dir, "archive"),
+                WRIKE_TASK_PARTITION_START=account.start_date.strftime("%Y-%m-%d"),
+                WRIKE_TASK_PARTITIONS=options['partitions'] or settings.WRIKE_TASK_PARTITIONS,
+                WRIKE_TASK_FETCH_WORKERS=options['workers'] or settings.WRIKE_TASK_FETCH_WORKERS)
+            with override_settings(**overrides):
+                for i in range(options['runs']):
+                    self.run_sync(i + 1, full=(i == 0))
+        finally:
+            server_process.terminate()
+            server_process.join()
+            for conn in connections.all():
+                conn.close()
+            if options['keep_db']:
+                self.stdout.write("The benchmark db is in %s" % db_dir)
+            else:
+                shutil.rmtree(db_dir, ignore_errors=True)
+
+    def run_sync(self, number, full):
+        start_time = time.time()
+        cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+        success = utils.process_wrike_data(full=full)
+        elapsed = time.time() - start_time
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+
+        run = SyncRun.objects.first()
+        stages = list(run.stages.all())
+        synced = sum(stage.rows_inserted + stage.rows_updated + stage.rows_unchanged for stage in stages
+                     if stage.name == "Tasks")
+        received = sum(stage.bytes for stage in stages)
+        self.stdout.write("Run %d (%s): %s in %.2fs; %d tasks synced (%.0f tasks/s), %d tasks and %d folders "
+                          "in the db, %.1f MB downloaded, %.2fs cpu, peak memory %.1f MB" % (
+            number, "full" if full else "incremental", "succeeded" if success else "FAILED", elapsed,
+            synced, synced / elapsed if elapsed else 0, Task.objects.count(), Folder.objects.count(),
+            received / 1048576.0,
+            (usage.ru_utime - cpu_start.ru_utime) + (usage.ru_stime - cpu_start.ru_stime),
+            # ru_maxrss is in kilobytes on Linux.
+            usage.ru_maxrss / 1024.0))
+        for stage in stages:
+            self.stdout.write("  %-14s %7.2fs  %5d requests %4d retries %5d pages  http %6.2fs  db %6.2fs  "
+                              "%d inserted, %d updated, %d unchanged, %d failed" % (
+                stage.name, stage.duration, stage.requests, stage.retries, stage.pages, stage.http_seconds,
+                stage.db_seconds, stage.rows_inserted, stage.rows_updated, stage.rows_unchanged, stage.rows_failed))
@@ -0,0 +1,118 @@
+import datetime
+import time
+
+import pytz
+
+from django.core.management.base import BaseCommand
+
+from django.utils.encoding import smart_text
+
+from wrike.fake_api import SyntheticAccount
+from wrike.models import Folder, Task
+from wrike.transformers import get_transformer, parse_datetime
+
+
+def get_field_names(model):
+    # What the sync used to look up for every page.
+    return [field.name for field in model._meta.get_fields()]
+
+
+def parse_datetime_with_strptime(value):
+    timestamp = datetime.datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+    return timestamp.replace(tzinfo=pytz.UTC)
+
+
+def transform_tasks_per_key(rows):
+    """
+    The per-key loop that process_wrike_tasks_helper used before the transformers.
+    """
+    db_col_names = get_field_names(Task)
+    db_rows = []
+    for row in rows:
+        db_row = {}
+        for col, val in row.iteritems():
+            if col in ("customFields", "parentIds", "responsibleIds"):
+                pass
+            elif col == "createdDate" or col == "updatedDate" or col == "completedDate":
+                db_row[col] = parse_datetime_with_strptime(val)
+            elif col == "briefDescription" or col == "title":
+                db_row[col] = smart_text("%s..." % val[:250])
+            else:
+                if col in db_col_names and col != "id": db_row[col] = smart_text(val)
+        db_rows.append(db_row)
+    return db_rows
+
+
+def transform_folders_per_key(rows):
+    """
+    The per-key loop that process_wrike_folder_and_projects_helper used before the transformers.
+    """
+    db_col_names = get_field_names(Folder)
+    db_rows = []
+    for row in rows:
+        db_row = {}
+        for col, val in row.iteritems():
+            if col == "project":
+                db_row["status"] = smart_text(val['status'])
+                db_row["createdDate"] = parse_datetime_with_strptime(val['createdDate'])
+                if val.get("startDate", None): db_row["startDate"] = val["startDate"]
+                if val.get("endDate", None): db_row["endDate"] = val["endDate"]
+                if val.get("completedDate", None):
+                    db_row["completedDate"] = parse_datetime_with_strptime(val['completedDate'])
+            if col in db_col_names and col != "id": db_row[col] = smart_text(val)
+        db_rows.append(db_row)
+    return db_rows
+
+
+def transform_tasks(rows):
+    transformer = get_transformer(Task)
+    return [transformer.transform(row) for row in rows]
+
+
+def transform_folders(rows):
+    transformer = get_transformer(Folder)
+    db_rows = []
+    for row in rows:
+        db_row = transformer.transform(row)
+        if row.get("project", None):
+            db_row.update(transformer.transform(row["project"]))
+        db_rows.append(db_row)
+    return db_rows
+
+
+class Command(BaseCommand):
+    """
+    Usage: python manage.py benchmark_wrike_transformers [--rows 20000] [--repeat 3]
+    """
+    help = 'Measures how many synthetic Wrike task and folder rows per second are converted into column values'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=20000, help="Number of task and of project rows")
+        parser.add_argument("--repeat", type=int, default=3, help="The best of this many passes is reported")
+
+    def handle(self, *args, **options):
+        account = SyntheticAccount(tasks=options['rows'], projects=options['rows'])
+        tasks = [account.get_task(i) for i in range(options['rows'])]
+        folders = account.get_folders() + account.get_projects()
+        timestamps = [task["updatedDate"] for task in tasks]
+
+        for name, rows, before, after in (
+                ("Task", tasks, transform_tasks_per_key, transform_tasks),
+                ("Folder", folders, transform_folders_per_key, transform_folders),
+                ("Timestamp", timestamps,
+                 lambda values: [parse_datetime_with_strptime(value) for value in values],
+                 lambda values: [parse_datetime(value) for value in values])):
+            before_rate, before_rows = self.measure(before, rows, options['repeat'])
+            after_rate, after_rows = self.measure(after, rows, options['repeat'])
+            self.stdout.write("%-9s %8d rows  before %9.0f rows/s  after %9.0f rows/s  %.1fx%s" % (
+                name, len(rows), before_rate, after_rate, after_rate / before_rate if before_rate else 0,
+                "" if before_rows == after_rows else "  OUTPUTS DIFFER"))
+
+    def measure(self, func, rows, repeat):
+        best = None
+        for i in range(max(1, repeat)):
+            start_time = time.time()
+            result = func(rows)
+            elapsed = time.time() - start_time
+            best = elapsed if best is None else min(best, elapsed)
+        return (len(rows) / best if best else 0, result)
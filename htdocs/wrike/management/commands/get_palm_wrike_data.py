@@ -1,19 +1,52 @@
 from django.core.management.base import BaseCommand, CommandError
 
 from wrike import utils
+from wrike.daemon import SyncAlreadyRunning, SyncDaemon, sync_lock
+from wrike.staging import StagingNotSupported, staging_db
 
 class Command(BaseCommand):
     """
-    Usage: python manage.py get_palm_wrike_data
+    Usage: python manage.py get_palm_wrike_data [--full] [--blue-green] [--replay RUN [RUN ...]] [--daemon]
     """
     help = 'Fetches PALM Wrike data under "PALM Support" folder'
 
     def add_arguments(self, parser):
         #parser.add_argument("-u", "--username", type=str, required=True)
         #parser.add_argument('--read_ids', nargs='*', type=int)
-        pass
+        parser.add_argument("--full", action="store_true", default=False,
+                            help="Fetch all tasks instead of only those updated since the last sync")
+        parser.add_argument("--blue-green", action="store_true", default=False,
+                            help="Build into a staging db and swap it in once the sync has finished")
+        parser.add_argument("--replay", type=int, nargs="+", metavar="RUN",
+                            help="Rebuild the db from the archived pages of these sync runs instead of calling Wrike")
+        parser.add_argument("--daemon", action="store_true", default=False,
+                            help="Keep running and sync each entity type on its own schedule (WRIKE_SYNC_INTERVALS)")
 
     def handle(self, *args, **options):
-        if utils.process_wrike_data() == False:
-            #send out an email
-            pass
\ No newline at end of file
+        if options['daemon']:
+            if options['full'] or options['blue_green'] or options['replay']:
+                raise CommandError("--daemon can't be combined with --full, --blue-green or --replay")
+            try:
+                SyncDaemon().run()
+            except SyncAlreadyRunning as e:
+                raise CommandError(str(e))
+            return
+
+        if options['replay']:
+            sync = lambda: utils.replay_wrike_data(options['replay'])
+        else:
+            sync = lambda: utils.process_wrike_data(full=options['full'])
+
+        try:
+            with sync_lock():
+                if options['blue_green']:
+                    with staging_db() as build:
+                        # Keep serving the previous mirror rather than a partially synced one.
+                        build.publish = sync()
+                    return
+
+                if sync() == False:
+                    #send out an email
+                    pass
+        except (SyncAlreadyRunning, StagingNotSupported) as e:
+            raise CommandError(str(e))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from wrike.fake_api import FakeWrikeServer, add_account_arguments, get_account
+
+
+class Command(BaseCommand):
+    """
+    Usage: python manage.py run_fake_wrike_server [--size small|medium|large] [--port 8765]
+    """
+    help = 'Serves a synthetic Wrike account locally, for testing and benchmarking the sync'
+
+    def add_arguments(self, parser):
+        add_account_arguments(parser)
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+
+    def handle(self, *args, **options):
+        account = get_account(options)
+        server = FakeWrikeServer(account, options['host'], options['port'], latency=options['latency'])
+        self.stdout.write("Serving %s tasks, %s folders and %s projects on %s" % (
+            account.tasks, account.folders, account.projects, server.base_url))
+        self.stdout.write("Point the sync at it with these settings:")
+        for name, value in sorted(server.get_settings().items()):
+            self.stdout.write("%s = '%s'" % (name, value))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
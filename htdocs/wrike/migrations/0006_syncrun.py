@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 10:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrike', '0005_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('started', models.DateTimeField()),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('duration', models.FloatField(blank=True, help_text='seconds', null=True)),
+                ('full', models.BooleanField(default=False)),
+                ('success', models.NullBooleanField()),
+            ],
+            options={
+                'ordering': ('-started',),
+            },
+        ),
+        migrations.CreateModel(
+            name='SyncStageRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('name', models.CharField(max_length=50)),
+                ('started', models.DateTimeField()),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('duration', models.FloatField(blank=True, help_text='seconds', null=True)),
+                ('success', models.NullBooleanField()),
+                ('requests', models.IntegerField(default=0)),
+                ('retries', models.IntegerField(default=0)),
+                ('pages', models.IntegerField(default=0)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('inserted', models.IntegerField(default=0)),
+                ('updated', models.IntegerField(default=0)),
+                ('unchanged', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+                ('http_seconds', models.FloatField(default=0)),
+                ('db_seconds', models.FloatField(default=0)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stages', to='wrike.SyncRun')),
+            ],
+            options={
+                'ordering': ('started',),
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 10:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrike', '0006_syncrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folder',
+            name='tombstoned',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='tombstoned',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 10:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrike', '0008_synccheckpoint_last_run'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookUpdate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('entity', models.CharField(choices=[('task', 'Task'), ('folder', 'Folder')], max_length=10)),
+                ('wrike_id', models.CharField(max_length=100)),
+                ('received', models.DateTimeField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='webhookupdate',
+            unique_together=set([('entity', 'wrike_id')]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 11:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrike', '0011_supportrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FolderClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='wrike.Folder')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='wrike.Folder')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='folderclosure',
+            unique_together=set([('ancestor', 'descendant')]),
+        ),
+    ]
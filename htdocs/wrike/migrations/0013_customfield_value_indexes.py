@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 11:06
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrike', '0012_folderclosure'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='customfieldfolder',
+            index_together=set([('customfield', 'value', 'folder')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='customfieldtask',
+            index_together=set([('customfield', 'value', 'task')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='supportfact',
+            index_together=set([('category', 'wrike_id')]),
+        ),
+    ]
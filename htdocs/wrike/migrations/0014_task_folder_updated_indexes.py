@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 11:28
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrike', '0013_customfield_value_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='folder',
+            index_together=set([('updated',)]),
+        ),
+        migrations.AlterIndexTogether(
+            name='task',
+            index_together=set([('updated',)]),
+        ),
+    ]
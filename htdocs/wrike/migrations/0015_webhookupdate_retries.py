@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 11:54
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrike', '0014_task_folder_updated_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookupdate',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='webhookupdate',
+            name='retry_after',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
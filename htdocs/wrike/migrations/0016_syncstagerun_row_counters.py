@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 12:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wrike', '0015_webhookupdate_retries'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='syncstagerun',
+            old_name='inserted',
+            new_name='rows_inserted',
+        ),
+        migrations.RenameField(
+            model_name='syncstagerun',
+            old_name='updated',
+            new_name='rows_updated',
+        ),
+        migrations.RenameField(
+            model_name='syncstagerun',
+            old_name='unchanged',
+            new_name='rows_unchanged',
+        ),
+        migrations.RenameField(
+            model_name='syncstagerun',
+            old_name='failed',
+            new_name='rows_failed',
+        ),
+        migrations.AddField(
+            model_name='syncstagerun',
+            name='updated',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -46,6 +46,8 @@ class CustomField(BaseModel):
     title = models.CharField(max_length=254, null=True, blank=True)
     type = models.CharField(max_length=30, null=True, blank=True)
     deleted = models.BooleanField(default=False)
+    # Hash of the row as last received from Wrike; unchanged rows are not rewritten.
+    content_hash = models.CharField(max_length=40, null=True, blank=True)
 
 
     def __unicode__(self):
@@ -61,6 +63,7 @@ class Contact(BaseModel):
     lastName = models.CharField(max_length=100, null=True, blank=True)
     type = models.CharField(max_length=30, null=True, blank=True)
     deleted = models.BooleanField(default=False)
+    content_hash = models.CharField(max_length=40, null=True, blank=True)
 
     def __unicode__(self):
         return "%s %s" % (self.firstName, self.lastName)
@@ -88,6 +91,13 @@ class Folder(BaseModel):
         through = 'CustomFieldFolder',
         through_fields = ('folder', 'customfield')
     )
+    content_hash = models.CharField(max_length=40, null=True, blank=True)
+    # Set once the row is no longer listed by Wrike, i.e. it was deleted there.
+    tombstoned = models.BooleanField(default=False, db_index=True)
+
+    class Meta:
+        # Lets the sync find the rows that it has changed since a stage last ran, see bulk.get_changed_ids.
+        index_together = (("updated",),)
 
     def __unicode__(self):
         return self.title
@@ -101,6 +111,10 @@ class CustomFieldFolder(BaseModel):
     customfield = models.ForeignKey(CustomField, on_delete=models.CASCADE)
     value = models.CharField(max_length=254, null=True, blank=True)
 
+    class Meta:
+        # Lets the reports group a custom field's values, and find their folders, from the index alone.
+        index_together = (("customfield", "value", "folder"),)
+
     def __unicode__(self):
         return "%s=%s" % (self.customfield, self.value)
 
@@ -127,6 +141,13 @@ class Task(BaseModel):
         through = 'CustomFieldTask',
         through_fields = ('task', 'customfield')
     )
+    content_hash = models.CharField(max_length=40, null=True, blank=True)
+    # Set once the row is no longer listed by Wrike, i.e. it was deleted there.
+    tombstoned = models.BooleanField(default=False, db_index=True)
+
+    class Meta:
+        # Lets the sync find the rows that it has changed since a stage last ran, see bulk.get_changed_ids.
+        index_together = (("updated",),)
 
     def __unicode__(self):
         return self.title
@@ -140,6 +161,10 @@ class CustomFieldTask(BaseModel):
     customfield = models.ForeignKey(CustomField, on_delete=models.CASCADE)
     value = models.CharField(max_length=254, null=True, blank=True)
 
+    class Meta:
+        # Lets the reports group a custom field's values, and find their tasks, from the index alone.
+        index_together = (("customfield", "value", "task"),)
+
     def __unicode__(self):
         return "%s=%s" % (self.customfield, self.value)
 
@@ -162,3 +187,182 @@ class WrikeOauth2Credentials(BaseModel):
         return self.access_token
 
 
+class SyncCheckpoint(BaseModel):
+    """
+    The high-water mark of the last successful sync for each entity type,
+    e.g. the latest updatedDate seen across all tasks, or the hash of the
+    last stored custom fields response.
+    """
+    entity = models.CharField(max_length=30, primary_key=True)
+    watermark = models.DateTimeField(blank=True, null=True)
+    # Hash of the whole endpoint response, for the entities that are fetched in one go.
+    content_hash = models.CharField(max_length=40, null=True, blank=True)
+    # The last run of the entity's sync stage.
+    last_started = models.DateTimeField(blank=True, null=True)
+    last_finished = models.DateTimeField(blank=True, null=True)
+    last_success = models.NullBooleanField()
+
+    def __unicode__(self):
+        return "%s@%s" % (self.entity, self.watermark)
+
+    def __str__(self):
+        return "%s@%s" % (self.entity, self.watermark)
+
+
+class SyncRun(BaseModel):
+    """
+    One run of the wrike sync (get_palm_wrike_data); its stages are SyncStageRuns.
+    """
+    started = models.DateTimeField()
+    finished = models.DateTimeField(blank=True, null=True)
+    duration = models.FloatField(blank=True, null=True, help_text="seconds")
+    full = models.BooleanField(default=False)
+    success = models.NullBooleanField()
+
+    class Meta:
+        ordering = ('-started',)
+
+    def __unicode__(self):
+        return "Sync run %s" % self.started
+
+    def __str__(self):
+        return "Sync run %s" % self.started
+
+
+class SyncStageRun(BaseModel):
+    """
+    Timings and counters of one stage (custom fields, contacts, ...) of a SyncRun.
+    The row counters are prefixed with rows_ as `updated` is BaseModel's timestamp.
+    """
+    run = models.ForeignKey(SyncRun, on_delete=models.CASCADE, related_name="stages")
+    name = models.CharField(max_length=50)
+    started = models.DateTimeField()
+    finished = models.DateTimeField(blank=True, null=True)
+    duration = models.FloatField(blank=True, null=True, help_text="seconds")
+    success = models.NullBooleanField()
+    requests = models.IntegerField(default=0)
+    retries = models.IntegerField(default=0)
+    pages = models.IntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+    rows_inserted = models.IntegerField(default=0)
+    rows_updated = models.IntegerField(default=0)
+    rows_unchanged = models.IntegerField(default=0)
+    rows_failed = models.IntegerField(default=0)
+    http_seconds = models.FloatField(default=0)
+    db_seconds = models.FloatField(default=0)
+
+    class Meta:
+        ordering = ('started',)
+
+    def __unicode__(self):
+        return "%s: %s" % (self.run, self.name)
+
+    def __str__(self):
+        return "%s: %s" % (self.run, self.name)
+
+
+class WebhookUpdate(BaseModel):
+    """
+    A task or folder that a Wrike webhook notified us of a change to, queued
+    until the sync fetches its current state.
+    """
+    TASK = 'task'
+    FOLDER = 'folder'
+    ENTITY_CHOICES = (
+        (TASK, 'Task'),
+        (FOLDER, 'Folder'),
+    )
+    entity = models.CharField(max_length=10, choices=ENTITY_CHOICES)
+    wrike_id = models.CharField(max_length=100)
+    # The latest notification about the row; a row notified again while it is being fetched stays queued.
+    received = models.DateTimeField()
+    # Failed fetches since the latest notification; see webhooks.defer_updates.
+    attempts = models.PositiveIntegerField(default=0)
+    # After a failed fetch, the row isn't fetched again before this time.
+    retry_after = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        unique_together = ('entity', 'wrike_id')
+
+    def __unicode__(self):
+        return "%s %s" % (self.entity, self.wrike_id)
+
+    def __str__(self):
+        return "%s %s" % (self.entity, self.wrike_id)
+
+
+class SupportFact(models.Model):
+    """
+    A support instance, i.e. a general tech support task or a project in one of
+    the support categories, with one row for each of its assignees, countries and
+    regions. The sync keeps the table up to date with the mirror so that the
+    charts aggregate this one table instead of joining the folder tree.
+    """
+    category = models.CharField(max_length=30)
+    # The id of the task or project.
+    wrike_id = models.CharField(max_length=100)
+    assignee = models.ForeignKey(Contact, null=True, blank=True, on_delete=models.CASCADE, related_name="+")
+    country = models.ForeignKey(Folder, null=True, blank=True, on_delete=models.CASCADE, related_name="+")
+    region = models.ForeignKey(Folder, null=True, blank=True, on_delete=models.CASCADE, related_name="+")
+    completedDate = models.DateTimeField(blank=True, null=True, db_index=True)
+
+    class Meta:
+        index_together = (("category", "wrike_id"),)
+
+    def __unicode__(self):
+        return "%s %s" % (self.category, self.wrike_id)
+
+    def __str__(self):
+        return "%s %s" % (self.category, self.wrike_id)
+
+
+class SupportRollup(models.Model):
+    """
+    The number of support instances completed on a day in a category, for one
+    assignee, country or region; exactly one of the three is set. The buckets
+    are adjusted by the sync from the SupportFacts that changed, so that a date
+    range is counted by summing its days' buckets. Instances that haven't been
+    completed are counted in the buckets without a day.
+    """
+    day = models.DateField(blank=True, null=True, db_index=True)
+    category = models.CharField(max_length=30)
+    assignee = models.ForeignKey(Contact, null=True, blank=True, on_delete=models.CASCADE, related_name="+")
+    country = models.ForeignKey(Folder, null=True, blank=True, on_delete=models.CASCADE, related_name="+")
+    region = models.ForeignKey(Folder, null=True, blank=True, on_delete=models.CASCADE, related_name="+")
+    total = models.IntegerField(default=0)
+
+    def get_key(self):
+        """
+        Returns the (day, category, field, pk) that identifies the bucket.
+        """
+        for field in ("assignee", "country", "region"):
+            pk = getattr(self, "%s_id" % field)
+            if pk is not None:
+                return (self.day, self.category, field, pk)
+
+    def __unicode__(self):
+        return "%s %s %s" % (self.day, self.category, self.total)
+
+    def __str__(self):
+        return "%s %s %s" % (self.day, self.category, self.total)
+
+
+class FolderClosure(models.Model):
+    """
+    A folder and one of its ancestors, at any depth, with the length of the
+    shortest path between them; every folder is its own ancestor at depth 0.
+    It turns "anywhere under this folder" into one indexed join. Folders that
+    were deleted in Wrike are left out. Maintained by the sync, see hierarchy.py.
+    """
+    ancestor = models.ForeignKey(Folder, on_delete=models.CASCADE, related_name="descendant_links")
+    descendant = models.ForeignKey(Folder, on_delete=models.CASCADE, related_name="ancestor_links")
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = (("ancestor", "descendant"),)
+
+    def __unicode__(self):
+        return "%s > %s" % (self.ancestor_id, self.descendant_id)
+
+    def __str__(self):
+        return "%s > %s" % (self.ancestor_id, self.descendant_id)
@@ -0,0 +1,107 @@
+"""
+Caches the chart data of the views_helpers across the WSGI worker processes.
+
+The chart data only changes when a sync changes the mirror, so the results are
+cached in WRIKE_REPORT_CACHE, a file-based cache that all of the workers share,
+under a key that includes the current data version. A sync that inserts,
+updates or tombstones any rows bumps the version, which orphans every cached
+result at once; the orphans expire with the cache's TIMEOUT.
+
+When several workers miss the same key at the same time, only the first one
+computes the result: the others wait on a lock file for it and then read it
+from the cache.
+"""
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "wrike_report_data_version"
+
+# Keys are spread over this many lock files.
+LOCK_STRIPES = 64
+
+
+def get_cache():
+    if not settings.WRIKE_REPORT_CACHE:
+        return None
+    return caches[settings.WRIKE_REPORT_CACHE]
+
+
+def get_data_version(cache):
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # The version is random rather than a counter so that results cached under
+        # an earlier version can't match it if the version itself is culled.
+        cache.add(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_data_version():
+    """
+    Invalidates every cached result; called once a sync has committed changes.
+    """
+    cache = get_cache()
+    if cache is not None:
+        cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def get_report_key(report, args, criteria, version):
+    start = criteria.get('start', None)
+    end = criteria.get('end', None)
+    return "wrike_report:%s:%s:%s:%s:%s" % (report, ",".join(args), start.isoformat() if start else '',
+                                            end.isoformat() if end else '', version)
+
+
+def get_lock_path(key):
+    stripe = int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16) % LOCK_STRIPES
+    return os.path.join(settings.WRIKE_REPORT_LOCK_DIR, "%02d.lock" % stripe)
+
+
+def open_lock_file(path):
+    try:
+        return open(path, "a")
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return open(path, "a")
+
+
+def get_report(func, criteria, *args):
+    """
+    Returns func(*args, criteria), e.g. get_support_data_by_person(criteria),
+    from the cache if it has been computed since the data last changed. The
+    args are strings, e.g. the id of a custom field.
+    """
+    cache = get_cache()
+    if cache is None:
+        return func(*args + (criteria,))
+    key = get_report_key(func.__name__, args, criteria, get_data_version(cache))
+    result = cache.get(key)
+    if result is not None:
+        return result
+
+    lock_file = open_lock_file(get_lock_path(key))
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # Another worker may have computed it while this one waited for the lock.
+        result = cache.get(key)
+        if result is None:
+            result = func(*args + (criteria,))
+            cache.set(key, result)
+    finally:
+        lock_file.close()
+    return result
@@ -0,0 +1,48 @@
+STAGING_DB_ALIAS = 'wrike_staging'
+
+# Models that are never rebuilt by a sync and therefore always live in the default db.
+LIVE_ONLY_MODELS = ('wrikeoauth2credentials', 'syncrun', 'syncstagerun', 'webhookupdate')
+
+# The alias the mirror models are routed to while a staging db is being built.
+_active_alias = None
+
+
+def activate(alias):
+    global _active_alias
+    _active_alias = alias
+
+
+def deactivate():
+    global _active_alias
+    _active_alias = None
+
+
+def is_mirror_model(model):
+    """
+    Returns True for the wrike models whose rows are (re)built by the sync.
+    """
+    return model._meta.app_label == 'wrike' and model._meta.model_name not in LIVE_ONLY_MODELS
+
+
+class StagingRouter(object):
+    """
+    Sends reads and writes of the wrike mirror models to the staging db while a
+    blue/green sync is building it; otherwise lets django use the default db.
+    """
+    def db_for_read(self, model, **hints):
+        if _active_alias and is_mirror_model(model):
+            return _active_alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_read(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._meta.app_label == 'wrike' and obj2._meta.app_label == 'wrike':
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == STAGING_DB_ALIAS:
+            return False
+        return None
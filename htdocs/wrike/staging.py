@@ -0,0 +1,174 @@
+import os
+import sqlite3
+import logging
+import time
+
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+from . import report_cache, routers
+
+logger = logging.getLogger(__name__)
+
+# The StagingBuild that is in progress, if any.
+_active_build = None
+
+
+class StagingNotSupported(Exception):
+    pass
+
+
+def get_mirror_tables():
+    """
+    Returns the db tables of the wrike mirror models, including the m2m tables.
+    """
+    tables = []
+    for model in apps.get_app_config('wrike').get_models(include_auto_created=True):
+        if routers.is_mirror_model(model):
+            tables.append(model._meta.db_table)
+    return tables
+
+
+def get_staging_db_path():
+    live_path = connections[DEFAULT_DB_ALIAS].settings_dict['NAME']
+    return settings.WRIKE_STAGING_DB_PATH or "%s.staging" % live_path
+
+
+def create_staging_db(path, tables):
+    """
+    Creates a fresh SQLite file holding a copy of the live mirror tables along
+    with their indexes.
+    """
+    live = connections[DEFAULT_DB_ALIAS]
+    with live.cursor() as cursor:
+        cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE tbl_name IN (%s) AND sql IS NOT NULL "
+            "ORDER BY type DESC" % ", ".join(["%s"] * len(tables)), tables)
+        schema = [row[0] for row in cursor.fetchall()]
+
+    if os.path.exists(path):
+        # Left behind by a build that didn't finish.
+        os.remove(path)
+
+    db = sqlite3.connect(path, isolation_level=None)
+    try:
+        db.execute("PRAGMA journal_mode=MEMORY")
+        db.execute("PRAGMA synchronous=OFF")
+        db.execute("ATTACH DATABASE ? AS live", (live.settings_dict['NAME'],))
+        # A single read transaction gives a consistent snapshot of the live tables.
+        db.execute("BEGIN")
+        for sql in schema:
+            db.execute(sql)
+        for table in tables:
+            db.execute('INSERT INTO main."%s" SELECT * FROM live."%s"' % (table, table))
+        db.execute("COMMIT")
+        db.execute("DETACH DATABASE live")
+    finally:
+        db.close()
+
+
+def publish_staging_db(path, tables):
+    """
+    Replaces the live mirror tables with the ones in the staging db in one transaction.
+    """
+    live = connections[DEFAULT_DB_ALIAS]
+    with live.cursor() as cursor:
+        cursor.execute("ATTACH DATABASE %s AS staging", [path])
+        try:
+            with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                for table in tables:
+                    cursor.execute('DELETE FROM main."%s"' % table)
+                    cursor.execute('INSERT INTO main."%s" SELECT * FROM staging."%s"' % (table, table))
+        finally:
+            cursor.execute("DETACH DATABASE staging")
+
+
+def close_staging_connections():
+    if routers.STAGING_DB_ALIAS in connections.databases:
+        connections[routers.STAGING_DB_ALIAS].close()
+
+
+@contextmanager
+def staging_db():
+    """
+    Blue/green rebuild of the wrike mirror: routes the mirror models to a fresh
+    SQLite file, which starts out as a copy of the live mirror tables, for the
+    duration of the block. The charts keep reading the live db meanwhile and
+    never see a half-synced mirror. The staging db is published into the live db
+    only if the block returns without raising; it is removed either way.
+
+    Usage:
+        with staging_db() as build:
+            build.publish = process_wrike_data()
+
+    The staging db is attached to the live db to copy the tables across, so the
+    live db has to be SQLite too; StagingNotSupported is raised otherwise, before
+    anything has been synced.
+    """
+    vendor = connections[DEFAULT_DB_ALIAS].vendor
+    if vendor != 'sqlite':
+        raise StagingNotSupported("Blue/green syncs need an SQLite db, not %s; sync without --blue-green" % vendor)
+
+    start_time = time.time()
+    tables = get_mirror_tables()
+    path = get_staging_db_path()
+    create_staging_db(path, tables)
+    logger.info("Wrike staging db %s created in %.2fs" % (path, time.time() - start_time))
+
+    connections.databases[routers.STAGING_DB_ALIAS] = dict(
+        connections[DEFAULT_DB_ALIAS].settings_dict, NAME=path)
+    global _active_build
+    build = StagingBuild()
+    _active_build = build
+    routers.activate(routers.STAGING_DB_ALIAS)
+    try:
+        yield build
+        routers.deactivate()
+        _active_build = None
+        close_staging_connections()
+        if build.publish:
+            start_time = time.time()
+            publish_staging_db(path, tables)
+            # The charts' cached data was computed from the tables that have just been replaced.
+            report_cache.bump_data_version()
+            logger.info("Wrike staging db published in %.2fs" % (time.time() - start_time))
+            for func in build.on_publish:
+                func()
+        else:
+            logger.error("Wrike staging db was discarded without being published")
+    finally:
+        routers.deactivate()
+        _active_build = None
+        close_staging_connections()
+        del connections.databases[routers.STAGING_DB_ALIAS]
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class StagingBuild(object):
+    """
+    Set publish to False within a staging_db() block to discard the build.
+    """
+    publish = True
+
+    def __init__(self):
+        # Called once the build has been published, see after_publish().
+        self.on_publish = []
+
+
+def after_publish(func):
+    """
+    Calls func once the mirror that is being synced is live: straight away,
+    unless a blue/green build is in progress, in which case it is called once
+    that build has been published, and never if the build is discarded. E.g.
+    the webhook updates are only dequeued once the rows fetched for them are
+    live; the queue itself always lives in the live db.
+    """
+    build = _active_build
+    if build is None:
+        func()
+    else:
+        build.on_publish.append(func)
@@ -0,0 +1,129 @@
+"""
+Incremental decoding of large Wrike responses.
+
+Wrike returns listings as one json object, {"kind": ..., "data": [...]}. The
+items of the `data` array are decoded one at a time as the document is read,
+so that only the current item and the current chunk are held in memory.
+"""
+import json
+
+# Bytes read at a time from a stream or file.
+CHUNK_SIZE = 65536
+
+WHITESPACE = ' \t\n\r'
+
+# Characters that can go on a number, e.g. "12" of "12.5e3".
+NUMBER_CHARACTERS = '0123456789.eE+-'
+
+_decoder = json.JSONDecoder()
+
+
+class JsonStreamReader(object):
+    """
+    Decodes json values one at a time from an iterable of chunks of a document.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+        self.pos = 0
+
+    def read_more(self):
+        for chunk in self.chunks:
+            if chunk:
+                # Only the part that hasn't been decoded yet is kept.
+                self.buffer = self.buffer[self.pos:] + chunk
+                self.pos = 0
+                return True
+        return False
+
+    def peek(self):
+        """
+        Returns the next character that isn't whitespace without consuming it,
+        or None at the end of the document.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                return None
+
+    def expect(self, characters):
+        """
+        Consumes and returns the next character, which has to be one of `characters`.
+        """
+        character = self.peek()
+        if character is None or character not in characters:
+            raise ValueError("Expected one of %r at %s but found %r" % (characters, self.pos, character))
+        self.pos += 1
+        return character
+
+    def decode(self):
+        """
+        Consumes and returns the next json value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # The value doesn't end in this chunk.
+                if not self.read_more():
+                    raise
+                continue
+            if isinstance(value, (int, long, float)) and not isinstance(value, bool) \
+                    and not self.buffer[end:].lstrip(NUMBER_CHARACTERS) and self.read_more():
+                # A number at the end of the chunk may go on in the next one, e.g.
+                # "12345." is only decoded as far as 12345.
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_items(chunks, key="data"):
+    """
+    Yields the items of the array under `key` of the json object that the
+    chunks make up. The object's other values are skipped.
+    """
+    reader = JsonStreamReader(chunks)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        name = reader.decode()
+        reader.expect(":")
+        if name == key:
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.decode()
+                    if reader.expect(",]") == "]":
+                        break
+        else:
+            reader.decode()
+        if reader.expect(",}") == "}":
+            return
+
+
+def iter_file_chunks(fileobj, chunk_size=CHUNK_SIZE):
+    return iter(lambda: fileobj.read(chunk_size), b"")
+
+
+class JsonItems(object):
+    """
+    The items of the `data` array of a json document in a file. The file is
+    read again every time the items are iterated over, so they can be gone
+    through more than once without keeping them in memory.
+    """
+    def __init__(self, path, open_file=open, key="data"):
+        self.path = path
+        self.open_file = open_file
+        self.key = key
+
+    def __iter__(self):
+        with self.open_file(self.path, "rb") as fileobj:
+            for item in iter_json_items(iter_file_chunks(fileobj), self.key):
+                yield item
@@ -0,0 +1,65 @@
+import threading
+
+
+_local = threading.local()
+
+# The SyncStageRun columns of the row counters; they are prefixed as `updated` is BaseModel's timestamp.
+ROW_COUNTER_COLUMNS = {
+    "inserted": "rows_inserted",
+    "updated": "rows_updated",
+    "unchanged": "rows_unchanged",
+    "failed": "rows_failed",
+}
+
+
+class StageStats(object):
+    """
+    Counters of a single sync stage: http requests, retries, pages and bytes
+    fetched, rows inserted/updated/unchanged/failed and the seconds spent in
+    http calls and in db writes. It is shared by all the threads working on
+    the stage.
+    """
+    FIELDS = ("requests", "retries", "pages", "bytes", "inserted", "updated",
+              "unchanged", "failed", "http_seconds", "db_seconds")
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.counters = dict((field, 0) for field in self.FIELDS)
+
+    def add(self, **increments):
+        with self.lock:
+            for field, value in increments.iteritems():
+                self.counters[field] += value
+
+    def get_counters(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+def get_current_stage():
+    return getattr(_local, 'stage', None)
+
+
+def bind(stage):
+    """
+    Attributes everything recorded on the current thread to the given stage.
+    Threads spawned by a stage must bind themselves to the stage too.
+    """
+    _local.stage = stage
+
+
+def record(**increments):
+    """
+    Adds the increments to the counters of the current thread's stage, if any.
+    """
+    stage = get_current_stage()
+    if stage is not None:
+        stage.add(**increments)
+
+
+def get_stage_run_values(counters):
+    """
+    Returns a stage's counters keyed by the SyncStageRun fields they are stored in.
+    """
+    return dict((ROW_COUNTER_COLUMNS.get(field, field), value) for field, value in counters.iteritems())
@@ -1,3 +1,910 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urlparse
+import BaseHTTPServer
 
-# Create your tests here.
+from datetime import datetime, timedelta
+
+import pytz
+import requests
+
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+
+from . import archive, client, daemon, report_cache, routers, staging, telemetry, utils, webhooks
+from .bulk import bulk_upsert, bulk_upsert_values, reconcile_m2m, reconcile_tombstones
+from .facts import update_support_facts
+from .fake_api import FakeWrikeServer, SyntheticAccount
+from .hierarchy import get_folder_closure, update_folder_closure
+from .models import Contact, CustomField, CustomFieldFolder, CustomFieldTask, Folder, FolderClosure, SyncCheckpoint, \
+    Task, SupportFact, SupportRollup, SyncRun, WebhookUpdate, WrikeOauth2Credentials
+from .streaming import JsonItems, iter_json_items
+from .tokens import TokenUnavailable, WrikeTokenProvider, token_provider
+from .views import SyncRuns, WrikeWebhook
+from .views_helpers import SUPPORT_CATEGORIES, get_support_data_by_country, get_support_data_by_custom_field, \
+    get_support_data_by_person
+
+# Folder ids for the settings of the support categories, e.g. "RECRUITING" for WRIKE_PALM_RECRUITING_FOLDER_ID.
+CATEGORY_FOLDER_IDS = dict((name, name[len('WRIKE_PALM_'):-len('_FOLDER_ID')])
+                           for category, names in SUPPORT_CATEGORIES for name in names)
+
+# The settings of the folders that the support facts are drawn from.
+SUPPORT_FOLDER_SETTINGS = dict(WRIKE_PALM_GENERAL_TECH_SUPPORT_FOLDER_ID='GENERAL_TECH_SUPPORT',
+                               WRIKE_PALM_COUNTRIES_FOLDER_ID='COUNTRIES',
+                               WRIKE_PALM_RPD_PORTFOLIOS_FOLDER_ID='RPD_PORTFOLIOS', **CATEGORY_FOLDER_IDS)
+
+
+@override_settings(WRIKE_REPORT_CACHE=None, **SUPPORT_FOLDER_SETTINGS)
+class SupportDataTest(TestCase):
+    def setUp(self):
+        self.ann = Contact.objects.create(id='C1', firstName='Ann')
+        self.bob = Contact.objects.create(id='C2', firstName='Bob')
+        gen_tech = Folder.objects.create(id='GENERAL_TECH_SUPPORT', title='General Tech Support')
+        for folder_id in list(CATEGORY_FOLDER_IDS.values()) + ['COUNTRIES', 'RPD_PORTFOLIOS']:
+            Folder.objects.create(id=folder_id, title=folder_id)
+        Folder.objects.create(id='KENYA', title='Kenya').parents.add('COUNTRIES')
+        Folder.objects.create(id='NIGER', title='Niger').parents.add('COUNTRIES')
+
+        for i in range(2):
+            task = Task.objects.create(id='T%d' % i, title='Task %d' % i)
+            task.folders.add(gen_tech, 'KENYA')
+            task.assignees.add(self.ann)
+        self.add_project('P1', ['RECRUITING', 'KENYA', 'NIGER'], [self.ann, self.bob])
+        self.add_project('P2', ['TENDERS_ARCHIVE', 'NIGER'], [self.ann])
+        # Filed under both tender folders, but it's one project.
+        self.add_project('P3', ['TENDERS', 'TENDERS_ARCHIVE'], [self.bob])
+        self.add_project('P4', ['RECRUITING'], [self.bob], tombstoned=True)
+        update_support_facts()
+
+    def add_project(self, project_id, parent_ids, assignees, tombstoned=False):
+        project = Folder.objects.create(id=project_id, title=project_id, tombstoned=tombstoned)
+        project.parents.add(*parent_ids)
+        project.assignees.add(*assignees)
+        return project
+
+    def sync(self, model, pks, **values):
+        """
+        Updates the rows the way the sync does, which stamps them as updated.
+        """
+        model.objects.filter(pk__in=pks).update(updated=timezone.now(), **values)
+        if model is Folder:
+            update_folder_closure()
+        update_support_facts()
+
+    def test_counts_by_person_and_category(self):
+        labels, series = get_support_data_by_person({})
+        data = dict((s['name'], s['data']) for s in series)
+        self.assertEqual(labels, ['Bob', 'Ann'])
+        self.assertEqual(data['General Tech Support'], ['0', 2])
+        self.assertEqual(data['Recruitment'], [1, 1])
+        self.assertEqual(data['Tender'], [1, 1])
+        self.assertEqual(data['Material Aid'], ['0', '0'])
+
+    def test_number_of_queries_does_not_depend_on_categories(self):
+        # The support facts are counted by person and category in one query.
+        with self.assertNumQueries(1):
+            get_support_data_by_person({})
+
+    def test_counts_by_country_and_category(self):
+        labels, series = get_support_data_by_country({})
+        data = dict((s['name'], s['data']) for s in series)
+        self.assertEqual(labels, ['Kenya', 'Niger'])
+        self.assertEqual(data['General Tech Support'], [2, '0'])
+        self.assertEqual(data['Recruitments'], [1, 1])
+        self.assertEqual(data['Tenders'], [0, 1])
+
+    def test_completed_date_range(self):
+        self.sync(Task, ['T0'], completedDate=datetime(2016, 3, 5, 10, tzinfo=pytz.UTC))
+        self.sync(Task, ['T1'], completedDate=datetime(2016, 3, 10, 10, tzinfo=pytz.UTC))
+        labels, series = get_support_data_by_person({'start': datetime(2016, 3, 1, tzinfo=pytz.UTC),
+                                                     'end': datetime(2016, 3, 10, tzinfo=pytz.UTC)})
+        self.assertEqual(labels, ['Ann'])
+        self.assertEqual(series[0]['data'], [1])
+
+    def test_changes_are_rolled_up(self):
+        Folder.objects.get(pk='P2').assignees.add(self.bob)
+        self.sync(Folder, ['P2'])
+        self.sync(Folder, ['P1'], tombstoned=True)
+        self.sync(Folder, ['P4'], tombstoned=False)
+        labels, series = get_support_data_by_person({})
+        data = dict((s['name'], s['data']) for s in series)
+        self.assertEqual(data['Recruitment'], [1, '0'])
+        self.assertEqual(data['Tender'], [2, 1])
+
+        # The adjusted buckets are the ones that a rollup from scratch comes to.
+        buckets = sorted(SupportRollup.objects.values_list('day', 'category', 'assignee', 'country', 'region', 'total'))
+        SupportRollup.objects.all().delete()
+        update_support_facts()
+        self.assertEqual(
+            sorted(SupportRollup.objects.values_list('day', 'category', 'assignee', 'country', 'region', 'total')),
+            buckets)
+
+    def test_projects_nested_deeper(self):
+        Folder.objects.create(id='NAIROBI', title='Nairobi').parents.add('KENYA')
+        Folder.objects.create(id='2016', title='2016').parents.add('RECRUITMENT_ARCHIVE')
+        self.add_project('P5', ['2016', 'NAIROBI'], [self.bob])
+        self.sync(Folder, ['NAIROBI', '2016', 'P5'], status='Completed')
+        labels, series = get_support_data_by_country({})
+        data = dict((s['name'], s['data']) for s in series)
+        self.assertEqual(labels, ['Kenya', 'Niger'])
+        self.assertEqual(data['Recruitments'], [2, 1])
+
+    def test_only_changed_rows_are_looked_at(self):
+        # The update doesn't notice a change that the sync didn't make.
+        Task.objects.get(pk='T0').assignees.add(self.bob)
+        update_support_facts()
+        self.assertEqual(get_support_data_by_person({})[0], ['Bob', 'Ann'])
+        self.assertEqual(dict((s['name'], s['data']) for s in get_support_data_by_person({})[1])
+                         ['General Tech Support'], ['0', 2])
+
+        self.sync(Task, ['T0'])
+        data = dict((s['name'], s['data']) for s in get_support_data_by_person({})[1])
+        self.assertEqual(data['General Tech Support'], [1, 2])
+
+    def test_moved_folders_move_what_is_under_them(self):
+        # A folder that groups a project and a task moves from Kenya to Niger.
+        Folder.objects.create(id='GROUP', title='Group').parents.add('RECRUITING', 'KENYA')
+        self.add_project('P5', ['GROUP'], [self.bob])
+        Folder.objects.filter(pk='P5').update(status='Active')
+        task = Task.objects.create(id='T2', title='Task 2')
+        task.folders.add('GROUP', 'GENERAL_TECH_SUPPORT')
+        self.sync(Folder, ['GROUP', 'P5'])
+        self.sync(Task, ['T2'])
+        data = dict((s['name'], s['data']) for s in get_support_data_by_country({})[1])
+        # The group counts as well, as it's directly under the category folder.
+        self.assertEqual((data['General Tech Support'], data['Recruitments']), ([3, '0'], [3, 1]))
+
+        Folder.parents.through.objects.filter(from_folder='GROUP', to_folder='KENYA').update(to_folder='NIGER')
+        self.sync(Folder, ['GROUP'])
+        data = dict((s['name'], s['data']) for s in get_support_data_by_country({})[1])
+        self.assertEqual((data['General Tech Support'], data['Recruitments']), ([2, 1], [1, 3]))
+
+    def test_counts_by_custom_field_value(self):
+        donor = CustomField.objects.create(id='DONOR', title='Donor')
+        for task_id, value in (('T0', 'USAID'), ('T1', 'ECHO')):
+            CustomFieldTask.objects.create(task_id=task_id, customfield=donor, value=value)
+        for folder_id, value in (('P1', 'USAID'), ('P2', 'USAID'), ('P3', ''), ('P4', 'USAID')):
+            CustomFieldFolder.objects.create(folder_id=folder_id, customfield=donor, value=value)
+        with self.assertNumQueries(2):
+            labels, series = get_support_data_by_custom_field('DONOR', {})
+        data = dict((s['name'], s['data']) for s in series)
+        self.assertEqual(labels, ['ECHO', 'USAID'])
+        self.assertEqual(data['General Tech Support'], [1, 1])
+        self.assertEqual(data['Recruitments'], ['0', 1])
+        self.assertEqual(data['Tenders'], ['0', 1])
+
+
+class ReportCacheTest(TestCase):
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(WRIKE_REPORT_CACHE='default', WRIKE_REPORT_LOCK_DIR=self.lock_dir)
+        self.settings_override.enable()
+        self.calls = []
+        report_cache.bump_data_version()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.lock_dir)
+
+    def get_support_data(self, criteria):
+        self.calls.append(criteria)
+        return (['Ann'], [{"name": "General Tech Support", "data": [len(self.calls)]}])
+
+    def test_results_are_cached_until_the_data_changes(self):
+        criteria = {'start': datetime(2016, 3, 1, tzinfo=pytz.UTC), 'end': None}
+        first = report_cache.get_report(self.get_support_data, criteria)
+        self.assertEqual(report_cache.get_report(self.get_support_data, criteria), first)
+        self.assertEqual(len(self.calls), 1)
+
+        report_cache.get_report(self.get_support_data, {})
+        self.assertEqual(len(self.calls), 2)
+
+        report_cache.bump_data_version()
+        self.assertNotEqual(report_cache.get_report(self.get_support_data, criteria), first)
+        self.assertEqual(len(self.calls), 3)
+
+
+class FakeWrikeTestCase(TestCase):
+    """
+    Points the sync at a FakeWrikeServer serving `account`, without retries.
+    The access token is handed out from memory, as the server's threads can't
+    see the test's uncommitted credentials.
+    """
+    account = SyntheticAccount(tasks=2500, customfields=0)
+
+    def setUp(self):
+        self.server = FakeWrikeServer(self.account)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.settings_override = override_settings(
+            WRIKE_HTTP_MAX_RETRIES=0, WRIKE_ARCHIVE_DIR=None, WRIKE_TASK_PARTITIONS=1, **self.server.get_settings())
+        self.settings_override.enable()
+        token_provider._access_token = 'fake-access-token'
+        token_provider._expires_at = datetime.utcnow().replace(tzinfo=pytz.UTC) + timedelta(days=1)
+
+    def tearDown(self):
+        token_provider._access_token = None
+        token_provider._expires_at = None
+        self.settings_override.disable()
+        # Drops the pooled keep-alive connections to the server.
+        client.get_client().session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RequestBudgetTest(TestCase):
+    def test_no_more_than_the_limit_per_period(self):
+        budget = client.RequestBudget(3, 0.5)
+        start = time.time()
+        for i in range(3):
+            budget.acquire()
+        self.assertTrue(time.time() - start < 0.25)
+        # The first period is full, so the next request waits for the first one to be a period old.
+        budget.acquire()
+        self.assertTrue(time.time() - start >= 0.5)
+
+
+class TaskListingTest(FakeWrikeTestCase):
+    def test_failed_page_is_raised(self):
+        self.server.failing_task_pages[1000] = 503
+        pages = client.iter_pages(utils.get_wrike_tasks_url(full=True))
+        with self.assertRaises(requests.HTTPError):
+            list(pages)
+
+    def test_partitions_share_their_boundaries(self):
+        with override_settings(WRIKE_TASK_PARTITIONS=4,
+                               WRIKE_TASK_PARTITION_START=self.account.start_date.strftime("%Y-%m-%d")):
+            urls = utils.get_wrike_task_partition_urls(utils.get_wrike_tasks_url(full=True))
+            self.assertTrue(utils.process_wrike_tasks(full=True))
+        ranges = [json.loads(url.split('&createdDate=')[1]) for url in urls]
+        self.assertNotIn('start', ranges[0])
+        self.assertNotIn('end', ranges[-1])
+        for previous, current in zip(ranges, ranges[1:]):
+            self.assertEqual(previous['end'], current['start'])
+        self.assertEqual(Task.objects.count(), self.account.tasks)
+
+    def test_failed_page_keeps_the_watermark(self):
+        self.assertTrue(utils.process_wrike_tasks(full=True))
+        watermark = SyncCheckpoint.objects.get(entity='tasks').watermark
+        SyncCheckpoint.objects.filter(entity='tasks').update(watermark=None)
+
+        self.server.failing_task_pages[2000] = 429
+        self.assertFalse(utils.process_wrike_tasks(full=True))
+        self.assertIsNone(SyncCheckpoint.objects.get(entity='tasks').watermark)
+        self.assertIsNotNone(watermark)
+
+
+class ReconcileTombstonesTest(TestCase):
+    def setUp(self):
+        Task.objects.bulk_create(Task(id='T%02d' % i, title='Task %d' % i) for i in range(20))
+
+    def get_tombstoned_ids(self):
+        return set(Task.objects.filter(tombstoned=True).values_list('id', flat=True))
+
+    def test_unlisted_rows_are_tombstoned(self):
+        remote_ids = ['T%02d' % i for i in range(20) if i not in (3, 17)] + ['T99']
+        tombstoned, revived, differing, ranges = reconcile_tombstones(Task, remote_ids, range_size=5)
+        self.assertEqual((tombstoned, revived, ranges), (2, 0, 4))
+        self.assertEqual(differing, 2)
+        self.assertEqual(self.get_tombstoned_ids(), set(['T03', 'T17']))
+        # Ids that don't exist locally are left to the sync.
+        self.assertFalse(Task.objects.filter(id='T99').exists())
+
+    def test_relisted_rows_are_revived(self):
+        Task.objects.filter(id__in=['T05', 'T06']).update(tombstoned=True)
+        remote_ids = ['T%02d' % i for i in range(20) if i != 6]
+        self.assertEqual(reconcile_tombstones(Task, remote_ids, range_size=5)[:2], (0, 1))
+        self.assertEqual(self.get_tombstoned_ids(), set(['T06']))
+
+    def test_matching_listing_changes_nothing(self):
+        remote_ids = ['T%02d' % i for i in reversed(range(20))]
+        self.assertEqual(reconcile_tombstones(Task, remote_ids, range_size=5), (0, 0, 0, 4))
+
+    def test_empty_listing_changes_nothing(self):
+        self.assertEqual(reconcile_tombstones(Task, []), (0, 0, 0, 0))
+        self.assertEqual(self.get_tombstoned_ids(), set())
+
+
+class TaskDeletionsTest(FakeWrikeTestCase):
+    def setUp(self):
+        super(TaskDeletionsTest, self).setUp()
+        self.assertTrue(utils.process_wrike_tasks(full=True))
+
+    def test_failed_listing_tombstones_nothing(self):
+        self.server.failing_task_pages[1000] = 429
+        self.assertFalse(utils.process_wrike_task_deletions(full=True))
+        self.assertFalse(Task.objects.filter(tombstoned=True).exists())
+        self.assertIsNone(utils.get_sync_watermark('task_ids'))
+
+    def test_page_without_data_tombstones_nothing(self):
+        self.server.failing_task_pages[1000] = 200
+        self.assertFalse(utils.process_wrike_task_deletions(full=True))
+        self.assertFalse(Task.objects.filter(tombstoned=True).exists())
+
+    def test_complete_listing_tombstones_unlisted_tasks(self):
+        Task.objects.create(id='IEFAKEGONE', title='Deleted in Wrike')
+        self.assertTrue(utils.process_wrike_task_deletions(full=True))
+        self.assertEqual(list(Task.objects.filter(tombstoned=True).values_list('id', flat=True)), ['IEFAKEGONE'])
+
+    def test_ids_url_keeps_the_listing_filters(self):
+        with override_settings(WRIKE_TASK_API_URL='%s/tasks?descendants=true&fields=["parentIds"]&pageSize=100'
+                                                  '&status=Active' % self.server.base_url):
+            self.assertEqual(utils.get_wrike_task_ids_url(),
+                             '%s/tasks?descendants=true&status=Active&pageSize=1000' % self.server.base_url)
+
+
+@override_settings(WRIKE_WEBHOOK_SECRET='webhook-secret')
+class WrikeWebhookTest(TestCase):
+    def post(self, body, **headers):
+        request = RequestFactory().post('/wrike/webhook/', body, content_type='application/json', **headers)
+        return WrikeWebhook.as_view()(request)
+
+    def test_verification_request_is_answered(self):
+        body = json.dumps({"requestType": "WebHook secret verification"})
+        response = self.post(body, HTTP_X_HOOK_SECRET='a1B2c3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Hook-Secret'], webhooks.get_signature('a1B2c3', 'webhook-secret'))
+
+    def test_verification_request_does_not_sign_notifications(self):
+        notification = json.dumps([{"taskId": "IEFORGED", "eventType": "TaskStatusChanged"}])
+        body = json.dumps({"requestType": "WebHook secret verification"})
+        response = self.post(body, HTTP_X_HOOK_SECRET=notification)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.has_header('X-Hook-Secret'))
+
+    def test_signed_notification_is_queued(self):
+        body = json.dumps([{"taskId": "IETASK1", "eventType": "TaskStatusChanged"},
+                           {"folderId": "IEFOLDER1", "eventType": "FolderTitleChanged"}])
+        response = self.post(body, HTTP_X_HOOK_SIGNATURE=webhooks.get_signature(body, 'webhook-secret'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(WebhookUpdate.objects.values_list('entity', 'wrike_id')),
+                         set([(WebhookUpdate.TASK, 'IETASK1'), (WebhookUpdate.FOLDER, 'IEFOLDER1')]))
+
+    def test_forged_notification_is_rejected(self):
+        body = json.dumps([{"taskId": "IETASK1", "eventType": "TaskStatusChanged"}])
+        for headers in ({}, {'HTTP_X_HOOK_SIGNATURE': webhooks.get_signature(body, 'another-secret')},
+                        {'HTTP_X_HOOK_SECRET': webhooks.get_signature(body, 'webhook-secret')}):
+            self.assertEqual(self.post(body, **headers).status_code, 403)
+        self.assertFalse(WebhookUpdate.objects.exists())
+
+
+class UnresolvedLinksTest(TestCase):
+    def setUp(self):
+        Contact.objects.create(id='C1', firstName='Ann')
+
+    def test_task_links_are_added_once_the_folder_exists(self):
+        rows = [{"id": "T1", "title": "Task", "parentIds": ["F1"], "responsibleIds": ["C1"]}]
+        utils.process_wrike_tasks_helper(rows)
+        task = Task.objects.get(id='T1')
+        self.assertIsNone(task.content_hash)
+        self.assertEqual(list(task.assignees.values_list('id', flat=True)), ['C1'])
+        self.assertFalse(task.folders.exists())
+
+        Folder.objects.create(id='F1', title='Folder')
+        self.assertEqual(utils.process_wrike_tasks_helper(rows)["updated"], 1)
+        task = Task.objects.get(id='T1')
+        self.assertIsNotNone(task.content_hash)
+        self.assertEqual(list(task.folders.values_list('id', flat=True)), ['F1'])
+        self.assertEqual(utils.process_wrike_tasks_helper(rows)["unchanged"], 1)
+
+    def test_project_owners_are_added_once_the_contact_exists(self):
+        rows = [{"id": "P1", "title": "Project", "project": {"ownerIds": ["C1", "C2"]}}]
+        self.assertTrue(utils.process_wrike_folder_and_projects_helper(rows))
+        project = Folder.objects.get(id='P1')
+        self.assertIsNone(project.content_hash)
+        self.assertEqual(list(project.assignees.values_list('id', flat=True)), ['C1'])
+
+        Contact.objects.create(id='C2', firstName='Bob')
+        self.assertTrue(utils.process_wrike_folder_and_projects_helper(rows))
+        project = Folder.objects.get(id='P1')
+        self.assertIsNotNone(project.content_hash)
+        self.assertEqual(set(project.assignees.values_list('id', flat=True)), set(['C1', 'C2']))
+
+
+class SyncRunPruningTest(TestCase):
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+
+    def test_archives_of_full_runs_are_kept(self):
+        for run_id in range(1, 11):
+            os.mkdir(os.path.join(self.archive_dir, str(run_id)))
+        with override_settings(WRIKE_ARCHIVE_DIR=self.archive_dir):
+            archive.prune(keep=3, also_keep=[2])
+        self.assertEqual(sorted(int(name) for name in os.listdir(self.archive_dir)), [2, 8, 9, 10])
+
+    def test_old_runs_are_deleted(self):
+        now = timezone.now()
+        old_full = SyncRun.objects.create(started=now - timedelta(days=60), full=True)
+        old = SyncRun.objects.create(started=now - timedelta(days=40))
+        recent = SyncRun.objects.create(started=now - timedelta(days=1))
+        old.stages.create(name="Tasks", started=old.started)
+        with override_settings(WRIKE_SYNC_RUN_KEEP_DAYS=30):
+            utils.prune_sync_runs(also_keep=[old_full.pk])
+        self.assertEqual(set(SyncRun.objects.values_list('pk', flat=True)), set([old_full.pk, recent.pk]))
+
+    def test_tasks_without_their_links_are_queued(self):
+        Task.objects.create(id='T1', title='Unresolved')
+        Task.objects.create(id='T2', title='Stored', content_hash='0' * 40)
+        Task.objects.create(id='T3', title='Deleted', tombstoned=True)
+        utils.queue_unresolved_tasks()
+        self.assertEqual(list(WebhookUpdate.objects.values_list('entity', 'wrike_id')), [(WebhookUpdate.TASK, 'T1')])
+
+
+class SyncStagesTest(TestCase):
+    def setUp(self):
+        self.settings_override = override_settings(WRIKE_REPORT_CACHE='default')
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def run_stage(self, **counters):
+        def stage():
+            telemetry.record(**counters)
+        utils.run_sync_stages((("Contacts", stage, ()),))
+
+    def test_any_change_invalidates_the_charts(self):
+        cache = report_cache.get_cache()
+        version = report_cache.get_data_version(cache)
+        self.run_stage(unchanged=10)
+        self.assertEqual(report_cache.get_data_version(cache), version)
+        # E.g. a renamed contact, which doesn't change any support fact.
+        self.run_stage(updated=1, unchanged=9)
+        self.assertNotEqual(report_cache.get_data_version(cache), version)
+
+    def test_counters_are_recorded(self):
+        run = SyncRun.objects.create(started=timezone.now())
+        def stage():
+            telemetry.record(inserted=1, updated=2, unchanged=3, failed=4)
+        utils.run_sync_stages((("Contacts", stage, ()),), run=run)
+        stage_run = run.stages.get()
+        # Saving the row again stamps its updated time without touching the counters.
+        stage_run.save()
+        stage_run = run.stages.get()
+        self.assertEqual((stage_run.rows_inserted, stage_run.rows_updated, stage_run.rows_unchanged,
+                          stage_run.rows_failed), (1, 2, 3, 4))
+        self.assertIsNotNone(stage_run.updated)
+
+
+class CustomFieldValuesTest(TestCase):
+    def setUp(self):
+        CustomField.objects.create(id='CF1', title='Sector', type='Text')
+        CustomField.objects.create(id='CF2', title='Donor', type='Text')
+
+    def get_values(self):
+        return dict(CustomFieldTask.objects.values_list('customfield_id', 'value'))
+
+    def test_cleared_values_are_deleted(self):
+        utils.process_wrike_tasks_helper([{"id": "T1", "title": "Task", "customFields": [
+            {"id": "CF1", "value": "Health"}, {"id": "CF2", "value": "ECHO"}]}])
+        self.assertEqual(self.get_values(), {'CF1': 'Health', 'CF2': 'ECHO'})
+
+        result = utils.process_wrike_tasks_helper([{"id": "T1", "title": "Task", "customFields": [
+            {"id": "CF1", "value": "Shelter"}, {"id": "CF2", "value": ""}]}])
+        self.assertEqual((result["values_updated"], result["values_deleted"]), (1, 1))
+        self.assertEqual(self.get_values(), {'CF1': 'Shelter'})
+
+    def test_values_are_kept_if_the_row_has_no_custom_fields(self):
+        utils.process_wrike_folder_and_projects_helper([{"id": "F1", "title": "Folder", "customFields": [
+            {"id": "CF1", "value": "Health"}]}])
+        utils.process_wrike_folder_and_projects_helper([{"id": "F1", "title": "Renamed folder"}])
+        self.assertEqual(list(CustomFieldFolder.objects.values_list('folder_id', 'value')), [('F1', 'Health')])
+
+
+class SyncRunsViewTest(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        for i in range(3):
+            run = SyncRun.objects.create(started=now - timedelta(minutes=i))
+            run.stages.create(name="Tasks", started=run.started)
+
+    def get_runs(self, **params):
+        response = SyncRuns.as_view()(RequestFactory().get('/wrike/sync_runs/', params))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)['runs']
+
+    def test_limit(self):
+        self.assertEqual(len(self.get_runs()), 3)
+        self.assertEqual(len(self.get_runs(limit=2)), 2)
+        self.assertEqual(len(self.get_runs(limit=-1)), 1)
+        self.assertEqual(len(self.get_runs(limit=0)), 1)
+        self.assertEqual(len(self.get_runs(limit='all')), 3)
+
+    def test_stage_counters(self):
+        stage = self.get_runs(limit=1)[0]['stages'][0]
+        self.assertEqual((stage['name'], stage['rows_inserted'], stage['rows_updated']), ("Tasks", 0, 0))
+
+
+class StagingDbTest(TestCase):
+    def test_other_dbs_are_refused(self):
+        live = connections[DEFAULT_DB_ALIAS]
+        live.vendor = 'mysql'
+        try:
+            with self.assertRaises(staging.StagingNotSupported):
+                with staging.staging_db():
+                    self.fail("The sync shouldn't have started")
+        finally:
+            del live.vendor
+        self.assertFalse(os.path.exists(staging.get_staging_db_path()))
+        self.assertNotIn(routers.STAGING_DB_ALIAS, connections.databases)
+
+
+class WebhookUpdatesTest(FakeWrikeTestCase):
+    def setUp(self):
+        super(WebhookUpdatesTest, self).setUp()
+        self.task_ids = [self.account.task_id(i) for i in range(3)]
+        webhooks.queue_updates([{"taskId": task_id} for task_id in self.task_ids])
+
+    def tearDown(self):
+        staging._active_build = None
+        super(WebhookUpdatesTest, self).tearDown()
+
+    def test_updates_are_dequeued_once_stored(self):
+        self.assertTrue(utils.process_wrike_webhook_updates())
+        self.assertEqual(Task.objects.filter(id__in=self.task_ids).count(), 3)
+        self.assertFalse(WebhookUpdate.objects.exists())
+
+    def test_updates_stay_queued_until_the_staging_db_is_published(self):
+        build = staging._active_build = staging.StagingBuild()
+        self.assertTrue(utils.process_wrike_webhook_updates())
+        self.assertEqual(WebhookUpdate.objects.count(), 3)
+
+        staging._active_build = None
+        for func in build.on_publish:
+            func()
+        self.assertFalse(WebhookUpdate.objects.exists())
+
+    @override_settings(WRIKE_REPORT_CACHE=None, **SUPPORT_FOLDER_SETTINGS)
+    def test_deleted_rows_leave_the_facts_and_the_closure(self):
+        for folder_id in SUPPORT_FOLDER_SETTINGS.values():
+            Folder.objects.create(id=folder_id, title=folder_id)
+        Folder.objects.create(id='GONE_PROJECT', title='Project').parents.add('RECRUITING')
+        Task.objects.create(id='GONE_TASK', title='Task').folders.add('GENERAL_TECH_SUPPORT')
+        update_folder_closure()
+        update_support_facts()
+        self.assertEqual(set(SupportFact.objects.values_list('wrike_id', flat=True)),
+                         set(['GONE_PROJECT', 'GONE_TASK']))
+
+        # Neither is in the account, so Wrike answers 404.
+        WebhookUpdate.objects.all().delete()
+        webhooks.queue_updates([{"taskId": "GONE_TASK"}, {"folderId": "GONE_PROJECT"}])
+        stats = telemetry.StageStats("Webhook Updates")
+        telemetry.bind(stats)
+        try:
+            self.assertTrue(utils.process_wrike_webhook_updates())
+        finally:
+            telemetry.bind(None)
+        # Counted as updated rows, so that the cached charts are invalidated.
+        self.assertEqual(stats.get_counters()['updated'], 2)
+        self.assertTrue(Task.objects.get(pk='GONE_TASK').tombstoned)
+
+        update_support_facts()
+        self.assertFalse(SupportFact.objects.exists())
+        self.assertFalse(FolderClosure.objects.filter(descendant='GONE_PROJECT').exists())
+
+
+@override_settings(WRIKE_TASK_API_URL='http://127.0.0.1:1/api/v3/tasks', WRIKE_HTTP_MAX_RETRIES=0,
+                   WRIKE_WEBHOOK_RETRY_DELAY=60, WRIKE_WEBHOOK_MAX_ATTEMPTS=3)
+class WebhookRetriesTest(TestCase):
+    """
+    Nothing listens on port 1, so every fetch of the queued task fails.
+    """
+    def setUp(self):
+        token_provider._access_token = 'fake-access-token'
+        token_provider._expires_at = timezone.now() + timedelta(days=1)
+        webhooks.queue_updates([{"taskId": "T1"}])
+
+    def tearDown(self):
+        token_provider._access_token = None
+        token_provider._expires_at = None
+
+    def test_failed_update_is_backed_off(self):
+        self.assertFalse(utils.process_wrike_webhook_updates())
+        update = WebhookUpdate.objects.get()
+        self.assertEqual(update.attempts, 1)
+        self.assertFalse("Webhook Updates" in daemon.get_due_stages()[0])
+        # Nothing is fetched until the backoff has passed.
+        self.assertTrue(utils.process_wrike_webhook_updates())
+        self.assertEqual(WebhookUpdate.objects.get().attempts, 1)
+        self.assertTrue("Webhook Updates" in daemon.get_due_stages(now=update.retry_after)[0])
+
+        WebhookUpdate.objects.update(retry_after=timezone.now())
+        self.assertFalse(utils.process_wrike_webhook_updates())
+        update = WebhookUpdate.objects.get()
+        self.assertEqual(update.attempts, 2)
+        self.assertTrue(update.retry_after > timezone.now() + timedelta(seconds=110))
+
+    def test_update_is_dropped_after_the_last_attempt(self):
+        for i in range(3):
+            WebhookUpdate.objects.update(retry_after=None)
+            self.assertFalse(utils.process_wrike_webhook_updates())
+        self.assertFalse(WebhookUpdate.objects.exists())
+
+    def test_new_notification_restarts_the_retries(self):
+        self.assertFalse(utils.process_wrike_webhook_updates())
+        webhooks.queue_updates([{"taskId": "T1"}])
+        self.assertEqual(WebhookUpdate.objects.filter(attempts=0, retry_after=None).count(), 1)
+
+
+class FolderClosureTest(TestCase):
+    def setUp(self):
+        # ROOT > A > B > C and ROOT > D, with C also filed under D.
+        for folder_id, parent_ids in (('ROOT', []), ('A', ['ROOT']), ('B', ['A']), ('C', ['B', 'D']), ('D', ['ROOT'])):
+            Folder.objects.create(id=folder_id, title=folder_id).parents.add(*parent_ids)
+        update_folder_closure()
+
+    def get_closure(self):
+        return dict(((ancestor_id, descendant_id), depth) for ancestor_id, descendant_id, depth in
+                    FolderClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+
+    def sync(self, folder_ids, **values):
+        Folder.objects.filter(pk__in=folder_ids).update(updated=timezone.now(), **values)
+        self.assertTrue(update_folder_closure())
+
+    def test_closure(self):
+        closure = self.get_closure()
+        self.assertEqual(closure[('ROOT', 'C')], 2)
+        self.assertEqual(closure[('A', 'C')], 2)
+        self.assertEqual(closure[('C', 'C')], 0)
+        self.assertEqual(len(closure), 13)
+
+    def test_moved_folders_take_what_is_under_them(self):
+        Folder.objects.create(id='E', title='E').parents.add('ROOT')
+        Folder.parents.through.objects.filter(from_folder='B', to_folder='A').update(to_folder='E')
+        self.sync(['B', 'E'])
+        closure = self.get_closure()
+        self.assertNotIn(('A', 'C'), closure)
+        self.assertEqual((closure[('E', 'B')], closure[('E', 'C')]), (1, 2))
+        self.assertEqual(closure, get_folder_closure(list(Folder.objects.values_list('id', flat=True))))
+
+    def test_deleted_folders_are_left_out(self):
+        self.sync(['D'], tombstoned=True)
+        closure = self.get_closure()
+        self.assertFalse([pair for pair in closure if 'D' in pair])
+        self.assertEqual(closure[('ROOT', 'C')], 3)
+
+
+class StreamingTest(TestCase):
+    document = json.dumps({
+        "kind": "tasks",
+        "data": [
+            {"id": "T1", "title": u"Caf\u00e9 \u2615 \U0001f600", "escaped": "a \"quoted\" \\ value\n"},
+            {"id": "T2", "numbers": [0, -12, 3.25, 1e-05, 123456789012345678], "nested": {"data": [1, 2]}},
+            12345.678,
+            u"\u6771\u4eac",
+            None,
+        ],
+        "nextPageToken": "ABC",
+    }, indent=2, sort_keys=True, ensure_ascii=False).encode('utf-8')
+
+    def split(self, document, size):
+        return [document[i:i + size] for i in range(0, len(document), size)]
+
+    def test_items_split_across_chunks(self):
+        expected = json.loads(self.document)['data']
+        # Every value, string, number and multibyte character ends up split at some chunk size.
+        for size in range(1, 40):
+            self.assertEqual(list(iter_json_items(self.split(self.document, size))), expected)
+
+    def test_keys_after_data_are_skipped(self):
+        document = b'{"data": [{"id": "T1"}], "nextPageToken": "ABC", "kind": {"data": [2]}}'
+        for size in (1, 2, 5, len(document)):
+            self.assertEqual(list(iter_json_items(self.split(document, size))), [{"id": "T1"}])
+
+    def test_empty_documents(self):
+        for document in (b'{"kind": "tasks", "data": []}', b'{ "data" : [ ] , "kind": "tasks" }', b'{}',
+                         b'{"kind": "tasks"}'):
+            for size in (1, 3, len(document)):
+                self.assertEqual(list(iter_json_items(self.split(document, size))), [])
+
+    def test_other_keys(self):
+        document = b'{"data": [1], "customFields": [2, 3]}'
+        self.assertEqual(list(iter_json_items(self.split(document, 4), key="customFields")), [2, 3])
+
+    def test_truncated_document(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_items(self.split(self.document[:-40], 16)))
+
+    def test_items_of_a_file(self):
+        with tempfile.NamedTemporaryFile() as document_file:
+            document_file.write(self.document)
+            document_file.flush()
+            items = JsonItems(document_file.name)
+            # The items can be gone through more than once.
+            self.assertEqual(list(items), json.loads(self.document)['data'])
+            self.assertEqual(len(list(items)), 5)
+
+
+class BulkUpsertTest(TestCase):
+    def setUp(self):
+        Contact.objects.create(id='C1', firstName='Ann', content_hash='hash-1')
+        Contact.objects.create(id='C2', firstName='Bob', content_hash='hash-2')
+        Contact.objects.create(id='C3', firstName='Cid')
+        CustomField.objects.create(id='CF1', title='Sector', type='Text')
+        CustomField.objects.create(id='CF2', title='Donor', type='Text')
+        for task_id in ('T1', 'T2', 'T3'):
+            Task.objects.create(id=task_id, title=task_id)
+        CustomFieldTask.objects.create(task_id='T1', customfield_id='CF1', value='Health')
+        CustomFieldTask.objects.create(task_id='T1', customfield_id='CF2', value='ECHO')
+        CustomFieldTask.objects.create(task_id='T2', customfield_id='CF1', value='Shelter')
+        CustomFieldTask.objects.create(task_id='T3', customfield_id='CF1', value='Water')
+
+    def get_changed(self, model, before):
+        return set(pk for pk, updated in model.objects.values_list('pk', 'updated') if updated != before.get(pk))
+
+    def get_values(self):
+        return dict(((task_id, customfield_id), value) for task_id, customfield_id, value
+                    in CustomFieldTask.objects.values_list('task_id', 'customfield_id', 'value'))
+
+    def test_rows_are_inserted_updated_or_skipped(self):
+        rows = {
+            'C1': {'firstName': 'Ann', 'content_hash': 'hash-1'},
+            'C2': {'firstName': 'Robert', 'content_hash': 'hash-2b'},
+            # Rows without a stored hash are always rewritten.
+            'C3': {'firstName': 'Cid', 'content_hash': 'hash-3'},
+            'C4': {'firstName': 'Dee', 'content_hash': 'hash-4'},
+        }
+        before = dict(Contact.objects.values_list('pk', 'updated'))
+        inserted, updated, unchanged = bulk_upsert(Contact, rows)
+        self.assertEqual((inserted, updated, unchanged), (set(['C4']), set(['C2', 'C3']), set(['C1'])))
+        self.assertEqual(dict(Contact.objects.values_list('pk', 'firstName')),
+                         {'C1': 'Ann', 'C2': 'Robert', 'C3': 'Cid', 'C4': 'Dee'})
+        self.assertEqual(Contact.objects.get(pk='C4').content_hash, 'hash-4')
+        # Unchanged rows aren't written at all; inserted ones are stamped like updated ones.
+        self.assertEqual(self.get_changed(Contact, before), set(['C2', 'C3', 'C4']))
+
+    def test_only_changed_values_are_written(self):
+        rows = {('T1', 'CF1'): 'Health', ('T1', 'CF2'): 'DFID', ('T2', 'CF2'): 'ECHO'}
+        before = dict(CustomFieldTask.objects.values_list('pk', 'updated'))
+        self.assertEqual(bulk_upsert_values(CustomFieldTask, 'task', ['T1', 'T2'], rows), (1, 1, 1))
+        # T2's value of CF1 was cleared; T3 wasn't given, so its values are left alone.
+        self.assertEqual(self.get_values(), {('T1', 'CF1'): 'Health', ('T1', 'CF2'): 'DFID', ('T2', 'CF2'): 'ECHO',
+                                             ('T3', 'CF1'): 'Water'})
+        # The value that is the same isn't written again.
+        changed = self.get_changed(CustomFieldTask, before)
+        self.assertEqual(CustomFieldTask.objects.get(pk__in=changed).value, 'DFID')
+
+
+class ReconcileM2MTest(TestCase):
+    def setUp(self):
+        for contact_id in ('C1', 'C2', 'C3'):
+            Contact.objects.create(id=contact_id, firstName=contact_id)
+        for task_id in ('T1', 'T2', 'T3'):
+            Task.objects.create(id=task_id, title=task_id).assignees.add('C1', 'C2')
+
+    def get_pairs(self):
+        return set(Task.assignees.through.objects.values_list('task_id', 'contact_id'))
+
+    def test_pairs_of_the_given_rows_are_reconciled(self):
+        pairs = set([('T1', 'C2'), ('T1', 'C3'), ('T2', 'C1'), ('T2', 'C2')])
+        with self.assertNumQueries(3):
+            self.assertEqual(reconcile_m2m(Task, 'assignees', ['T1', 'T2'], pairs), (1, 1))
+        # T3 wasn't given, so its pairs are left alone.
+        self.assertEqual(self.get_pairs(), pairs | set([('T3', 'C1'), ('T3', 'C2')]))
+
+    def test_rows_without_pairs_lose_theirs(self):
+        self.assertEqual(reconcile_m2m(Task, 'assignees', ['T1'], set()), (0, 2))
+        self.assertFalse(Task.objects.get(pk='T1').assignees.exists())
+
+
+class TokenRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        form = urlparse.parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        self.server.refreshes.append(form['refresh_token'][0])
+        if self.server.error:
+            body = {"error": self.server.error, "error_description": "Refresh failed"}
+        else:
+            body = {
+                "access_token": "access-token-%d" % len(self.server.refreshes),
+                "refresh_token": "refresh-token-%d" % len(self.server.refreshes),
+                "token_type": "bearer",
+                "expires_in": 3600,
+            }
+        content = json.dumps(body)
+        self.send_response(400 if self.server.error else 200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TokenServer(BaseHTTPServer.HTTPServer):
+    """
+    A stand-in for Wrike's token endpoint that records the refresh tokens it is
+    sent and hands out a new access token for each, or `error` if it is set.
+    """
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), TokenRequestHandler)
+        self.refreshes = []
+        self.error = None
+
+    @property
+    def url(self):
+        return "http://%s:%s/oauth2/token" % self.server_address[:2]
+
+
+class TokenProviderTest(TestCase):
+    def setUp(self):
+        self.server = TokenServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.settings_override = override_settings(
+            WRIKE_API_USER_ACCOUNT='palm', WRIKE_ACCESS_TOKEN_URL=self.server.url,
+            WRIKE_OAUTH2_CLIENT_ID='client-id', WRIKE_OAUTH2_CLIENT_SECRET='client-secret')
+        self.settings_override.enable()
+        user = User.objects.create(username='palm')
+        WrikeOauth2Credentials.objects.create(user=user, access_token='stored-token', token_type='bearer',
+                                              refresh_token='stored-refresh-token')
+        self.provider = WrikeTokenProvider()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def expire_stored_token(self, age=timedelta(hours=2)):
+        # last_time_access_token_fetched is auto_now, so it can only be moved back with update().
+        WrikeOauth2Credentials.objects.update(last_time_access_token_fetched=timezone.now() - age)
+
+    def test_fresh_token_is_used(self):
+        self.assertEqual(self.provider.get_token(), 'stored-token')
+        self.assertEqual(self.server.refreshes, [])
+
+    def test_expiring_token_is_refreshed(self):
+        self.expire_stored_token()
+        self.assertEqual(self.provider.get_token(), 'access-token-1')
+        self.assertEqual(self.server.refreshes, ['stored-refresh-token'])
+        cred = WrikeOauth2Credentials.objects.get()
+        self.assertEqual((cred.access_token, cred.refresh_token), ('access-token-1', 'refresh-token-1'))
+        # The new token is handed out from memory until it expires in turn.
+        self.assertEqual(self.provider.get_token(), 'access-token-1')
+        self.assertEqual(len(self.server.refreshes), 1)
+
+    def test_invalidated_token_is_refreshed(self):
+        self.assertEqual(self.provider.get_token(), 'stored-token')
+        # A token that has already been replaced is ignored.
+        self.provider.invalidate('older-token')
+        self.assertEqual(self.provider.get_token(), 'stored-token')
+        self.provider.invalidate('stored-token')
+        self.assertEqual(self.provider.get_token(), 'access-token-1')
+
+    def test_failed_refresh_is_not_retried_straight_away(self):
+        # The stored token is about to expire but still valid.
+        self.expire_stored_token(age=timedelta(minutes=59))
+        self.server.error = 'invalid_grant'
+        self.assertEqual(self.provider.get_token(), 'stored-token')
+        self.assertEqual(self.provider.get_token(), 'stored-token')
+        self.assertEqual(len(self.server.refreshes), 1)
+        self.server.error = None
+        with override_settings(WRIKE_ACCESS_TOKEN_RETRY_DELAY=0):
+            self.assertEqual(self.provider.get_token(), 'access-token-2')
+
+    def test_expired_token_is_not_handed_out(self):
+        self.expire_stored_token()
+        self.server.error = 'invalid_grant'
+        self.assertRaises(TokenUnavailable, self.provider.get_token)
+        self.assertRaises(TokenUnavailable, self.provider.get_token)
+        self.assertEqual(len(self.server.refreshes), 1)
+
+    def test_rejected_token_is_not_handed_out(self):
+        self.assertEqual(self.provider.get_token(), 'stored-token')
+        self.provider.invalidate('stored-token')
+        # The token endpoint can't be reached either.
+        with override_settings(WRIKE_ACCESS_TOKEN_URL='http://127.0.0.1:1/oauth2/token'):
+            self.assertRaises(TokenUnavailable, self.provider.get_token)
+        self.assertRaises(TokenUnavailable, self.provider.get_token)
+        self.assertEqual(self.server.refreshes, [])
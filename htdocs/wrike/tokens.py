@@ -0,0 +1,139 @@
+import datetime
+import json
+import logging
+import threading
+import time
+import requests
+
+from django.conf import settings
+from django.utils.timezone import utc
+
+from django.contrib.auth.models import User
+
+from .models import WrikeOauth2Credentials
+
+logger = logging.getLogger(__name__)
+
+
+class TokenUnavailable(Exception):
+    pass
+
+
+class WrikeTokenProvider(object):
+    """
+    Hands out the wrike access token of the WRIKE_API_USER_ACCOUNT user.
+
+    The token is cached in memory together with its expiry so that callers don't
+    hit the db every time. It is refreshed WRIKE_ACCESS_TOKEN_REFRESH_MARGIN seconds
+    before it expires; only one caller refreshes it while the others wait for the
+    new token. After a failed refresh the old token is handed out, without trying
+    again for WRIKE_ACCESS_TOKEN_RETRY_DELAY seconds, until it expires.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expires_at = None
+        self._force_refresh = False
+        self._refresh_failed_at = None
+
+    def get_token(self):
+        """
+        Raises TokenUnavailable if there is no token that hasn't expired, e.g.
+        because it couldn't be refreshed.
+        """
+        access_token = self._access_token
+        if access_token and not self._needs_refresh():
+            return access_token
+
+        with self._lock:
+            # Another caller may have refreshed the token while this one was waiting.
+            if self._access_token is None or self._needs_refresh():
+                self._load()
+            if self._access_token is None or self._is_expired():
+                raise TokenUnavailable("There is no valid Wrike access token for %s" % settings.WRIKE_API_USER_ACCOUNT)
+            return self._access_token
+
+    def invalidate(self, access_token):
+        """
+        Forces a refresh on the next get_token(), e.g. after Wrike has rejected
+        the token. Tokens that have already been replaced are ignored.
+        """
+        with self._lock:
+            if self._access_token == access_token:
+                self._access_token = None
+                self._expires_at = None
+                self._force_refresh = True
+
+    def _is_expiring(self):
+        now_utc = datetime.datetime.utcnow().replace(tzinfo=utc)
+        margin = datetime.timedelta(seconds=settings.WRIKE_ACCESS_TOKEN_REFRESH_MARGIN)
+        return self._expires_at is None or now_utc >= self._expires_at - margin
+
+    def _is_expired(self):
+        now_utc = datetime.datetime.utcnow().replace(tzinfo=utc)
+        return self._expires_at is None or now_utc >= self._expires_at
+
+    def _is_backing_off(self):
+        return self._refresh_failed_at is not None and \
+            time.time() - self._refresh_failed_at < settings.WRIKE_ACCESS_TOKEN_RETRY_DELAY
+
+    def _needs_refresh(self):
+        # While backing off, a token that is only expiring is used as it is.
+        return self._is_expiring() and (self._is_expired() or not self._is_backing_off())
+
+    def _load(self):
+        user = User.objects.get(username=settings.WRIKE_API_USER_ACCOUNT)
+        cred = WrikeOauth2Credentials.objects.get_or_none(pk=user.pk)
+        if cred is None:
+            self._access_token = None
+            self._expires_at = None
+            return
+
+        # The token in the db may have been refreshed by another process.
+        self._access_token = cred.access_token
+        self._expires_at = cred.last_time_access_token_fetched + \
+            datetime.timedelta(seconds=settings.WRIKE_ACCESS_TOKEN_LIFETIME)
+        if not (self._force_refresh or self._is_expiring()):
+            return
+        if self._is_backing_off():
+            if self._force_refresh:
+                # Wrike has rejected the token.
+                self._access_token = None
+            return
+        self._refresh(cred)
+
+    def _refresh(self, cred):
+        data = {
+            "client_id": settings.WRIKE_OAUTH2_CLIENT_ID,
+            "client_secret": settings.WRIKE_OAUTH2_CLIENT_SECRET,
+            "grant_type": "refresh_token",
+            "refresh_token": cred.refresh_token
+        }
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        try:
+            result = requests.post(settings.WRIKE_ACCESS_TOKEN_URL, data=data, headers=headers,
+                                   timeout=(settings.WRIKE_HTTP_CONNECT_TIMEOUT, settings.WRIKE_HTTP_READ_TIMEOUT))
+            result_json = json.loads(result.text)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            result_json = {"error": e}
+
+        if result_json.get("error", None) is not None:
+            logger.error("Wrike access token refresh failed: %s" % result_json.get("error_description", result_json["error"]))
+            self._refresh_failed_at = time.time()
+            if self._force_refresh:
+                self._access_token = None
+            return
+
+        cred.access_token = result_json['access_token']
+        # Wrike may hand out a new refresh token along with the access token.
+        cred.refresh_token = result_json.get('refresh_token', cred.refresh_token)
+        cred.save()
+
+        lifetime = result_json.get('expires_in', settings.WRIKE_ACCESS_TOKEN_LIFETIME)
+        self._access_token = cred.access_token
+        self._expires_at = cred.last_time_access_token_fetched + datetime.timedelta(seconds=lifetime)
+        self._force_refresh = False
+        self._refresh_failed_at = None
+
+
+token_provider = WrikeTokenProvider()
@@ -13,6 +13,10 @@ urlpatterns = [
     url(r'^support_by_country/$', SupportByCountry.as_view(), name='support_by_country'),
     url(r'^support_by_region/$', SupportByRegion.as_view(), name='support_by_region'),
     url(r'^support_by_person/$', SupportCompletedByPerson.as_view(), name='support_by_person'),
+    url(r'^support_by_customfield/(?P<customfield_id>[\w-]+)/$', SupportByCustomField.as_view(),
+        name='support_by_customfield'),
+    url(r'^sync_runs/$', SyncRuns.as_view(), name='sync_runs'),
+    url(r'^webhook/$', csrf_exempt(WrikeWebhook.as_view()), name='wrike_webhook'),
     #url(r'^pr/edit/(?P<pk>\d+)/$', PurchaseRequestUpdateView.as_view(), name='pr_edit'),
 ]
 
@@ -1,354 +1,904 @@
 import datetime
-import requests
+import functools
+import itertools
+import os
+import shutil
+import tempfile
+import time
 import json
 import logging
-import pytz
+import Queue
+
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
-from django.apps import apps
+from django.db import connections
 
 from django.utils import timezone
 from django.utils.timezone import utc
-from django.utils.encoding import smart_text
 
 from django.contrib.auth.models import User
 
-from .models import WrikeOauth2Credentials, CustomField, Contact, Folder, Task, CustomFieldTask, CustomFieldFolder
+from .models import WrikeOauth2Credentials, CustomField, Contact, Folder, Task, CustomFieldTask, CustomFieldFolder, \
+    SyncCheckpoint, SyncRun, SyncStageRun, WebhookUpdate
+from .bulk import chunked, clear_content_hashes, get_content_hash, get_existing_ids, bulk_upsert, bulk_upsert_values, \
+    reconcile_m2m, reconcile_tombstones, write_transaction
+from .facts import update_support_facts
+from .hierarchy import update_folder_closure
+from .streaming import JsonItems
+from .tokens import token_provider
+from .transformers import get_transformer, to_text
+from . import archive, client, report_cache, staging, telemetry, webhooks
 
 logger = logging.getLogger(__name__)
 mail_logger = logging.getLogger('app_admins')
 
+# The SyncCheckpoint entity of each sync stage, which records the stage's last run.
+STAGE_ENTITIES = {
+    "Custom Fields": "custom_fields",
+    "Contacts": "contacts",
+    "Folders": "folders",
+    "Tasks": "tasks",
+    "Deletions": "task_ids",
+    "Webhook Updates": "webhook_updates",
+    "Support Facts": "support_facts",
+}
+
+# The archive entity names of the three folder listings fetched by process_wrike_folders.
+FOLDER_ARCHIVE_ENTITIES = ("folders_all", "projects", "folders")
+
 def get_wrike_access_token():
     """
-    If the access token is older than one hour, then fetch a new one since
-    they get expired after one hour.
+    Returns the current access token; see tokens.WrikeTokenProvider.
     """
-    user = User.objects.get(username=settings.WRIKE_API_USER_ACCOUNT)
-    cred = WrikeOauth2Credentials.objects.get_or_none(pk=user.pk)
-    if cred:
-        now_utc = datetime.datetime.utcnow().replace(tzinfo=utc)
-        diff = now_utc - cred.last_time_access_token_fetched
-        # if it has been more than 59 minutes, get a new access_token
-        if diff.seconds >= 3540:
-            data = {
-                "client_id": settings.WRIKE_OAUTH2_CLIENT_ID,
-                "client_secret": settings.WRIKE_OAUTH2_CLIENT_SECRET,
-                "grant_type": "refresh_token",
-                "refresh_token": cred.refresh_token
-            }
-            headers = {'Content-Type': 'application/x-www-form-urlencoded'} #{'Content-Type': 'application/json'}
-            result = requests.post(settings.WRIKE_ACCESS_TOKEN_URL, data=data, headers=headers)
-            result_json = json.loads(result.text)
-
-            if result_json.get("error", None) is None:
-                defaults = {
-                    "access_token": result_json['access_token'],
-                }
-                cred.access_token = result_json['access_token']
-                cred.save()
-        return cred.access_token
-    return None
+    return token_provider.get_token()
 
 
+def get_sync_stages(full=False):
+    """
+    Returns the sync stages as (name, function, names of the stages it depends on).
+    """
+    return (
+        ("Custom Fields", lambda: process_wrike_custom_fields(full), ()),
+        ("Contacts", lambda: process_wrike_contacts(full), ()),
+        ("Folders", process_wrike_folders, ("Custom Fields", "Contacts")),
+        ("Tasks", lambda: process_wrike_tasks(full), ("Custom Fields", "Contacts", "Folders")),
+        ("Deletions", lambda: process_wrike_task_deletions(full), ("Tasks",)),
+        ("Webhook Updates", process_wrike_webhook_updates, ("Folders", "Tasks")),
+        # The charts' fact table is rebuilt once everything else has been stored.
+        ("Support Facts", update_support_facts, ("Folders", "Tasks", "Deletions", "Webhook Updates")),
+    )
+
+
+def process_wrike_data(full=False, stage_names=None):
+    """
+    Runs all of the sync stages. Stages that do not depend on each other run
+    concurrently; a stage starts once all of the stages it depends on are done.
+    If `stage_names` is given, only those stages run and their dependencies on
+    the other stages are taken to be met by earlier runs; the Support Facts stage
+    always runs last so that the charts reflect whatever was synced.
+
+    The run and its stages are recorded as a SyncRun and SyncStageRuns, and the
+    fetched pages are archived under the run's id; the old runs and archives are
+    pruned afterwards.
+    """
+    stages = get_sync_stages(full)
+    if stage_names is not None:
+        stage_names = list(stage_names) + ["Support Facts"]
+        stages = tuple((name, func, tuple(dependency for dependency in dependencies if dependency in stage_names))
+                       for name, func, dependencies in stages if name in stage_names)
+    run = SyncRun.objects.create(started=timezone.now(), full=full)
+    # The raw pages are archived so that the mirror can be rebuilt from them offline.
+    archive.activate(run.pk)
+    try:
+        results = run_sync_stages(stages, run)
+    finally:
+        archive.deactivate()
+    if run.stages.filter(name__in=("Contacts", "Folders"), rows_inserted__gt=0).exists():
+        queue_unresolved_tasks()
+    run.finished = timezone.now()
+    run.duration = (run.finished - run.started).total_seconds()
+    run.success = all(results.values())
+    run.save()
+
+    full_run_ids = list(SyncRun.objects.filter(full=True).values_list('pk', flat=True)
+                        [:settings.WRIKE_ARCHIVE_KEEP_FULL_RUNS])
+    archive.prune(also_keep=full_run_ids)
+    prune_sync_runs(full_run_ids)
+    return run.success
+
+
+def queue_unresolved_tasks():
+    """
+    Queues the tasks that were stored without some of their folders or contacts,
+    i.e. those without a content hash, to be fetched again by the Webhook Updates
+    stage now that new folders or contacts have been stored. Incremental syncs
+    only list the tasks that have been updated in Wrike, so they wouldn't be
+    retried otherwise.
+    """
+    task_ids = list(Task.objects.filter(content_hash__isnull=True, tombstoned=False)
+                    .values_list('pk', flat=True))
+    now = timezone.now()
+    for task_id in task_ids:
+        WebhookUpdate.objects.update_or_create(entity=WebhookUpdate.TASK, wrike_id=task_id,
+                                               defaults=webhooks.get_queued_values(now))
+    if task_ids:
+        logger.info("Wrike tasks: %s queued to be fetched again for their new folders and contacts" % len(task_ids))
 
-def get_model_fields_names(model_name):
-    model = apps.get_model(app_label='wrike', model_name=model_name)
-    cols = model._meta.get_fields()
-    col_names = []
-    for col in cols:
-        col_names.append(col.name)
-    return col_names
 
+def prune_sync_runs(also_keep=()):
+    """
+    Deletes the SyncRuns, and their SyncStageRuns, that started more than
+    WRIKE_SYNC_RUN_KEEP_DAYS days ago, except the runs in `also_keep`.
+    """
+    cutoff = timezone.now() - datetime.timedelta(days=settings.WRIKE_SYNC_RUN_KEEP_DAYS)
+    run_ids = list(SyncRun.objects.filter(started__lt=cutoff).exclude(pk__in=also_keep)
+                   .values_list('pk', flat=True))
+    for chunk in chunked(run_ids):
+        SyncRun.objects.filter(pk__in=chunk).delete()
 
-def process_wrike_data():
-    if process_wrike_custom_fields() == False:
-        mail_logger.error("Wrike Custom Fields Fetch and Processing Failed")
 
-    if process_wrike_contacts() == False:
-        mail_logger.error("Wrike Contacts Fetch and processing failed")
+def replay_wrike_data(run_ids):
+    """
+    Rebuilds the mirror from the archived pages of the given sync runs, in the
+    given order, without calling the Wrike api. Every archived row is rewritten,
+    e.g. to fill in columns that have been added since it was archived.
+    """
+    for run_id in run_ids:
+        if not archive.PayloadArchive(run_id).exists():
+            logger.error("There is no archive of Wrike sync run %s" % run_id)
+            return False
 
-    if process_wrike_folders() == False:
-        mail_logger.error("Wrike Folders Fetch and processing failed")
+    for model in (CustomField, Contact, Folder, Task):
+        model.objects.update(content_hash=None)
 
-    if process_wrike_tasks() == False:
-        mail_logger.error("Wrike Tasks Fetch and processing failed")
+    success = True
+    for run_id in run_ids:
+        pages = archive.PayloadArchive(run_id)
+        logger.info("Replaying Wrike sync run %s from %s" % (run_id, pages.path))
+        stages = (
+            ("Custom Fields", "custom_fields",
+             lambda: all(store_wrike_custom_fields(page, full=True) for page in pages.iter_pages("custom_fields"))),
+            ("Contacts", "contacts",
+             lambda: all(store_wrike_contacts(page, full=True) for page in pages.iter_pages("contacts"))),
+            ("Folders", "projects",
+             lambda: store_wrike_folders(*[pages.get_items(entity) for entity in FOLDER_ARCHIVE_ENTITIES])),
+            ("Tasks", "tasks", lambda: store_wrike_tasks(pages.iter_pages("tasks"))),
+            ("Deletions", "task_ids",
+             lambda: tombstone_deleted_rows("tasks", Task, [pk for page in pages.iter_pages("task_ids")
+                                                             for pk in get_listed_page_ids(page)])),
+        )
+        for name, entity, func in stages:
+            # Stages that failed before fetching anything have nothing to replay.
+            if pages.has_pages(entity):
+                success = run_sync_stage(name, func)[1] and success
+    success = run_sync_stage("Support Facts", update_support_facts)[1] and success
+    report_cache.bump_data_version()
+    return success
 
 
-def process_wrike_custom_fields():
+def run_sync_stage(name, func):
+    stats = telemetry.StageStats(name)
+    telemetry.bind(stats)
+    started = timezone.now()
+    try:
+        success = func() != False
+    except Exception as e:
+        logger.error(e)
+        success = False
+    finally:
+        telemetry.bind(None)
+        # Each stage runs on its own thread, which has its own db connections.
+        for conn in connections.all():
+            conn.close()
+    finished = timezone.now()
+    logger.info("Wrike %s stage finished in %.2fs: %s" % (
+        name, (finished - started).total_seconds(), stats.get_counters()))
+    if success == False:
+        mail_logger.error("Wrike %s Fetch and processing failed" % name)
+    return (name, success, started, finished, stats)
+
+
+def run_sync_stages(stages, run=None):
+    """
+    Runs the (name, function, dependencies) stages on a thread pool and returns
+    a dictionary of {name: success}. The last run of each stage is recorded on
+    its SyncCheckpoint and, if a SyncRun is given, as a SyncStageRun. If any
+    stage inserted or updated rows, the cached chart data is invalidated.
+    """
+    start_time = time.time()
+    results = {}
+    pending = list(stages)
+    finished = Queue.Queue()
+    running = 0
+    stage_runs = []
+    last_runs = []
+    changed = False
+    pool = ThreadPool(settings.WRIKE_SYNC_POOL_SIZE)
+    try:
+        while pending or running:
+            for stage in list(pending):
+                name, func, dependencies = stage
+                if all(dependency in results for dependency in dependencies):
+                    pending.remove(stage)
+                    pool.apply_async(run_sync_stage, (name, func), callback=finished.put)
+                    running += 1
+            if running == 0:
+                # The remaining stages depend on stages that don't exist.
+                for name, func, dependencies in pending:
+                    logger.error("Wrike %s stage has unmet dependencies: %s" % (name, dependencies))
+                    results[name] = False
+                break
+            name, success, stage_started, stage_finished, stats = finished.get()
+            results[name] = success
+            running -= 1
+            last_runs.append((name, success, stage_started, stage_finished))
+            counters = stats.get_counters()
+            changed = changed or counters['inserted'] > 0 or counters['updated'] > 0
+            if run is not None:
+                stage_runs.append(SyncStageRun(
+                    run=run, name=name, started=stage_started, finished=stage_finished,
+                    duration=(stage_finished - stage_started).total_seconds(),
+                    success=success, **telemetry.get_stage_run_values(counters)))
+    finally:
+        pool.close()
+        pool.join()
+        # The charts also show e.g. the names of contacts and folders and the values of
+        # custom fields, so any change, not only one to the support facts, invalidates them.
+        if changed:
+            report_cache.bump_data_version()
+    # Written once all the stages are done so that they don't compete for SQLite's write lock.
+    SyncStageRun.objects.bulk_create(stage_runs)
+    for name, success, stage_started, stage_finished in last_runs:
+        if name in STAGE_ENTITIES:
+            update_sync_checkpoint(STAGE_ENTITIES[name], last_started=stage_started,
+                                   last_finished=stage_finished, last_success=success)
+    logger.info("Wrike sync finished in %.2fs; api usage so far: %s" % (
+        time.time() - start_time, client.get_client().get_counters()))
+    return results
+
+
+def process_wrike_custom_fields(full=False):
     """
     Fetches custom_fields from Wrike's Mercy Corps account and stores them.
+    Nothing is written if the response is the same as last time, unless `full` is True.
     """
     try:
-        access_token = get_wrike_access_token()
-        headers = {"Authorization": "bearer %s" % access_token}
-        custom_fields = requests.get(settings.WRIKE_CUSTOMFIELDS_API_URL, headers=headers)
+        custom_fields = client.get(settings.WRIKE_CUSTOMFIELDS_API_URL)
+        archive.record("custom_fields", custom_fields.content)
         custom_fields_json = json.loads(custom_fields.text)
     except Exception as e:
         logger.error(e)
         return False
 
-    db_col_names = get_model_fields_names('CustomField')
+    return store_wrike_custom_fields(custom_fields_json, full)
+
 
+def store_wrike_custom_fields(custom_fields_json, full=False):
     try:
         data = custom_fields_json['data'][0]['customFields']
     except Exception as e:
         logger.error(e)
         return False
 
-    for row in data:
-        db_row = {}
-        for col,val in row.iteritems():
-            if col in db_col_names: db_row[col] = smart_text(val)
-        try:
-            field, created = CustomField.objects.update_or_create(id=row['id'], defaults=db_row)
-        except Exception as e:
-            logger.error(e)
-            return False
-    return True
+    return process_wrike_rows("custom_fields", CustomField, data, full)
 
 
-def process_wrike_contacts():
+def process_wrike_contacts(full=False):
     """
     Fetches contacts(users) from Wrike's Mercy Corps account and stores them.
+    Nothing is written if the response is the same as last time, unless `full` is True.
     """
     try:
-        access_token = get_wrike_access_token()
-        headers = {"Authorization": "bearer %s" % access_token}
-        contacts = requests.get(settings.WRIKE_CONTACT_API_URL, headers=headers)
+        contacts = client.get(settings.WRIKE_CONTACT_API_URL)
+        archive.record("contacts", contacts.content)
         contacts_json = json.loads(contacts.text)
     except Exception as e:
         logger.error(e)
         return False
 
-    db_col_names = get_model_fields_names('Contact')
+    return store_wrike_contacts(contacts_json, full)
 
+
+def store_wrike_contacts(contacts_json, full=False):
     try:
         data = contacts_json['data']
     except Exception as e:
         logger.error(e)
         return False
 
+    return process_wrike_rows("contacts", Contact, data, full)
+
+
+def process_wrike_rows(entity, model, data, full=False):
+    """
+    Stores the rows of a wrike endpoint that is fetched in one go, i.e. custom
+    fields and contacts, whose columns map one to one onto the model's fields.
+    """
+    content_hash = get_content_hash(data)
+    checkpoint = get_sync_checkpoint(entity)
+    if not full and checkpoint and checkpoint.content_hash == content_hash:
+        logger.info("Wrike %s haven't changed since the last sync" % entity)
+        return True
+
+    transformer = get_transformer(model)
+    rows = {}
     for row in data:
-        db_row = {}
-        for col,val in row.iteritems():
-            if col in db_col_names: db_row[col] = smart_text(val)
-        try:
-            contact, created = Contact.objects.update_or_create(id=row['id'], defaults=db_row)
-        except Exception as e:
-            logger.error(e)
-            return False
-    return True
+        db_row = transformer.transform(row)
+        db_row["content_hash"] = get_content_hash(row)
+        rows[row['id']] = db_row
 
+    start_time = time.time()
+    try:
+        with write_transaction(model):
+            inserted, updated, unchanged = bulk_upsert(model, rows)
+            update_sync_checkpoint(entity, content_hash=content_hash)
+    except Exception as e:
+        logger.error(e)
+        telemetry.record(failed=len(rows), db_seconds=time.time() - start_time)
+        return False
+    telemetry.record(inserted=len(inserted), updated=len(updated), unchanged=len(unchanged),
+                     db_seconds=time.time() - start_time)
+    logger.info("Wrike %s: %s inserted, %s updated, %s unchanged" % (
+        entity, len(inserted), len(updated), len(unchanged)))
+    return True
 
 
 def process_wrike_folders():
     """
     Fetches Wrike Folders and Projects.
     """
-    success = True
-
     # First, get a list of all folders and projects to make sure in subsequent calls
     # we don't run into parentIds that have not yet been created. This call does not
     # retrieve parentIds or customFields because Wrike does not include these two attributes
     # in API calls that query all folders/projects under an Account ID
+    urls = (
+        settings.WRIKE_FOLDER_AND_PROJECTS_API_URL,
+        settings.WRIKE_PROJECT_API_URL,
+        settings.WRIKE_FOLDER_API_URL,
+    )
+    # The three listings are downloaded at the same time, each into a file, and are
+    # decoded a row at a time from there, so that none of them is held in memory.
+    download_dir = tempfile.mkdtemp(prefix="wrike-folders-")
+    paths = [os.path.join(download_dir, "%s.json" % entity) for entity in FOLDER_ARCHIVE_ENTITIES]
+    try:
+        try:
+            client.download_many(zip(urls, paths, FOLDER_ARCHIVE_ENTITIES))
+        except Exception as e:
+            logger.error(e)
+            return False
+        return store_wrike_folders(*[JsonItems(path) for path in paths])
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+
+def store_wrike_folders(all_folders, projects, folders):
+    """
+    Stores the rows of the three folder listings fetched by process_wrike_folders.
+    The listings can be iterated over more than once, and are written
+    WRIKE_FOLDER_BATCH_SIZE rows at a time; only their ids are kept in memory.
+    """
+    batch_size = settings.WRIKE_FOLDER_BATCH_SIZE
     try:
-        access_token = get_wrike_access_token()
-        headers = {"Authorization": "bearer %s" % access_token}
-        all_folders = requests.get(settings.WRIKE_FOLDER_AND_PROJECTS_API_URL, headers=headers)
-        all_folders_json = json.loads(all_folders.text)
+        # First pass: only the missing folders are created, so that all of the parentIds
+        # in the second pass exist. The rest are refreshed from the complete rows below
+        # so that their content hashes stay comparable.
+        live_ids = []
+        for batch in chunked(all_folders, batch_size):
+            success = process_wrike_folder_and_projects_helper(batch, create_only=True)
+            if success == False: return success
+            live_ids.extend(get_listed_ids(batch))
+
+        # Second pass: the projects and the folders, which include parentIds and customFields,
+        # if any, are stored in the folders table.
+        stored_ids = set()
+        for batch in chunked(itertools.chain(projects, folders), batch_size):
+            success = process_wrike_folder_and_projects_helper(batch)
+            if success == False: return success
+            stored_ids.update(row['id'] for row in batch)
+
+        # Folders that are only listed in the first call (e.g. the account's root folders)
+        # are refreshed from the rows of that call.
+        for batch in chunked((row for row in all_folders if row['id'] not in stored_ids), batch_size):
+            success = process_wrike_folder_and_projects_helper(batch)
+            if success == False: return success
     except Exception as e:
         logger.error(e)
         return False
 
-    success = process_wrike_folder_and_projects_helper(all_folders_json['data'])
-    if success == False: return success
+    # The first call lists every folder and project, so the ones that are missing
+    # from it have been deleted in Wrike.
+    if tombstone_deleted_rows("folders", Folder, live_ids) == False:
+        return False
+    return update_folder_closure()
+
+
+def get_listed_ids(data):
+    """
+    Returns the ids of the listed rows, leaving out those in Wrike's Recycle Bin,
+    i.e. the deleted ones, whose scopes start with "Rb".
+    """
+    return [row['id'] for row in data if not (row.get('scope', None) or '').startswith('Rb')]
+
+
+def get_listed_page_ids(page):
+    """
+    Returns the ids listed on a page of an id listing. A page without a `data`
+    list, e.g. an error body, raises a ValueError rather than passing for an
+    empty page: rows that are missing from an incomplete listing would be
+    tombstoned.
+    """
+    data = page.get('data', None)
+    if not isinstance(data, list):
+        raise ValueError("Wrike returned a page without data: %s" % str(page)[:200])
+    return get_listed_ids(data)
+
 
+def tombstone_deleted_rows(entity, model, remote_ids):
+    """
+    Tombstones the rows that Wrike no longer lists, and revives those that it
+    lists again.
+    """
+    start_time = time.time()
     try:
-        # Second, fetch all projects from Wrike; this call includes parentIds, which should
-        # already be created in the first step above. It also includes customFields, if any.
-        projects = requests.get(settings.WRIKE_PROJECT_API_URL, headers=headers)
-        projects_json = json.loads(projects.text)
-
-        # Third, fetch all folders from Wrike; this call includes parentIds, which should
-        # already be created in the first step above. It also includes customFields, if any.
-        folders = requests.get(settings.WRIKE_FOLDER_API_URL, headers=headers)
-        folders_json = json.loads(folders.text)
-
-        # Finally, combine the two lists from projects and folders together and store
-        # them in the folders table.
-        data = projects_json['data'] + folders_json['data']
+        with write_transaction(model):
+            tombstoned, revived, differing, ranges = reconcile_tombstones(model, remote_ids)
     except Exception as e:
         logger.error(e)
         return False
-    success = process_wrike_folder_and_projects_helper(data)
-    return success
+    telemetry.record(updated=tombstoned + revived, db_seconds=time.time() - start_time)
+    logger.info("Wrike %s: %s tombstoned, %s revived; %s of %s id ranges differed" % (
+        entity, tombstoned, revived, differing, ranges))
+    return True
 
 
-def process_wrike_folder_and_projects_helper(data):
+def process_wrike_folder_and_projects_helper(data, create_only=False):
     """
     This is a helper method to process wrike's folder and project data in db.
+    Rows whose content hash hasn't changed since the last sync are skipped; if
+    `create_only` is True, only the folders that don't exist yet are written.
     """
-    db_col_names = get_model_fields_names('Folder')
-
-    parents_mapping = []
+    transformer = get_transformer(Folder)
+    customfield_ids = set(CustomField.objects.values_list('id', flat=True))
+    if create_only:
+        existing_ids = get_existing_ids(Folder, [row['id'] for row in data])
+        data = [row for row in data if row['id'] not in existing_ids]
+
+    folder_rows = {}
+    # Folders whose custom fields / parents / project owners are given in this batch and
+    # their desired values and (folder, parent) and (folder, contact) pairs; these are
+    # reconciled at the end.
+    customfield_folder_ids = set()
+    customfield_values = {}
+    parent_folder_ids = set()
+    parent_pairs = set()
+    assignee_folder_ids = set()
+    assignee_pairs = set()
     for row in data:
-        db_row = {}
-        customfields = None
+        db_row = transformer.transform(row)
+        customfields = row.get("customFields", None)
         project_assignee_ids = []
 
-        for col,val in row.iteritems():
-            if col == "project":
-                db_row["status"] = smart_text(val['status'])
-                timestamp = datetime.datetime.strptime(val['createdDate'][:19], "%Y-%m-%dT%H:%M:%S")
-                timestamp = timestamp.replace(tzinfo=pytz.UTC)
-                db_row["createdDate"] = timestamp
-                if val.get("startDate", None): db_row["startDate"] = val["startDate"]
-                if val.get("endDate", None): db_row["endDate"] = val["endDate"]
-                if val.get("completedDate", None):
-                    completedDate = datetime.datetime.strptime(val['completedDate'][:19], "%Y-%m-%dT%H:%M:%S")
-                    completedDate = completedDate.replace(tzinfo=pytz.UTC)
-                    db_row["completedDate"] = completedDate
-                ownerIds = val.get("ownerIds", None)
-                for ownerId in ownerIds or []:
-                    project_assignee_ids.append(ownerId)
-            elif col == "parentIds":
-                parents_mapping.append({"id":row['id'], "parentIds": val})
-            elif col == "customFields":
-                customfields = val
-            if col in db_col_names: db_row[col] = smart_text(val)
-
-        try:
-            folder, created = Folder.objects.update_or_create(id=row['id'], defaults=db_row)
-            if project_assignee_ids:
-                folder.assignees.clear()
-                for assignee_id in project_assignee_ids:
-                    assignee = Contact.objects.get(id=assignee_id)
-                    folder.assignees.add(assignee)
-        except Exception as e:
-            logger.error(e)
-            return False
-
-        # Associate task with custom_fields and its values
+        project = row.get("project", None)
+        if project:
+            # The status and dates of projects are columns of the folder.
+            db_row.update(transformer.transform(project))
+            project_assignee_ids = project.get("ownerIds", None) or []
+        if "customFields" in row:
+            customfield_folder_ids.add(row['id'])
+        if "parentIds" in row:
+            parent_folder_ids.add(row['id'])
+            parent_pairs.update((row['id'], pid) for pid in row["parentIds"])
+
+        db_row["content_hash"] = get_content_hash(row)
+        folder_rows[row['id']] = db_row
+
+        if project_assignee_ids:
+            assignee_folder_ids.add(row['id'])
+            assignee_pairs.update((row['id'], assignee_id) for assignee_id in project_assignee_ids)
+
+        # Associate folder with custom_fields and its values
         for field in customfields or []:
-            val = smart_text(field['value'])
+            val = to_text(field['value'])
             if val is None or val == "":
                 continue
-            try:
-                customfield = CustomField.objects.get(pk=field['id'])
-                cff, created = CustomFieldFolder.objects.update_or_create(folder=folder, customfield=customfield, defaults={'value': val})
-            except Exception as e:
-                logger.error(e)
+            if field['id'] not in customfield_ids:
+                logger.error("CustomField matching query does not exist: %s" % field['id'])
                 continue
+            customfield_values[(row['id'], field['id'])] = val
 
-    for mapping in parents_mapping:
-        folder = Folder.objects.get(pk=mapping.get("id"))
-        folder.parents.clear()
-        parentIds = mapping.get("parentIds")
-        for pid in parentIds:
-            try:
-                parent = Folder.objects.get(pk=pid)
-                folder.parents.add(parent)
-            except Exception as e:
-                logger.warn("%s: %s" % (pid, e))
-                continue
+    start_time = time.time()
+    try:
+        with write_transaction(Folder):
+            inserted, updated, unchanged = bulk_upsert(Folder, folder_rows)
+
+            # The relations of unchanged folders are the same as last time.
+            customfield_folder_ids -= unchanged
+            customfield_values = dict(item for item in customfield_values.iteritems() if item[0][0] not in unchanged)
+            parent_folder_ids -= unchanged
+            parent_pairs = set(pair for pair in parent_pairs if pair[0] not in unchanged)
+            assignee_folder_ids -= unchanged
+            assignee_pairs = set(pair for pair in assignee_pairs if pair[0] not in unchanged)
+
+            # Drop the pairs that point at parents or contacts we don't have; the folders
+            # that had any are rewritten by the next sync, which may have them by then.
+            unresolved_ids = set()
+            parent_ids = get_existing_ids(Folder, set(pid for folder_id, pid in parent_pairs))
+            for folder_id, pid in parent_pairs:
+                if pid not in parent_ids:
+                    logger.warn("%s: Folder matching query does not exist." % pid)
+                    unresolved_ids.add(folder_id)
+            contact_ids = get_existing_ids(Contact, set(cid for folder_id, cid in assignee_pairs))
+            for folder_id, cid in assignee_pairs:
+                if cid not in contact_ids:
+                    logger.error("%s: Contact matching query does not exist." % cid)
+                    unresolved_ids.add(folder_id)
+
+            bulk_upsert_values(CustomFieldFolder, 'folder', customfield_folder_ids, customfield_values)
+            reconcile_m2m(Folder, 'parents', parent_folder_ids,
+                          set(pair for pair in parent_pairs if pair[1] in parent_ids))
+            reconcile_m2m(Folder, 'assignees', assignee_folder_ids,
+                          set(pair for pair in assignee_pairs if pair[1] in contact_ids))
+            clear_content_hashes(Folder, unresolved_ids)
+    except Exception as e:
+        logger.error(e)
+        telemetry.record(failed=len(folder_rows), db_seconds=time.time() - start_time)
+        return False
+    telemetry.record(inserted=len(inserted), updated=len(updated), unchanged=len(unchanged),
+                     db_seconds=time.time() - start_time)
 
+    logger.info("Wrike folders: %s inserted, %s updated, %s unchanged" % (
+        len(inserted), len(updated), len(unchanged)))
     return True
 
 
+def get_sync_checkpoint(entity):
+    return SyncCheckpoint.objects.get_or_none(pk=entity)
+
+
+def update_sync_checkpoint(entity, **values):
+    SyncCheckpoint.objects.update_or_create(entity=entity, defaults=values)
+
 
+def get_sync_watermark(entity):
+    """
+    Returns the high-water mark of the last successful sync of the entity, if any.
+    """
+    checkpoint = get_sync_checkpoint(entity)
+    if checkpoint:
+        return checkpoint.watermark
+    return None
+
+
+def set_sync_watermark(entity, watermark):
+    update_sync_checkpoint(entity, watermark=watermark)
 
-def process_wrike_tasks():
+
+def get_wrike_tasks_url(full=False):
+    """
+    Returns the url for fetching tasks. Unless a full resync is requested, only
+    the tasks updated since the last successful sync are asked for; the mark is
+    moved back by WRIKE_SYNC_WATERMARK_OVERLAP to tolerate clock skew and tasks
+    that were being updated while the previous sync was running.
     """
-    Fetch tasks from wrike's api.
+    watermark = None if full else get_sync_watermark("tasks")
+    if watermark is None:
+        return settings.WRIKE_TASK_API_URL
+
+    since = watermark - datetime.timedelta(seconds=settings.WRIKE_SYNC_WATERMARK_OVERLAP)
+    updated_date = json.dumps({"start": since.strftime("%Y-%m-%dT%H:%M:%SZ")}, separators=(',', ':'))
+    return "%s&%s=%s" % (settings.WRIKE_TASK_API_URL, "updatedDate", updated_date)
+
+
+def get_wrike_tasks_urls(full=False):
     """
-    access_token = get_wrike_access_token()
-    headers = {"Authorization": "bearer %s" % access_token}
-    tasks = requests.get(settings.WRIKE_TASK_API_URL, headers=headers)
-    tasks_json = tasks.json()
-    nextPageToken = tasks_json.get('nextPageToken', None)
-    process_wrike_tasks_helper(tasks_json.get('data', None))
+    Returns the urls to fetch tasks from. An incremental fetch usually fits in a
+    page or two and uses a single url; a full fetch is partitioned.
+    """
+    url = get_wrike_tasks_url(full)
+    if url != settings.WRIKE_TASK_API_URL:
+        return [url]
+    return get_wrike_task_partition_urls(url)
+
+
+def get_wrike_task_ids_url():
+    """
+    Returns the url of the task listing without any of the optional fields, which
+    is a lot smaller than the one the tasks are synced from. Its other parameters,
+    e.g. descendants or a status filter, are kept so that it lists the same tasks.
+    """
+    base_url, _, query = settings.WRIKE_TASK_API_URL.partition('?')
+    params = [param for param in query.split('&')
+              if param and not param.startswith('fields=') and not param.startswith('pageSize=')]
+    return "%s?%s" % (base_url, "&".join(params + ["pageSize=1000"]))
+
+
+def get_wrike_task_partition_urls(url):
+    """
+    Splits a task listing into WRIKE_TASK_PARTITIONS createdDate ranges whose
+    pages can be fetched concurrently.
+    """
+    partitions = settings.WRIKE_TASK_PARTITIONS
+    start = datetime.datetime.strptime(settings.WRIKE_TASK_PARTITION_START, "%Y-%m-%d")
+    end = datetime.datetime.utcnow()
+    if partitions <= 1 or end <= start:
+        return [url]
+
+    # The first range is open at the start and the last one at the end. Adjacent
+    # ranges share their boundary, which Wrike includes in both, so that no task
+    # falls between them; the tasks created at a boundary are listed twice and
+    # are only stored once, see store_wrike_tasks.
+    step = (end - start) / partitions
+    boundaries = [(start + step * i).replace(microsecond=0) for i in range(1, partitions)]
+    urls = []
+    for i in range(partitions):
+        created_date = {}
+        if i > 0:
+            created_date["start"] = boundaries[i - 1].strftime("%Y-%m-%dT%H:%M:%SZ")
+        if i < len(boundaries):
+            created_date["end"] = boundaries[i].strftime("%Y-%m-%dT%H:%M:%SZ")
+        urls.append("%s&%s=%s" % (url, "createdDate", json.dumps(created_date, sort_keys=True, separators=(',', ':'))))
+    return urls
+
+
+def process_wrike_tasks(full=False):
+    """
+    Fetch tasks from wrike's api. Only the tasks updated since the last successful
+    run are fetched unless `full` is True.
+    """
+    # Wrike limits # of returned tasks to 1000, so the pages of the partitions are
+    # fetched in the background while the previous page is written to the db.
+    pages = client.iter_partitioned_pages(get_wrike_tasks_urls(full), archive_as="tasks")
     try:
-        while True:
-            # Wrike limits # of returned tasks to 1000. So I need to pagingate
-            tasks = requests.get("%s&%s=%s" % (settings.WRIKE_TASK_API_URL, "nextPageToken", nextPageToken), headers=headers)
-            tasks_json = tasks.json()
-            data = tasks_json.get('data', None)
-            process_wrike_tasks_helper(data)
-            nextPageToken = tasks_json.get('nextPageToken', None)
-            if nextPageToken == None:
-                break
+        return store_wrike_tasks(pages)
+    finally:
+        pages.close()
+
+
+def store_wrike_tasks(pages):
+    """
+    Stores the pages of tasks and moves the tasks watermark forward, once every
+    page has been stored.
+    """
+    watermark = None
+    seen_ids = set()
+    try:
+        for tasks_json in pages:
+            # A task that is listed by more than one partition is only written once.
+            data = [row for row in tasks_json.get('data', None) or [] if row['id'] not in seen_ids]
+            seen_ids.update(row['id'] for row in data)
+            result = process_wrike_tasks_helper(data)
+            if watermark is None or (result["max_updatedDate"] and result["max_updatedDate"] > watermark):
+                watermark = result["max_updatedDate"]
     except Exception as e:
         logger.error(e)
         return False
+
+    if watermark:
+        set_sync_watermark("tasks", watermark)
     return True
 
-def process_wrike_tasks_helper(data):
+
+def process_wrike_task_deletions(full=False):
     """
-    A helper method for processing wrike's tasks and saving them into database
+    Finds the tasks that have been deleted in Wrike by comparing the ids that
+    Wrike lists with the local ones, and tombstones them. Listing every task is
+    costly for a large account, so unless `full` is True it is only done every
+    WRIKE_TASK_RECONCILE_INTERVAL seconds. Only a complete listing is reconciled:
+    if any page fails, nothing is tombstoned and the stage fails.
     """
-    db_col_names = get_model_fields_names('Task')
+    now_utc = datetime.datetime.utcnow().replace(tzinfo=utc)
+    last_checked = get_sync_watermark("task_ids")
+    interval = datetime.timedelta(seconds=settings.WRIKE_TASK_RECONCILE_INTERVAL)
+    if not full and last_checked and now_utc - last_checked < interval:
+        logger.info("Wrike deleted tasks were last checked for at %s" % last_checked)
+        return True
+
+    remote_ids = []
+    pages = client.iter_partitioned_pages(get_wrike_task_partition_urls(get_wrike_task_ids_url()),
+                                          archive_as="task_ids")
+    try:
+        for page in pages:
+            remote_ids.extend(get_listed_page_ids(page))
+    except Exception as e:
+        logger.error(e)
+        return False
+    finally:
+        pages.close()
 
-    for row in data:
-        db_row = {}
-        customfields = None
-        parentIds = None
-        responsibleIds = None
-
-        for col, val in row.iteritems():
-            if col == "customFields":
-                customfields = val
-            elif col == "parentIds":
-                parentIds = val
-            elif col == "responsibleIds":
-                responsibleIds = val
-            elif col == "createdDate" or col == "updatedDate" or col == "completedDate":
-                try:
-                    timestamp = datetime.datetime.strptime(val[:19], "%Y-%m-%dT%H:%M:%S")
-                    timestamp = timestamp.replace(tzinfo=pytz.UTC)
-                    db_row[col] = timestamp
-                except Exception as e:
-                    logger.error(e)
-                    continue
-            elif col == "briefDescription" or col == "title":
-                db_row[col] = smart_text("%s..." % val[:250])
-            else:
-                if col in db_col_names: db_row[col] = smart_text(val)
+    if tombstone_deleted_rows("tasks", Task, remote_ids) == False:
+        return False
+    set_sync_watermark("task_ids", now_utc)
+    return True
 
-        task, created = Task.objects.update_or_create(id=row['id'], defaults=db_row)
 
-        # Associate task with custom_fields and its values
-        for field in customfields:
-            val = smart_text(field['value'])
+def process_wrike_tasks_helper(data):
+    """
+    A helper method for processing wrike's tasks and saving them into database.
+
+    The whole page is written in one transaction: existing task ids and custom field
+    ids are preloaded into memory so that tasks and custom field values can be
+    written with bulk operations instead of a round trip per row. Tasks whose
+    content hash hasn't changed since the last sync are skipped.
+    """
+    start_time = time.time()
+    transformer = get_transformer(Task)
+    customfield_ids = set(CustomField.objects.values_list('id', flat=True))
+
+    task_rows = {}
+    # Tasks whose custom fields are given, and their values.
+    customfield_task_ids = set()
+    customfield_values = {}
+    folder_pairs = set()
+    assignee_pairs = set()
+    max_updatedDate = None
+    for row in data or []:
+        db_row = transformer.transform(row)
+        customfields = row.get("customFields", None)
+        parentIds = row.get("parentIds", None)
+        responsibleIds = row.get("responsibleIds", None)
+
+        db_row["content_hash"] = get_content_hash(row)
+        task_rows[row['id']] = db_row
+        if db_row.get("updatedDate") and (max_updatedDate is None or db_row["updatedDate"] > max_updatedDate):
+            max_updatedDate = db_row["updatedDate"]
+        # Associate task with folders (parents) and with contacts, i.e. those who are responsible for it.
+        folder_pairs.update((row['id'], pid) for pid in parentIds or [])
+        assignee_pairs.update((row['id'], rid) for rid in responsibleIds or [])
+
+        # Collect the task's custom_fields and their values
+        if "customFields" in row:
+            customfield_task_ids.add(row['id'])
+        for field in customfields or []:
+            val = to_text(field['value'])
             if val is None or val == "":
                 continue
-            try:
-                customfield = CustomField.objects.get(pk=field['id'])
-                cft, created = CustomFieldTask.objects.update_or_create(task=task, customfield=customfield, defaults={'value': val})
-            except Exception as e:
-                logger.error(e)
+            if field['id'] not in customfield_ids:
+                logger.error("CustomField matching query does not exist: %s" % field['id'])
                 continue
+            customfield_values[(row['id'], field['id'])] = val
+
+    db_start_time = time.time()
+    try:
+        with write_transaction(Task):
+            inserted, updated, unchanged = bulk_upsert(Task, task_rows)
+
+            # The custom field values and relations of unchanged tasks are the same as last time.
+            changed_ids = inserted | updated
+            customfield_values = dict(item for item in customfield_values.iteritems() if item[0][0] in changed_ids)
+            folder_pairs = set(pair for pair in folder_pairs if pair[0] in changed_ids)
+            assignee_pairs = set(pair for pair in assignee_pairs if pair[0] in changed_ids)
+
+            # The tasks that point at folders or contacts we don't have are rewritten by
+            # the next sync that lists them, which may have them by then.
+            unresolved_ids = set()
+            folder_ids = get_existing_ids(Folder, set(pid for task_id, pid in folder_pairs))
+            for task_id, pid in folder_pairs:
+                if pid not in folder_ids:
+                    logger.error("parentID=%s: Folder matching query does not exist." % pid)
+                    unresolved_ids.add(task_id)
+            contact_ids = get_existing_ids(Contact, set(rid for task_id, rid in assignee_pairs))
+            for task_id, rid in assignee_pairs:
+                if rid not in contact_ids:
+                    logger.error("%s: Contact matching query does not exist." % rid)
+                    unresolved_ids.add(task_id)
+
+            values_inserted, values_updated, values_deleted = bulk_upsert_values(
+                CustomFieldTask, 'task', customfield_task_ids & changed_ids, customfield_values)
+            reconcile_m2m(Task, 'folders', changed_ids,
+                          set(pair for pair in folder_pairs if pair[1] in folder_ids))
+            reconcile_m2m(Task, 'assignees', changed_ids,
+                          set(pair for pair in assignee_pairs if pair[1] in contact_ids))
+            clear_content_hashes(Task, unresolved_ids)
+    except Exception:
+        telemetry.record(failed=len(task_rows), db_seconds=time.time() - db_start_time)
+        raise
+    telemetry.record(inserted=len(inserted), updated=len(updated), unchanged=len(unchanged),
+                     db_seconds=time.time() - db_start_time)
+
+    elapsed = time.time() - start_time
+    written = len(inserted) + len(updated) + values_inserted + values_updated + values_deleted
+    logger.info("Tasks page: %s tasks inserted, %s updated, %s unchanged; %s custom field values "
+                "inserted, %s updated, %s deleted in %.2fs (%.0f rows/s)" % (len(inserted), len(updated),
+                len(unchanged), values_inserted, values_updated, values_deleted, elapsed,
+                written / elapsed if elapsed else 0))
+    return {
+        "inserted": len(inserted),
+        "updated": len(updated),
+        "unchanged": len(unchanged),
+        "values_inserted": values_inserted,
+        "values_updated": values_updated,
+        "values_deleted": values_deleted,
+        "seconds": elapsed,
+        "max_updatedDate": max_updatedDate,
+    }
+
+
+def get_wrike_ids_url(list_url, ids):
+    """
+    Returns the url that fetches the given tasks or folders by id, derived from
+    the url of their listing. The listing's `fields` are asked for as well, so
+    that the rows look the same as the listed ones.
+    """
+    base_url, _, query = list_url.partition('?')
+    params = [param for param in query.split('&') if param.startswith('fields=')]
+    url = "%s/%s" % (base_url, ",".join(ids))
+    if params:
+        url = "%s?%s" % (url, "&".join(params))
+    return url
 
-        task.folders.clear()
-        # Associate task with folders (parents)
-        for pid in parentIds:
-            try:
-                folder = Folder.objects.get(pk=pid)
-                task.folders.add(folder)
-            except Exception as e:
-                logger.error("parentID=%s: %s" % (pid, e))
-                continue
 
-        task.assignees.clear()
-        # Associate task with contacts, i.e. those who are responsible for it.
-        for rid in responsibleIds:
-            try:
-                assignee = Contact.objects.get(pk=rid)
-                task.assignees.add(assignee)
-            except Exception as e:
-                logger.error(e)
+def process_wrike_webhook_updates():
+    """
+    Fetches the current state of the folders and tasks queued by the webhook,
+    WRIKE_WEBHOOK_BATCH_SIZE at a time, and stores them with the same helpers as
+    the listed ones. A batch is only dequeued once it has been stored, and during
+    a blue/green sync once the staging db has been published; rows that were
+    notified again in the meantime stay queued. A batch that fails is backed off,
+    see webhooks.defer_updates.
+    """
+    updates = list(webhooks.get_ready_updates())
+    if not updates:
+        return True
+    read_until = max(update.received for update in updates)
+
+    success = True
+    for entity, model, list_url in ((WebhookUpdate.FOLDER, Folder, settings.WRIKE_FOLDER_API_URL),
+                                    (WebhookUpdate.TASK, Task, settings.WRIKE_TASK_API_URL)):
+        ids = sorted(update.wrike_id for update in updates if update.entity == entity)
+        for batch in chunked(ids, settings.WRIKE_WEBHOOK_BATCH_SIZE):
+            if process_wrike_updated_rows(model, list_url, batch) == False:
+                webhooks.defer_updates(entity, batch, read_until)
+                success = False
                 continue
-    return True
+            staging.after_publish(functools.partial(dequeue_webhook_updates, entity, batch, read_until))
+        if model is Folder and ids:
+            # The folders may have been moved, added or deleted.
+            success = update_folder_closure() and success
+    logger.info("Wrike webhook updates: %s folders and tasks fetched" % len(updates))
+    return success
 
 
+def dequeue_webhook_updates(entity, ids, read_until):
+    WebhookUpdate.objects.filter(entity=entity, wrike_id__in=ids, received__lte=read_until).delete()
 
 
+def process_wrike_updated_rows(model, list_url, ids):
+    """
+    Fetches the folders or tasks by id and stores them. Those that Wrike has
+    moved to its Recycle Bin, or no longer has at all, are tombstoned.
+    """
+    try:
+        response = client.get(get_wrike_ids_url(list_url, ids))
+        if response.status_code == 404:
+            # Wrike rejects the whole batch if any of the ids is gone; find out which.
+            if len(ids) == 1:
+                data = []
+            else:
+                return all([process_wrike_updated_rows(model, list_url, [wrike_id]) != False for wrike_id in ids])
+        elif response.status_code != 200:
+            logger.error("Wrike %s fetch failed: %s %s" % (model.__name__, response.status_code, response.text))
+            return False
+        else:
+            data = response.json()['data']
+
+        if model is Folder:
+            if process_wrike_folder_and_projects_helper(data) == False:
+                return False
+        else:
+            process_wrike_tasks_helper(data)
+
+        live_ids = set(get_listed_ids(data))
+        start_time = time.time()
+        # queryset.update() bypasses BaseModel.save(); the stamp lets the support facts
+        # and the folder closure find the rows, see get_changed_ids().
+        now_utc = datetime.datetime.utcnow().replace(tzinfo=utc)
+        with write_transaction(model):
+            tombstoned = model.objects.filter(id__in=[i for i in ids if i not in live_ids], tombstoned=False) \
+                .update(tombstoned=True, updated=now_utc)
+            revived = model.objects.filter(id__in=live_ids, tombstoned=True).update(tombstoned=False, updated=now_utc)
+        telemetry.record(updated=tombstoned + revived, db_seconds=time.time() - start_time)
+    except Exception as e:
+        logger.error(e)
+        return False
+    return True
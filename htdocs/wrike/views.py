@@ -6,15 +6,18 @@ import logging
 
 from django.core.urlresolvers import reverse_lazy
 
-from django.shortcuts import render, redirect
-from django.http import HttpResponse, HttpResponseRedirect
+from django.shortcuts import get_object_or_404, render, redirect
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, \
+    HttpResponseRedirect, JsonResponse
 from django.views.generic import TemplateView, View
 
 from django.contrib import messages
 
-from .models import WrikeOauth2Credentials
+from .models import CustomField, WrikeOauth2Credentials, SyncRun
 from .views_helpers import *
 from .mixins import FilterMixin
+from .report_cache import get_report
+from . import webhooks
 
 logger = logging.getLogger(__name__)
 
@@ -27,7 +30,7 @@ class SupportCompletedByPerson(FilterMixin, TemplateView):
         context['end_date'] = self.request.POST.get("end", '')
 
         criteria = kwargs.get('criteria', {})
-        data = get_support_data_by_person(criteria)
+        data = get_report(get_support_data_by_person, criteria)
         context['categories'] = json.dumps(data[0])
         context['data'] = json.dumps(data[1])
         return context
@@ -42,7 +45,7 @@ class SupportByRegion(FilterMixin, TemplateView):
         context['end_date'] = self.request.POST.get("end", '')
 
         criteria = kwargs.get('criteria', {})
-        data = get_support_data_by_region(criteria)
+        data = get_report(get_support_data_by_region, criteria)
         context['categories'] = json.dumps(data[0])
         context['data'] = json.dumps(data[1])
         return context
@@ -57,12 +60,83 @@ class SupportByCountry(FilterMixin, TemplateView):
         context['end_date'] = self.request.POST.get("end", '')
 
         criteria = kwargs.get('criteria', {})
-        data = get_support_data_by_country(criteria)
+        data = get_report(get_support_data_by_country, criteria)
         context['categories'] = json.dumps(data[0])
         context['data'] = json.dumps(data[1])
         return context
 
 
+class SupportByCustomField(FilterMixin, TemplateView):
+    template_name = 'wrike/home.html'
+
+    def get_context_data(self, **kwargs):
+        context = super(SupportByCustomField, self).get_context_data(**kwargs)
+        context['start_date'] = self.request.POST.get("start", '')
+        context['end_date'] = self.request.POST.get("end", '')
+
+        customfield = get_object_or_404(CustomField, pk=kwargs['customfield_id'])
+        criteria = kwargs.get('criteria', {})
+        data = get_report(get_support_data_by_custom_field, criteria, customfield.pk)
+        context['categories'] = json.dumps(data[0])
+        context['data'] = json.dumps(data[1])
+        return context
+
+
+class SyncRuns(View):
+    """
+    Returns the most recent sync runs, and the telemetry of their stages, as json.
+    The number of runs defaults to 50 and can be set with the `limit` parameter.
+    """
+    fields = ('id', 'started', 'finished', 'duration', 'full', 'success')
+    stage_fields = ('name', 'started', 'finished', 'duration', 'success', 'requests', 'retries', 'pages',
+                    'bytes', 'rows_inserted', 'rows_updated', 'rows_unchanged', 'rows_failed', 'http_seconds',
+                    'db_seconds')
+
+    def get(self, request):
+        try:
+            limit = max(1, min(int(request.GET.get("limit", 50)), 1000))
+        except ValueError:
+            limit = 50
+
+        runs = []
+        for run in SyncRun.objects.prefetch_related('stages')[:limit]:
+            data = dict((field, getattr(run, field)) for field in self.fields)
+            data['stages'] = [dict((field, getattr(stage, field)) for field in self.stage_fields)
+                              for stage in run.stages.all()]
+            runs.append(data)
+        return JsonResponse({'runs': runs})
+
+
+class WrikeWebhook(View):
+    """
+    Receives the task and folder change notifications of a Wrike webhook that
+    was created with WRIKE_WEBHOOK_SECRET as its secret, and queues the changed
+    tasks and folders for the sync to fetch.
+    """
+    def post(self, request):
+        if not settings.WRIKE_WEBHOOK_SECRET:
+            return HttpResponseNotFound()
+        try:
+            payload = json.loads(request.body)
+        except ValueError:
+            return HttpResponseBadRequest()
+
+        if webhooks.is_verification_request(payload):
+            hook_secret = request.META.get('HTTP_X_HOOK_SECRET', '')
+            if not webhooks.is_verification_secret(hook_secret):
+                logger.warn("Wrike webhook verification request with an invalid secret")
+                return HttpResponseBadRequest()
+            response = HttpResponse()
+            response['X-Hook-Secret'] = webhooks.get_signature(hook_secret)
+            return response
+
+        if not webhooks.is_valid_signature(request.body, request.META.get('HTTP_X_HOOK_SIGNATURE', '')):
+            logger.warn("Wrike webhook notification with an invalid signature")
+            return HttpResponseForbidden()
+        webhooks.queue_updates(payload if isinstance(payload, list) else [payload])
+        return HttpResponse()
+
+
 class WrikeOauth2SetupStep1(View):
     """
     Forwards the user to Wrike authorization URL to request an authorization code.
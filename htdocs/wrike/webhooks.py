@@ -0,0 +1,112 @@
+"""
+Receives Wrike's webhook notifications, see https://developers.wrike.com/webhooks/.
+
+Wrike signs every notification with the webhook's secret: the X-Hook-Signature
+header is the hex HMAC-SHA256 of the request body. When the webhook is created
+Wrike first sends a verification request whose X-Hook-Secret header is a random
+value, which has to be answered with that value's HMAC-SHA256. Only alphanumeric
+values are answered, since a notification body, which is json, can't be one;
+otherwise anyone could have a forged notification signed that way.
+
+The notified tasks and folders are queued as WebhookUpdates; the sync fetches
+their current state (see utils.process_wrike_webhook_updates). Updates whose
+fetch fails are retried with an exponential backoff and eventually dropped.
+"""
+import datetime
+import hashlib
+import hmac
+import logging
+import re
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import WebhookUpdate
+
+logger = logging.getLogger(__name__)
+
+VERIFICATION_REQUEST_TYPE = "WebHook secret verification"
+
+# The X-Hook-Secret values of the verification requests that are answered.
+VERIFICATION_SECRET_PATTERN = re.compile(r'^[A-Za-z0-9]{1,256}$')
+
+
+def get_signature(value, secret=None):
+    return hmac.new(str(secret or settings.WRIKE_WEBHOOK_SECRET), value, hashlib.sha256).hexdigest()
+
+
+def is_valid_signature(body, signature):
+    return hmac.compare_digest(get_signature(body), str(signature or ""))
+
+
+def is_verification_request(payload):
+    return isinstance(payload, dict) and payload.get("requestType", None) == VERIFICATION_REQUEST_TYPE
+
+
+def is_verification_secret(value):
+    return VERIFICATION_SECRET_PATTERN.match(value or "") is not None
+
+
+def queue_updates(events):
+    """
+    Queues the tasks and folders that the notified events are about and returns
+    how many there were.
+    """
+    ids = set()
+    for event in events:
+        if not isinstance(event, dict):
+            continue
+        if event.get("taskId", None):
+            ids.add((WebhookUpdate.TASK, event["taskId"]))
+        elif event.get("folderId", None):
+            ids.add((WebhookUpdate.FOLDER, event["folderId"]))
+
+    now = timezone.now()
+    with transaction.atomic():
+        for entity, wrike_id in ids:
+            WebhookUpdate.objects.update_or_create(entity=entity, wrike_id=wrike_id, defaults=get_queued_values(now))
+    logger.info("Wrike webhook: %s events, %s tasks and folders queued" % (len(events), len(ids)))
+    return len(ids)
+
+
+def get_queued_values(received):
+    """
+    The values of a newly queued update; a new notification also starts the
+    retries of a row whose fetch has failed afresh.
+    """
+    return {"received": received, "attempts": 0, "retry_after": None}
+
+
+def get_ready_updates(now=None):
+    """
+    Returns the queued updates that are to be fetched now, i.e. all but those
+    whose fetch has failed and whose backoff hasn't passed yet.
+    """
+    now = now or timezone.now()
+    return WebhookUpdate.objects.filter(Q(retry_after__isnull=True) | Q(retry_after__lte=now))
+
+
+def defer_updates(entity, ids, read_until):
+    """
+    Backs off the queued updates whose fetch failed, e.g. with a 403 or a 5xx,
+    so that the daemon doesn't fetch them again straight away: they wait for
+    WRIKE_WEBHOOK_RETRY_DELAY seconds, doubled after each failed attempt, and
+    after WRIKE_WEBHOOK_MAX_ATTEMPTS they are dropped, leaving the rows to the
+    scheduled syncs. Rows notified again since `read_until` are left alone.
+    """
+    now = timezone.now()
+    dropped = 0
+    for update in WebhookUpdate.objects.filter(entity=entity, wrike_id__in=ids, received__lte=read_until):
+        update.attempts += 1
+        if update.attempts >= settings.WRIKE_WEBHOOK_MAX_ATTEMPTS:
+            update.delete()
+            dropped += 1
+            continue
+        delay = settings.WRIKE_WEBHOOK_RETRY_DELAY * 2 ** (update.attempts - 1)
+        update.retry_after = now + datetime.timedelta(seconds=delay)
+        update.save()
+    if dropped:
+        logger.error("Wrike webhook: %s %ss dropped after %s failed fetches" % (
+            dropped, entity, settings.WRIKE_WEBHOOK_MAX_ATTEMPTS))